@@ -0,0 +1,268 @@
+"""Benchmark tex2ipy on synthetic beamer presentations.
+
+Each stage of the conversion (preprocessing, parsing, walking the tree,
+making the notebook and writing it) is timed separately for decks of
+different sizes and the peak memory used by the whole conversion is
+measured.  The results can be saved as JSON and compared with an earlier
+run, for example::
+
+    $ python benchmarks/bench.py --sizes 10 100 1000 -o new.json
+    $ python benchmarks/bench.py --compare old.json new.json
+
+"""
+import argparse
+from io import StringIO
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+# Benchmark the tex2ipy of this checkout, whether or not it is installed.
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from tex2ipy import __version__  # noqa: E402
+from tex2ipy.cli import _new_notebook, write_notebook  # noqa: E402
+from tex2ipy.tex2cells import Tex2Cells, preprocess, to_node  # noqa: E402
+
+
+STAGES = ('preprocess', 'texsoup', 'walk', 'from_dict', 'write')
+
+PREAMBLE = r"""\documentclass[14pt, compress]{beamer}
+\usepackage{listings}
+
+\title{A synthetic presentation}
+\author{Ty Coon}
+\date{TODAY}
+\institute{Jobless Inc.}
+
+\begin{document}
+
+\begin{frame}
+  \titlepage
+\end{frame}
+"""
+
+FRAME_PARTS = (
+    r"""  \begin{itemize}
+  \item The $\alpha_{%(i)d}$ item with \emph{emphasis} %% a comment
+  \item Another item with \textbf{bold} and \texttt{code}
+  \item A \lstinline{for} loop \ldots
+  \end{itemize}
+""",
+    r"""  \begin{enumerate}
+  \item First
+  \pause
+  \item Second \url{https://example.com/%(i)d}
+  \end{enumerate}
+""",
+    r"""  \begin{equation}
+    \int_0^{%(i)d} \sin(x) dx = 1 - \cos(%(i)d)
+  \end{equation}
+  \[ e^{i\pi} + 1 = 0 \]
+""",
+    r"""  \begin{lstlisting}
+In []: x = %(i)d
+In []: for i in range(x):
+  ....:     print(i %% 7)
+Out[]: 0
+In []: x*2
+  \end{lstlisting}
+""",
+    r"""  \begin{center}
+    \includegraphics[width=3in]{images/figure%(i)d}
+  \end{center}
+""",
+    r"""  \begin{block}{Block %(i)d}
+    Some text in a block with \unknownmacro{argument} and \othermacro.
+  \end{block}
+""",
+    r"""  Plain text in a paragraph that goes on for a while to make it longer
+  than a single line, with an inline equation $x^%(i)d$ and
+  \vspace{0.1in} some spacing.
+""",
+)
+
+
+def make_deck(n_frames, seed=0):
+    """Return the TeX code of a synthetic presentation with the given number
+    of frames mixing lists, equations, listings, images and unknown macros.
+    """
+    rng = random.Random(seed)
+    parts = [PREAMBLE]
+    for i in range(n_frames):
+        if i % 20 == 0:
+            parts.append('\\section{Section %d}\n\n' % i)
+        parts.append('\\begin{frame}[fragile]\n')
+        parts.append('  \\frametitle{Frame %d}\n' % i)
+        for part in rng.sample(FRAME_PARTS, rng.randint(1, 3)):
+            parts.append(part % dict(i=i))
+        parts.append('\\end{frame}\n\n')
+    parts.append('\\end{document}\n')
+    return ''.join(parts)
+
+
+def run_stages(code, engine='texsoup'):
+    """Convert the code and return a dictionary of the time taken by each
+    stage.  The `texsoup` stage is the parsing with the given `engine`.
+    """
+    times = {}
+    start = time.perf_counter()
+    preprocess(code)
+    times['preprocess'] = time.perf_counter() - start
+
+    t2c = Tex2Cells(code, engine=engine)
+    start = time.perf_counter()
+    t2c.soups
+    times['texsoup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cells = t2c.parse()
+    times['walk'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nb = _new_notebook([to_node(cell) for cell in cells])
+    times['from_dict'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_notebook(nb, StringIO())
+    times['write'] = time.perf_counter() - start
+    times['n_cells'] = len(cells)
+    return times
+
+
+def peak_memory(code, engine='texsoup'):
+    """Return the peak memory in bytes used to convert the code.
+    """
+    tracemalloc.start()
+    try:
+        t2c = Tex2Cells(code, engine=engine)
+        cells = t2c.parse()
+        nb = _new_notebook([to_node(cell) for cell in cells])
+        write_notebook(nb, StringIO())
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(sizes, repeat=3, seed=0, memory=True, engine='texsoup'):
+    """Run the benchmark for decks with each number of frames in `sizes`.
+
+    The best time of `repeat` runs is reported for each stage.  The decks
+    are parsed with the given `engine`.
+    """
+    results = []
+    for n_frames in sizes:
+        code = make_deck(n_frames, seed)
+        best = None
+        for i in range(repeat):
+            times = run_stages(code, engine)
+            if best is None:
+                best = times
+            else:
+                for stage in STAGES:
+                    best[stage] = min(best[stage], times[stage])
+        best['total'] = sum(best[stage] for stage in STAGES)
+        best['frames'] = n_frames
+        best['bytes'] = len(code)
+        if memory:
+            best['peak_memory'] = peak_memory(code, engine)
+        results.append(best)
+        print_result(best)
+    return dict(
+        version=__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        repeat=repeat,
+        seed=seed,
+        engine=engine,
+        results=results,
+    )
+
+
+def print_result(result, stream=None):
+    stages = ' '.join('%s=%.4f' % (s, result[s]) for s in STAGES)
+    memory = ''
+    if 'peak_memory' in result:
+        memory = ' peak_memory=%.1fMB' % (result['peak_memory']/2**20)
+    print('frames=%d cells=%d total=%.4f %s%s' % (
+        result['frames'], result['n_cells'], result['total'], stages, memory
+    ), file=stream)
+
+
+def compare(old, new, stream=None):
+    """Print the ratio of the new to the old times for each deck size.
+    """
+    old_results = dict((r['frames'], r) for r in old['results'])
+    keys = ('total',) + STAGES + ('peak_memory',)
+    print('frames ' + ' '.join('%10s' % k for k in keys), file=stream)
+    for new_r in new['results']:
+        old_r = old_results.get(new_r['frames'])
+        if old_r is None:
+            continue
+        ratios = []
+        for key in keys:
+            if old_r.get(key) and key in new_r:
+                ratios.append('%10.2f' % (new_r[key]/old_r[key]))
+            else:
+                ratios.append('%10s' % '-')
+        print('%6d ' % new_r['frames'] + ' '.join(ratios), file=stream)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        "Benchmark tex2ipy on synthetic beamer presentations"
+    )
+    parser.add_argument(
+        "--sizes", nargs='+', type=int, default=[10, 100, 1000],
+        help="Number of frames in each deck (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Number of times each deck is converted (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed used to generate the decks (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--no-memory", action="store_false", dest="memory", default=True,
+        help="Do not measure the peak memory."
+    )
+    parser.add_argument(
+        "--engine", default='texsoup', choices=['texsoup', 'fast'],
+        help="Parser to use (default: %(default)s)."
+    )
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="Save the results to this JSON file."
+    )
+    parser.add_argument(
+        "--compare", nargs=2, metavar=('OLD', 'NEW'), default=None,
+        help="Compare two saved results instead of running the benchmark."
+    )
+    args = parser.parse_args(args)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return
+
+    results = benchmark(
+        args.sizes, args.repeat, args.seed, args.memory, args.engine
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    main()
@@ -0,0 +1,300 @@
+"""Convert whole directory trees of TeX files in parallel.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+import time
+
+
+class _WorkerState(object):
+    """The converter class, its source, the cache, the image and include
+    resolvers, the macros, the parsing engine and whether to validate the
+    notebooks and merge their outputs in the current (worker) process.
+
+    These are set once per process by `_init_worker` so that a custom
+    converter is only loaded once and not for every file, and image
+    directories and included files are only read once.
+    """
+    __slots__ = ('converter', 'converter_source', 'cache', 'image_resolver',
+                 'include_resolver', 'macros', 'engine', 'validate', 'merge')
+
+    def __init__(self):
+        self.converter = None
+        self.converter_source = ''
+        self.cache = None
+        self.image_resolver = None
+        self.include_resolver = None
+        self.macros = None
+        self.engine = None
+        self.validate = False
+        self.merge = False
+
+
+_worker = _WorkerState()
+
+
+# A `\begin{document}` which is not in a comment.
+_BEGIN_DOCUMENT = re.compile(r'^[^%\n]*\\begin\s*\{document\}', re.M)
+
+
+def is_document(code):
+    r"""Return True if the code has a `\begin{document}`.  Files without one
+    are typically parts of a document included with `\input`.
+    """
+    return _BEGIN_DOCUMENT.search(code) is not None
+
+
+def find_tex_files(src_dir):
+    """Return a sorted list of all the `.tex` files under `src_dir`.
+    """
+    result = []
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.endswith('.tex'):
+                result.append(os.path.join(root, fname))
+    return result
+
+
+def get_output_path(src, src_dir, out_dir):
+    """Return the notebook path in `out_dir` mirroring `src` in `src_dir`.
+    """
+    rel = os.path.relpath(src, src_dir)
+    return os.path.join(out_dir, os.path.splitext(rel)[0] + '.ipynb')
+
+
+def _init_worker(converter_path, cache=None, validate=False, macros=None,
+                 engine=None, merge=False):
+    from .cli import load_converter
+    from .includes import IncludeResolver
+    from .tex2cells import ImageResolver
+    worker = _worker
+    worker.converter, worker.converter_source = load_converter(
+        converter_path
+    )
+    worker.cache = cache
+    worker.image_resolver = ImageResolver()
+    worker.include_resolver = IncludeResolver()
+    worker.macros = macros
+    worker.engine = engine
+    worker.validate = validate
+    worker.merge = merge
+
+
+def convert_file(src, dest, converter, cache=None, converter_source='',
+                 validate=False, include_resolver=None, merge=False,
+                 code=None, **kw):
+    """Convert the TeX file `src` and write the notebook to `dest`.
+
+    The files included by `src` are inlined using the `include_resolver`
+    (an `IncludeResolver`), unless the expanded `code` is given.  The output
+    file is only written if its contents change.  The notebook is only
+    validated if `validate` is True.  If `merge` is True, the outputs of the
+    existing notebook are kept (see `merge_outputs`).  Any keyword arguments
+    are passed on to the converter.
+    """
+    from .cli import merge_outputs, read_text, tex2ipy_text, \
+        write_if_changed
+    from .includes import IncludeResolver
+    if code is None:
+        if include_resolver is None:
+            include_resolver = IncludeResolver()
+        code = include_resolver.expand_file(src)
+    text = tex2ipy_text(
+        code, converter, cache, converter_source, validate, **kw
+    )
+    if merge:
+        text = merge_outputs(text, read_text(dest))
+    dest_dir = os.path.dirname(dest)
+    if dest_dir:
+        os.makedirs(dest_dir, exist_ok=True)
+    write_if_changed(dest, text)
+
+
+def _convert_task(src, dest):
+    """Convert the file if it is a document and return a dictionary with
+    the `error` message (or None), whether it is a `document`, the
+    `diagnostics`, the `stamps` of the files read and the `images` found.
+    """
+    from .cache import dump_images
+    from .tex2cells import Diagnostics
+    diagnostics = Diagnostics()
+    images = {}
+    result = dict(error=None, document=True, diagnostics=diagnostics)
+    worker = _worker
+    try:
+        code = worker.include_resolver.expand_file(src)
+        if is_document(code):
+            convert_file(
+                src, dest, worker.converter, worker.cache,
+                worker.converter_source, worker.validate,
+                worker.include_resolver, worker.merge, code=code,
+                image_resolver=worker.image_resolver,
+                diagnostics=diagnostics, macros=worker.macros,
+                engine=worker.engine, images=images
+            )
+        else:
+            result['document'] = False
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        return result
+    result['stamps'] = worker.include_resolver.stamps(src)
+    result['images'] = dump_images(images)
+    return result
+
+
+def _dependencies_file(cache):
+    return os.path.join(cache.base_dir, 'dependencies.json')
+
+
+def _converter_key(converter_path, macros=None):
+    from .cache import make_key
+    source = ''
+    if converter_path:
+        with open(converter_path) as f:
+            source = f.read()
+    extra = () if macros is None else (macros.key,)
+    return make_key(source, *extra)
+
+
+def batch_convert(src_dir, out_dir, converter_path='', jobs=None,
+                  cache=None, validate=False, macros=None, engine=None,
+                  merge=False):
+    r"""Convert all the TeX files in `src_dir` to notebooks in `out_dir`.
+
+    The directory layout of `src_dir` is mirrored in `out_dir`.  The files
+    are converted using a pool of `jobs` worker processes, each of which
+    loads the converter only once.  If `jobs` is 1, the conversion is done
+    in the current process.  If a `cache` (a `ConversionCache`) is given,
+    unchanged files are not converted again.  The notebooks are validated
+    if `validate` is True.  `macros` is a `MacroTable` with macros to
+    expand in every file and `engine` the parser to use (see `Tex2Cells`).
+    The outputs of existing notebooks are kept if `merge` is True.
+
+    Files without a `\begin{document}` (see `is_document`), such as the
+    parts of a document included with `\input`, are not converted.
+
+    The files included by each file and the images it uses are recorded in
+    the cache directory.  On later runs, files whose output exists (or which
+    are not documents) and which have not changed, nor have any of the files
+    they include or the image files found, are skipped without being read.
+
+    Returns a dictionary with the files found, the files skipped, the files
+    which are not documents, the failures (a list of (filename, error
+    message) tuples), the files affected by changes to the files they
+    include (a dictionary mapping them to the changed files), the unknown
+    macros found in all the files (a `Diagnostics` instance, those of the
+    skipped files are recorded in the cache directory) and the time taken.
+    """
+    from .cache import dump_diagnostics, load_diagnostics, load_images
+    from .includes import changed_files, load_dependencies, \
+        save_dependencies
+    from .tex2cells import Diagnostics, ImageResolver
+    start = time.perf_counter()
+    files = find_tex_files(src_dir)
+    dependencies = {}
+    if cache is not None:
+        dependencies = load_dependencies(_dependencies_file(cache))
+        converter_key = _converter_key(converter_path, macros)
+    tasks = []
+    skipped = []
+    parts = []
+    affected = {}
+    diagnostics = Diagnostics()
+    image_resolver = ImageResolver()
+    for src in files:
+        dest = get_output_path(src, src_dir, out_dir)
+        path = os.path.abspath(src)
+        entry = dependencies.get(path)
+        document = entry is None or entry.get('document', True)
+        if entry is not None and entry['dest'] == os.path.abspath(dest) \
+                and entry['converter'] == converter_key \
+                and (not document or os.path.exists(dest)) \
+                and 'diagnostics' in entry:
+            changed = changed_files(entry['stamps'])
+            images = load_images(entry.get('images', []))
+            if not changed and image_resolver.is_unchanged(images):
+                (skipped if document else parts).append(src)
+                diagnostics.update(load_diagnostics(entry['diagnostics']))
+                continue
+            included = [x for x in changed if x != path]
+            if included:
+                affected[src] = included
+        tasks.append((src, dest))
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(tasks)))
+
+    if not tasks:
+        results = []
+    elif jobs == 1:
+        _init_worker(converter_path, cache, validate, macros, engine, merge)
+        results = [_convert_task(src, dest) for src, dest in tasks]
+    else:
+        with ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker,
+                initargs=(converter_path, cache, validate, macros,
+                          engine, merge)) as pool:
+            results = list(pool.map(
+                _convert_task, *zip(*tasks),
+                chunksize=max(1, len(tasks)//(4*jobs))
+            ))
+    elapsed = time.perf_counter() - start
+
+    failures = []
+    for (src, dest), result in zip(tasks, results):
+        diagnostics.update(result['diagnostics'])
+        path = os.path.abspath(src)
+        if result['error'] is not None:
+            failures.append((src, result['error']))
+            dependencies.pop(path, None)
+            continue
+        if not result['document']:
+            parts.append(src)
+            affected.pop(src, None)
+        if cache is not None:
+            dependencies[path] = dict(
+                dest=os.path.abspath(dest), converter=converter_key,
+                stamps=result['stamps'], images=result['images'],
+                document=result['document'],
+                diagnostics=dump_diagnostics(result['diagnostics'])
+            )
+    if cache is not None:
+        save_dependencies(_dependencies_file(cache), dependencies)
+    return dict(
+        files=files, skipped=skipped, parts=parts, failures=failures,
+        affected=affected, diagnostics=diagnostics, time=elapsed, jobs=jobs
+    )
+
+
+def print_summary(result, stream=None):
+    """Print a summary of the result returned by `batch_convert`.
+    """
+    n_parts = len(result.get('parts', ()))
+    n_files = len(result['files']) - n_parts
+    n_failed = len(result['failures'])
+    n_skipped = len(result.get('skipped', ()))
+    elapsed = result['time']
+    rate = n_files/elapsed if elapsed > 0 else 0.0
+    print("Converted %d of %d files in %.2f s (%.1f files/s, %d jobs)" % (
+        n_files - n_failed, n_files, elapsed, rate, result['jobs']
+    ), file=stream)
+    if n_skipped:
+        print("%d unchanged files were skipped" % n_skipped, file=stream)
+    if n_parts:
+        print("%d files without \\begin{document} were not converted" %
+              n_parts, file=stream)
+    affected = result.get('affected')
+    if affected:
+        print("%d files affected by changed included files:" % len(affected),
+              file=stream)
+        for src, changed in sorted(affected.items()):
+            print("  %s: %s" % (src, ', '.join(changed)), file=stream)
+    if n_failed:
+        print("%d failed:" % n_failed, file=stream)
+        for src, err in result['failures']:
+            print("  %s: %s" % (src, err), file=stream)
+    diagnostics = result.get('diagnostics')
+    if diagnostics:
+        diagnostics.report(stream, show_lines=False)
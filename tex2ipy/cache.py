@@ -0,0 +1,387 @@
+"""A simple on-disk cache for converted notebooks, frames and parse trees.
+
+Entries are keyed on a hash of the input TeX, the source of the converter
+used and the tex2ipy version so a conversion is only redone when one of
+these changes.  The total size of the cache is bounded, the least recently
+used entries are evicted first.
+"""
+import copyreg
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+
+from . import __version__
+
+
+# 256 MB.
+DEFAULT_MAX_SIZE = 256*1024*1024
+
+
+def default_cache_dir():
+    """Return the default cache directory for tex2ipy.
+    """
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tex2ipy')
+
+
+def make_key(*parts):
+    """Return a hex digest identifying the given string parts.
+    """
+    sha = hashlib.sha256(__version__.encode('utf-8'))
+    for part in parts:
+        data = part.encode('utf-8')
+        sha.update(b'\0%d\0' % len(data))
+        sha.update(data)
+    return sha.hexdigest()
+
+
+class DiskCache(object):
+    """Store text (or bytes if `binary` is True) in files under a directory,
+    keyed on a hex digest.
+
+    Reading an entry updates its modification time which is used to evict
+    the least recently used entries when `prune` is called.
+    """
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE,
+                 suffix='', binary=False):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.suffix = suffix
+        self.binary = binary
+
+    def _open(self, path, mode):
+        if self.binary:
+            return open(path, mode + 'b')
+        else:
+            return open(path, mode, encoding='utf-8')
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """Return the data stored for the key or None if there is none.
+        """
+        path = self._path(key)
+        try:
+            with self._open(path, 'r') as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:  # pragma: no cover
+            pass
+        return data
+
+    def put(self, key, data):
+        """Store the data for the given key.
+
+        The data is written to a temporary file which is then renamed so
+        concurrent readers never see a partially written entry.
+        """
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        os.close(fd)
+        try:
+            with self._open(tmp, 'w') as fp:
+                fp.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for sub in os.listdir(self.cache_dir):
+            subdir = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for fname in os.listdir(subdir):
+                if not fname.endswith(self.suffix) or fname.endswith('.tmp'):
+                    continue
+                path = os.path.join(subdir, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:  # pragma: no cover
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        """Return the total size in bytes of all the entries.
+        """
+        return sum(size for mtime, size, path in self._entries())
+
+    def prune(self):
+        """Remove the least recently used entries until the total size of
+        the cache is at most `max_size`.  Returns the number of entries
+        removed.
+        """
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # pragma: no cover
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+def dump_images(images):
+    """Return the images found by a converter (see `Tex2Cells.images`) as a
+    list which can be saved as JSON, `load_images` reverses this.
+    """
+    return [
+        [path, list(search_paths), image]
+        for (path, search_paths), image in sorted(images.items())
+    ]
+
+
+def load_images(data):
+    return dict(
+        ((path, tuple(search_paths)), image)
+        for path, search_paths, image in data
+    )
+
+
+def dump_diagnostics(diagnostics):
+    """Return a `Diagnostics` instance as a dictionary which can be saved as
+    JSON, `load_diagnostics` reverses this.
+    """
+    return dict(
+        (name, [count, diagnostics.lines.get(name, [])])
+        for name, count in diagnostics.unknown.items()
+    )
+
+
+def load_diagnostics(data):
+    from .tex2cells import Diagnostics
+    diagnostics = Diagnostics()
+    for name, (count, lines) in data.items():
+        diagnostics.unknown[name] = count
+        if lines:
+            diagnostics.lines[name] = list(lines)
+    return diagnostics
+
+
+class ConversionCache(DiskCache):
+    """Cache the notebook text produced for a given TeX input.
+
+    Each entry is a dictionary with the notebook `text`, the `images` found
+    by the converter, see `Tex2Cells.images`, and its `diagnostics`.  The
+    output depends on which image files exist, so an entry should only be
+    used if the images are unchanged.
+
+    The frame and tree caches (see `frame_cache` and `tree_cache`) are kept
+    in the same directory and `max_size` bounds the size of all of them, so
+    `size` and `prune` apply to the whole directory.  As this lists every
+    entry, `maybe_prune` only prunes every `prune_interval` seconds.
+    """
+
+    # The minimum time in seconds between two calls to `prune` made by
+    # `maybe_prune`.
+    prune_interval = 600
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        super(ConversionCache, self).__init__(
+            os.path.join(cache_dir, 'notebooks'), max_size, suffix='.json'
+        )
+        self.base_dir = cache_dir
+
+    def get(self, key):
+        """Return the entry for the key or None if there is none.
+        """
+        data = super(ConversionCache, self).get(key)
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+            entry['images'] = load_images(entry['images'])
+            entry['diagnostics'] = load_diagnostics(entry['diagnostics'])
+        except (ValueError, KeyError, TypeError):
+            return None
+        return entry
+
+    def put(self, key, text, images=None, diagnostics=None, lines=None):
+        """Store the notebook text, the images found, the diagnostics (a
+        `Diagnostics` instance) and the line of each cell for the key.
+        """
+        entry = dict(text=text, images=dump_images(images or {}),
+                     diagnostics={})
+        if diagnostics is not None:
+            entry['diagnostics'] = dump_diagnostics(diagnostics)
+        if lines is not None:
+            entry['lines'] = lines
+        super(ConversionCache, self).put(key, json.dumps(entry))
+
+    def key(self, code, converter_source='', *extra):
+        """Return the key for the given TeX code and converter source and
+        any other strings the output depends on.
+        """
+        return make_key(code, converter_source, *extra)
+
+    def maybe_prune(self):
+        """Call `prune` unless it was called by this method less than
+        `prune_interval` seconds ago, the time is kept in a file in the
+        cache directory.  Returns the number of entries removed.
+        """
+        stamp = os.path.join(self.base_dir, 'last_prune')
+        try:
+            if time.time() - os.stat(stamp).st_mtime < self.prune_interval:
+                return 0
+        except OSError:
+            pass
+        # The time is recorded first so other processes do not prune too.
+        try:
+            with open(stamp, 'w'):
+                pass
+        except OSError:
+            pass
+        return self.prune()
+
+    def _entries(self):
+        entries = super(ConversionCache, self)._entries()
+        for cache in (self.frame_cache(), self.tree_cache()):
+            entries.extend(cache._entries())
+        return entries
+
+    def tree_cache(self):
+        """Return a `DiskTreeCache` sharing the same cache directory.
+        """
+        return DiskTreeCache(self.base_dir, self.max_size)
+
+    def frame_cache(self, converter_source=''):
+        """Return a `DiskFrameCache` for the given converter source sharing
+        the same cache directory.
+        """
+        return DiskFrameCache(
+            self.base_dir, make_key(converter_source), self.max_size
+        )
+
+
+class DiskFrameCache(DiskCache):
+    """Cache the cells generated for each frame on disk.
+
+    This may be passed as the `frame_cache` to `Tex2Cells`.  The `namespace`
+    is used to keep the frames converted with different converters apart,
+    the source of the converter is typically used for this.
+    """
+    def __init__(self, cache_dir=None, namespace='',
+                 max_size=DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        super(DiskFrameCache, self).__init__(
+            os.path.join(cache_dir, 'frames'), max_size, suffix='.pkl',
+            binary=True
+        )
+        self.namespace = namespace
+
+    def get(self, key):
+        data = super(DiskFrameCache, self).get(make_key(self.namespace, key))
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def put(self, key, cells):
+        data = pickle.dumps(cells, pickle.HIGHEST_PROTOCOL)
+        super(DiskFrameCache, self).put(make_key(self.namespace, key), data)
+
+
+def _token_code(kind, name):
+    from TexSoup import utils
+    return getattr(utils, kind)[name]
+
+
+def _tex_args(args, all_args):
+    from TexSoup.data import TexArgs
+    result = TexArgs()
+    list.extend(result, args)
+    result.all = all_args
+    return result
+
+
+def dump_tree(tree):
+    """Pickle a TexSoup tree and return the bytes, `pickle.loads` reads it.
+
+    The token codes and argument lists in the tree cannot be pickled as they
+    are, so they are reduced to simpler objects.
+    """
+    from TexSoup.data import TexArgs
+    from TexSoup.utils import CC, TC, Token
+    fp = io.BytesIO()
+    pickler = pickle.Pickler(fp, pickle.HIGHEST_PROTOCOL)
+    table = copyreg.dispatch_table.copy()
+    table[CC] = lambda x: (_token_code, ('CC', x.name))
+    table[TC] = lambda x: (_token_code, ('TC', x.name))
+    table[Token] = lambda x: (Token, (x.text, x.position, x.category))
+    table[TexArgs] = lambda x: (_tex_args, (list(x), x.all))
+    pickler.dispatch_table = table
+    pickler.dump(tree)
+    return fp.getvalue()
+
+
+class DiskTreeCache(DiskCache):
+    """Cache the TexSoup trees of parsed TeX code on disk.
+
+    This may be passed as the `tree_cache` to `Tex2Cells` so that code which
+    has not changed is not parsed again, even when the converter has.  The
+    trees are keyed on a hash of the code and the TexSoup version.
+    """
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        super(DiskTreeCache, self).__init__(
+            os.path.join(cache_dir, 'trees'), max_size, suffix='.pkl',
+            binary=True
+        )
+        self._texsoup_version = None
+
+    def _key(self, code):
+        if self._texsoup_version is None:
+            import TexSoup
+            self._texsoup_version = TexSoup.__version__
+        return make_key(self._texsoup_version, code)
+
+    def get(self, code):
+        """Return the tree for the code or None if it is not cached.
+        """
+        data = super(DiskTreeCache, self).get(self._key(code))
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def put(self, code, tree):
+        """Store the tree for the code, trees that cannot be pickled (for
+        example very deeply nested ones) are not stored.
+        """
+        try:
+            data = dump_tree(tree)
+        except (pickle.PicklingError, RecursionError):
+            return
+        super(DiskTreeCache, self).put(self._key(code), data)
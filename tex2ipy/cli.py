@@ -1,10 +1,27 @@
 import argparse
+import hashlib
+from functools import partial
+from io import StringIO
+import json
+import logging
+import os
+import sys
+import textwrap
 
-import nbformat
-from nbformat.v4 import new_notebook
-from nbformat.v4.nbjson import from_dict
+from .cache import ConversionCache, DEFAULT_MAX_SIZE
+from .profiling import Profile, maybe_stage
 
-from .tex2cells import Tex2Cells
+# nbformat and the converter (which imports TexSoup) are only imported when
+# needed so that the command starts quickly.
+
+
+logger = logging.getLogger(__name__)
+
+
+# The JSON formatting used by nbformat when writing notebooks.
+JSON_FORMAT = dict(
+    indent=1, sort_keys=True, separators=(',', ': '), ensure_ascii=False
+)
 
 
 def get_tex2cells_subclass(fp, fname):
@@ -16,6 +33,7 @@ def get_tex2cells_subclass(fp, fname):
     fp: :file: Input file object.
     fname: :str: Filename of file.
     """
+    from .tex2cells import Tex2Cells
     ns = {}
     exec(compile(fp.read(), fname, 'exec'), ns)
     converter = None
@@ -27,9 +45,7 @@ def get_tex2cells_subclass(fp, fname):
     return converter
 
 
-def tex2ipy(code, cls=Tex2Cells):
-    t2c = cls(code)
-    cells = t2c.parse()
+def _notebook_metadata():
     livereveal = dict(
         transition='none',
         scroll=True,
@@ -42,37 +58,513 @@ def tex2ipy(code, cls=Tex2Cells):
         celltoolbar='Slideshow',
         livereveal=livereveal
     )
-    nb = new_notebook(
-        metadata=from_dict(md),
-        cells=from_dict(cells)
+    return md
+
+
+NOTEBOOK_METADATA = _notebook_metadata()
+
+
+def _new_notebook(cells):
+    """Return a new notebook with the given cells and the slideshow metadata.
+
+    This is the same as `nbformat.v4.new_notebook` but does not validate the
+    notebook, which is slow and not needed here.
+    """
+    from nbformat import v4
+    from nbformat.notebooknode import NotebookNode, from_dict
+    return NotebookNode(
+        nbformat=v4.nbformat, nbformat_minor=v4.nbformat_minor,
+        metadata=from_dict(NOTEBOOK_METADATA), cells=cells
     )
-    return nb
+
+
+def _cell_id(cell, seen):
+    """Return a cell id based on the contents of the cell which is unique
+    among the ids in `seen`.  This keeps the ids stable across conversions.
+    """
+    data = cell['cell_type'] + '\0' + ''.join(cell['source'])
+    base = hashlib.sha1(data.encode('utf-8')).hexdigest()[:8]
+    cell_id = base
+    count = 1
+    while cell_id in seen:
+        cell_id = '%s-%d' % (base, count)
+        count += 1
+    seen.add(cell_id)
+    return cell_id
+
+
+def tex2ipy(code, cls=None, **kw):
+    """Convert the TeX code to a notebook using the given converter class,
+    `Tex2Cells` by default.
+
+    Any keyword arguments are passed on to the converter, for example a
+    `frame_cache`, an `image_resolver`, a `profile` or `diagnostics`.  If a
+    `profile` is given, the time taken by each stage is also recorded in it.
+    """
+    return _convert(code, cls, **kw)[0]
+
+
+def _convert(code, cls=None, **kw):
+    """Same as `tex2ipy` but returns the notebook and the converter.
+    """
+    from .tex2cells import Tex2Cells, to_node
+    if cls is None:
+        cls = Tex2Cells
+    profile = kw.get('profile')
+    with maybe_stage(profile, 'preprocess'):
+        t2c = cls(code, **kw)
+    if t2c.frame_cache is None:
+        with maybe_stage(profile, 'texsoup'):
+            t2c.soups
+    with maybe_stage(profile, 'walk'):
+        cells = t2c.parse_cells()
+    with maybe_stage(profile, 'from_dict'):
+        cells = [to_node(cell) for cell in cells]
+        seen = set()
+        for cell in cells:
+            if 'id' not in cell:
+                cell['id'] = _cell_id(cell, seen)
+        nb = _new_notebook(cells)
+    return nb, t2c
+
+
+def tex2ipy_stream(code, fp, cls=None, **kw):
+    """Convert the TeX code and write the notebook to the file object `fp`
+    as the cells are generated.
+
+    This uses `Tex2Cells.iter_cells` so the whole document is never held in
+    memory.  The output is the same as writing the notebook returned by
+    `tex2ipy` with `nbformat.write`.
+    """
+    from nbformat.notebooknode import NotebookNode
+    from nbformat.v4.rwbase import split_lines, strip_transient
+    from .tex2cells import Tex2Cells, to_node
+    if cls is None:
+        cls = Tex2Cells
+    t2c = cls(code, **kw)
+    fmt = JSON_FORMAT
+    nb = _new_notebook([])
+    head, tail = json.dumps(nb, **fmt).split('"cells": []', 1)
+    fp.write(head + '"cells": [')
+    sep = '\n'
+    seen = set()
+    for cell in t2c.iter_cells():
+        cell = to_node(cell)
+        if 'id' not in cell:
+            cell['id'] = _cell_id(cell, seen)
+        strip_transient(split_lines(NotebookNode(
+            metadata=NotebookNode(), cells=[cell]
+        )))
+        fp.write(sep + textwrap.indent(json.dumps(cell, **fmt), '  '))
+        sep = ',\n'
+    fp.write(']' if sep == '\n' else '\n ]')
+    fp.write(tail + '\n')
+
+
+def write_notebook(nb, fp, validate=False):
+    """Write the notebook to the file object `fp`.
+
+    The output is the same as that of `nbformat.write` but the notebook is
+    neither copied nor validated, which is not needed for the notebooks
+    generated here and is much faster.  Note that the notebook is modified
+    in place, text is split into lines as nbformat does.  If `validate` is
+    True, the notebook is validated first and a
+    `nbformat.ValidationError` is raised if it is invalid.
+    """
+    from nbformat.v4.rwbase import split_lines, strip_transient
+    if validate:
+        import nbformat
+        nbformat.validate(nb)
+    strip_transient(split_lines(nb))
+    json.dump(nb, fp, **JSON_FORMAT)
+    fp.write('\n')
+
+
+def notebook_text(nb, validate=False):
+    """Return the text of the notebook as written by `write_notebook`.
+    """
+    fp = StringIO()
+    write_notebook(nb, fp, validate)
+    return fp.getvalue()
+
+
+def load_converter(converter_path):
+    """Return the Tex2Cells subclass defined in the given file along with
+    the source of the file.  If no path is given or the file defines no
+    subclass, Tex2Cells is returned.
+    """
+    converter, source = None, ''
+    if converter_path:
+        with open(converter_path) as fp:
+            source = fp.read()
+        converter = get_tex2cells_subclass(StringIO(source), converter_path)
+    if converter is None:
+        from .tex2cells import Tex2Cells
+        converter = Tex2Cells
+    return converter, source
+
+
+def _images_unchanged(images, kw):
+    """Return True if the images found in an earlier conversion are still
+    the same files, using the `image_resolver` in `kw` or a new one which
+    is then added to `kw`.
+    """
+    if not images:
+        return True
+    resolver = kw.get('image_resolver')
+    if resolver is None:
+        from .tex2cells import ImageResolver
+        resolver = kw['image_resolver'] = ImageResolver()
+    return resolver.is_unchanged(images)
+
+
+def tex2ipy_text(code, cls=None, cache=None, converter_source='',
+                 validate=False, images=None, lines=None, **kw):
+    """Return the notebook text for the given TeX code.
+
+    If a `cache` (a `ConversionCache`) is given, the text is looked up there
+    first and stored in it after conversion.  The cells of the frames that
+    have not changed and the parse trees of unchanged code are also reused
+    from the cache.  Cached notebooks and frames are only used if the image
+    files they refer to are the same, the unknown macros found are cached
+    with them and added to the `diagnostics` given as if the code had been
+    converted.  The notebook is only validated if `validate` is True.  If
+    `images` is a dictionary, the images found are added to it (see
+    `Tex2Cells.images`).  If `lines` is a list, the line in the TeX code of
+    each cell is added to it (see `Cell.line`), these are cached too.  Any
+    keyword arguments are passed on to the converter.
+    """
+    diagnostics = kw.get('diagnostics')
+    if cache is not None:
+        macros = kw.get('macros')
+        extra = () if macros is None else (macros.key,)
+        key = cache.key(code, converter_source, *extra)
+        entry = cache.get(key)
+        if entry is not None and _images_unchanged(entry['images'], kw) \
+                and (lines is None or 'lines' in entry):
+            if images is not None:
+                images.update(entry['images'])
+            if lines is not None:
+                lines.extend(entry['lines'])
+            if diagnostics is not None:
+                diagnostics.update(entry['diagnostics'])
+            return entry['text']
+        kw['frame_cache'] = cache.frame_cache(converter_source)
+        kw.setdefault('tree_cache', cache.tree_cache())
+        # Collect the diagnostics of this code alone to cache them.
+        from .tex2cells import Diagnostics
+        kw['diagnostics'] = Diagnostics()
+    nb, t2c = _convert(code, cls, **kw)
+    with maybe_stage(kw.get('profile'), 'write'):
+        text = notebook_text(nb, validate)
+    if images is not None:
+        images.update(t2c.images)
+    cell_lines = [cell.line for cell in t2c.cells]
+    if lines is not None:
+        lines.extend(cell_lines)
+    if cache is not None:
+        cache.put(key, text, t2c.images, t2c.diagnostics, cell_lines)
+        if diagnostics is not None:
+            diagnostics.update(t2c.diagnostics)
+    return text
+
+
+def _source_hash(cell):
+    source = cell.get('source', '')
+    if not isinstance(source, str):
+        source = ''.join(source)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def merge_outputs(text, old_text):
+    """Return the notebook text with the outputs of the notebook `old_text`
+    (typically an earlier conversion which has been run) carried over.
+
+    Each code cell takes the `outputs` and `execution_count` of an old code
+    cell with the same source, the nearest one by position if there are
+    several.  Notebook metadata only in the old notebook (the kernel for
+    example) is kept too.  The sources are split into lines as Jupyter
+    saves them, so merging into an unchanged notebook gives the same text.
+    The text is returned unchanged if `old_text` is None or not a notebook.
+    """
+    if not old_text:
+        return text
+    try:
+        old = json.loads(old_text)
+        old_cells = [x for x in old['cells'] if x.get('cell_type') == 'code']
+        old_metadata = old.get('metadata', {})
+    except (ValueError, KeyError, TypeError, AttributeError):
+        logger.warning("Not merging outputs, the output is not a notebook.")
+        return text
+
+    executed = {}
+    for i, cell in enumerate(old_cells):
+        if cell.get('outputs') or cell.get('execution_count') is not None:
+            executed.setdefault(_source_hash(cell), []).append(i)
+    nb = json.loads(text)
+    metadata = nb['metadata']
+    for key, value in old_metadata.items():
+        metadata.setdefault(key, value)
+    j = 0
+    for cell in nb['cells']:
+        cell['source'] = ''.join(cell['source']).splitlines(True)
+        if cell['cell_type'] != 'code':
+            continue
+        candidates = executed.get(_source_hash(cell))
+        if candidates:
+            i = min(candidates, key=lambda i: abs(i - j))
+            candidates.remove(i)
+            cell['outputs'] = old_cells[i].get('outputs', [])
+            cell['execution_count'] = old_cells[i].get('execution_count')
+        j += 1
+    return json.dumps(nb, **JSON_FORMAT) + '\n'
+
+
+def source_location(source_map, fname, line):
+    """Return the location of the given line of the document `fname` with
+    its included files inlined, as recorded in `source_map` (see
+    `tex2ipy.includes.SourceMap`).  This is the line number for lines of
+    `fname` itself and `file:line` for those of an included file.
+    """
+    path, line = source_map.lookup(line)
+    if path is None or path == os.path.abspath(fname):
+        return line
+    return '%s:%d' % (os.path.relpath(path), line)
+
+
+def read_text(fname):
+    """Return the contents of the file or None if it cannot be read.
+    """
+    try:
+        with open(fname, encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def write_if_changed(fname, text):
+    """Write the text to the file unless it already has the same content.
+    Returns True if the file was written.
+    """
+    if read_text(fname) == text:
+        return False
+    with open(fname, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return True
 
 
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == 'serve':
+        from .server import main as serve
+        return serve(args[1:])
+
     parser = argparse.ArgumentParser(
-        "Convert LaTeX beamer slides to IPython notebooks + RISE"
+        "Convert LaTeX beamer slides to IPython notebooks + RISE",
+        epilog="Use 'tex2ipy serve --help' for the options to run a "
+        "conversion server."
+    )
+    parser.add_argument(
+        "input", nargs='?',
+        help="Input file (.tex) or source directory with --batch."
+    )
+    parser.add_argument(
+        "output", nargs='?',
+        help="Output file (.ipynb) or output directory with --batch."
     )
-    parser.add_argument("input", nargs=1, help="Input file (.tex)")
-    parser.add_argument("output", nargs=1, help="Output file (.ipynb)")
     parser.add_argument(
         "-c", "--converter", action="store", dest="converter", default='',
         help="Path to a Python file which defines a subclass of Tex2Cells."
     )
+    parser.add_argument(
+        "--preamble", action="append", dest="preamble", default=[],
+        help="File with macro definitions (\\newcommand etc.) to expand in "
+        "the input, may be given more than once."
+    )
+    parser.add_argument(
+        "--engine", action="store", dest="engine", default='texsoup',
+        choices=['texsoup', 'fast'],
+        help="Parser to use, 'fast' falls back to TexSoup for the frames "
+        "it does not support (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--batch", action="store_true", default=False,
+        help="Convert all .tex files in the input directory tree and "
+        "write the notebooks to the output directory."
+    )
+    parser.add_argument(
+        "-j", "--jobs", action="store", type=int, default=None,
+        help="Number of worker processes to use with --batch or to write "
+        "the parts of a split notebook (defaults to the number of CPUs)."
+    )
+    parser.add_argument(
+        "--merge", action="store_true", default=False,
+        help="Keep the outputs of the code cells of an existing output "
+        "notebook whose source has not changed."
+    )
+    parser.add_argument(
+        "--split", action="store_true", default=False,
+        help="Write each section to a separate notebook with an index "
+        "notebook linking to them in the output file."
+    )
+    parser.add_argument(
+        "--max-cells", action="store", type=int, dest="max_cells",
+        default=None,
+        help="Split the output into notebooks with about this many cells, "
+        "implies a split output."
+    )
+    parser.add_argument(
+        "--max-bytes", action="store", type=int, dest="max_bytes",
+        default=None,
+        help="Split the output into notebooks with about this many bytes "
+        "of cell source, implies a split output."
+    )
+    parser.add_argument(
+        "--no-cache", action="store_false", dest="cache", default=True,
+        help="Do not use the conversion cache."
+    )
+    parser.add_argument(
+        "--cache-dir", action="store", dest="cache_dir", default=None,
+        help="Directory for the conversion cache "
+        "(defaults to ~/.cache/tex2ipy)."
+    )
+    parser.add_argument(
+        "--cache-size", action="store", type=int, dest="cache_size",
+        default=DEFAULT_MAX_SIZE//(1024*1024),
+        help="Maximum size of the conversion cache in MB (default: "
+        "%(default)s)."
+    )
+    parser.add_argument(
+        "--validate", action="store_true", default=False,
+        help="Validate the generated notebooks against the notebook schema."
+    )
+    parser.add_argument(
+        "--check-code", action="store_true", dest="check_code",
+        default=False,
+        help="Check that the code cells are valid Python and report the "
+        "ones which are not with their line in the input."
+    )
+    parser.add_argument(
+        "--magics", action="store_true", default=False,
+        help="Accept IPython magics, ! shell commands and ? help when "
+        "checking the code cells."
+    )
+    parser.add_argument(
+        "--profile", action="store_true", default=False,
+        help="Print the time spent in each stage and handler, this implies "
+        "--no-cache."
+    )
+    parser.add_argument(
+        "--profile-json", action="store", dest="profile_json", default=None,
+        help="Save the profile as JSON to the given file, this implies "
+        "--no-cache."
+    )
+    parser.add_argument(
+        "--log-level", action="store", dest="log_level", default='WARNING',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help="Level of the log messages to show, each unknown macro is "
+        "logged at DEBUG level (default: %(default)s)."
+    )
     args = parser.parse_args(args)
-    converter = None
-    if len(args.converter) > 0:
-        with open(args.converter) as fp:
-            converter = get_tex2cells_subclass(fp, args.converter)
-    if converter is None:
-        converter = Tex2Cells
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    if args.input is None or args.output is None:
+        parser.error("both input and output must be given")
+
+    profile = None
+    if args.profile or args.profile_json:
+        if args.batch:
+            parser.error("--profile cannot be used with --batch")
+        profile = Profile()
+        args.cache = False
+    split = args.split or args.max_cells or args.max_bytes
+    if split and args.batch:
+        parser.error("the output cannot be split with --batch")
+    if split and args.merge:
+        parser.error("--merge cannot be used with a split output")
+    if args.check_code and args.batch:
+        parser.error("--check-code cannot be used with --batch")
+
+    cache = None
+    if args.cache:
+        cache = ConversionCache(args.cache_dir, args.cache_size*1024*1024)
+    macros = None
+    if args.preamble:
+        from .macros import load_preamble
+        macros = load_preamble(*args.preamble)
+
+    if args.batch:
+        from .batch import batch_convert, print_summary
+        result = batch_convert(
+            args.input, args.output, args.converter, args.jobs, cache,
+            args.validate, macros, args.engine, args.merge
+        )
+        print_summary(result)
+        ret = 1 if result['failures'] else 0
+    else:
+        from .includes import IncludeResolver, SourceMap
+        converter, source = load_converter(args.converter)
+        source_map = SourceMap()
+        code = IncludeResolver().expand_file(args.input, source_map)
+        from .tex2cells import Diagnostics
+        diagnostics = Diagnostics()
+        kw = dict(
+            diagnostics=diagnostics, macros=macros, engine=args.engine
+        )
+        if profile is not None:
+            kw['profile'] = profile
+        # The cells converted are kept to check their code.
+        cells = [] if args.check_code else None
+        lines = None
+        if split:
+            from .split import write_split
+            if cache is not None:
+                kw['frame_cache'] = cache.frame_cache(source)
+                kw['tree_cache'] = cache.tree_cache()
+            with maybe_stage(profile, 'split'):
+                paths = write_split(
+                    code, args.output, converter, args.split,
+                    args.max_cells, args.max_bytes, args.jobs,
+                    args.validate, cells=cells, **kw
+                )
+            print("Wrote %d parts and the index %s" % (
+                len(paths) - 1, args.output
+            ))
+        else:
+            if cells is not None:
+                lines = []
+            text = tex2ipy_text(
+                code, converter, cache, source, args.validate, lines=lines,
+                **kw
+            )
+            if cells is not None:
+                cells = json.loads(text)['cells']
+            if args.merge:
+                text = merge_outputs(text, read_text(args.output))
+            with maybe_stage(profile, 'save'):
+                write_if_changed(args.output, text)
+        location = partial(source_location, source_map, args.input)
+        diagnostics.map_lines(location).report(
+            title='Unknown macros in %s' % args.input
+        )
+        ret = None
+        if args.check_code:
+            from .codecheck import check_cells, report
+            with maybe_stage(profile, 'check'):
+                errors = check_cells(cells, args.magics, args.jobs, lines)
+            report(errors, args.input, location=location)
+            if errors:
+                ret = 1
+        if args.profile:
+            profile.report()
+        if args.profile_json:
+            with open(args.profile_json, 'w') as fp:
+                profile.dump_json(fp)
 
-    with open(args.input[0]) as f:
-        code = f.read()
-    nb = tex2ipy(code, converter)
-    with open(args.output[0], 'w') as f:
-        nbformat.write(nb, f)
+    if cache is not None:
+        cache.maybe_prune()
+    return ret
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""Check that the code cells of a converted document are valid Python.
+
+Each code cell is compiled with `compile`, which checks the syntax without
+running anything.  The cells are independent so many of them are compiled
+in a pool of processes, identical cells are only compiled once.
+"""
+import ast
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+
+
+# Below this many distinct cells they are compiled in the current process,
+# starting the worker processes would take longer.
+MIN_PARALLEL = 500
+
+# Cell magics whose body is Python code.
+PYTHON_CELL_MAGICS = ('capture', 'prun', 'time', 'timeit')
+
+# IPython magics (`%time f()`), shell commands (`!ls`), assigning their
+# results (`files = !ls`) and help (`len?`, `?len`).
+_MAGIC = re.compile(
+    r'^([ \t]*)(?:[%!]|[\w., \t]+=[ \t]*[%!]|[\w.]+\?\??[ \t]*$'
+    r'|\?\??[\w.]+[ \t]*$)'
+)
+_CELL_MAGIC = re.compile(r'\s*%%(\w+)')
+
+
+def _replace_magics(source):
+    """Return the source with the IPython syntax replaced by `pass`
+    statements, keeping the indentation and the line numbers.  Returns None
+    if the cell is not Python, for example a `%%bash` cell.
+    """
+    match = _CELL_MAGIC.match(source)
+    if match is not None:
+        if match.group(1) not in PYTHON_CELL_MAGICS:
+            return None
+        end = source.find('\n', match.end())
+        if end < 0:
+            return ''
+        source = '\n'*source.count('\n', 0, end + 1) + source[end + 1:]
+    if '%' not in source and '!' not in source and '?' not in source:
+        return source
+    lines = source.split('\n')
+    for i, line in enumerate(lines):
+        match = _MAGIC.match(line)
+        if match is not None:
+            lines[i] = match.group(1) + 'pass'
+    return '\n'.join(lines)
+
+
+def check_source(source, magics=False):
+    """Compile the source of a cell and return None if it is valid or a
+    tuple of the line (in the cell, starting at 1) and the error message.
+
+    If `magics` is True, IPython magics, `!` shell commands and `?` help
+    are accepted.  Top level `await` is always accepted, as in IPython.
+    """
+    if magics:
+        source = _replace_magics(source)
+        if source is None:
+            return None
+    try:
+        compile(source, '<cell>', 'exec', ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
+                dont_inherit=True)
+    except SyntaxError as e:
+        message = e.msg
+        text = (e.text or '').strip()
+        if text:
+            message = '%s: %s' % (message, text)
+        return e.lineno or 1, message
+    except ValueError as e:
+        return 1, str(e)
+    return None
+
+
+def _get_source(cell):
+    source = cell['source']
+    if isinstance(source, str):
+        return source
+    return ''.join(source)
+
+
+def check_cells(cells, magics=False, jobs=None, lines=None):
+    """Check the syntax of the code cells in the list of cells.
+
+    The cells are compiled using `jobs` processes (by default the number of
+    CPUs) if there are at least `MIN_PARALLEL` distinct ones.  `magics` is
+    passed on to `check_source`.
+
+    Returns a list of (cell index, line, message) tuples for the cells with
+    errors.  The line is that of the error in the TeX code if the cell
+    records where it came from (see `Cell.line` and
+    `Tex2Cells.parse_cells`) or `lines` gives the line of each cell, and
+    None otherwise.
+    """
+    sources = {}
+    for index, cell in enumerate(cells):
+        if cell['cell_type'] == 'code':
+            sources.setdefault(_get_source(cell), []).append(index)
+    unique = list(sources)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs > 1 and len(unique) >= MIN_PARALLEL:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(
+                check_source, unique, [magics]*len(unique),
+                chunksize=max(1, len(unique)//(4*jobs))
+            ))
+    else:
+        results = [check_source(x, magics) for x in unique]
+
+    errors = []
+    for source, result in zip(unique, results):
+        if result is None:
+            continue
+        lineno, message = result
+        for index in sources[source]:
+            if lines is None:
+                line = getattr(cells[index], 'line', None)
+            else:
+                line = lines[index]
+            if line is not None:
+                line += lineno - 1
+            errors.append((index, line, message))
+    errors.sort(key=lambda x: x[0])
+    return errors
+
+
+def report(errors, fname, stream=None, location=None):
+    """Print the errors found by `check_cells` in the file `fname`.
+
+    `location` is an optional function returning the location of a line,
+    either a line of `fname` or a string such as `file:line` for the lines
+    of included files (see `tex2ipy.cli.source_location`).
+    """
+    if not errors:
+        return
+    print("Invalid code cells in %s: %d" % (fname, len(errors)), file=stream)
+    for index, line, message in errors:
+        if line is not None and location is not None:
+            line = location(line)
+        if line is None:
+            where = fname
+        elif isinstance(line, int):
+            where = '%s:%d' % (fname, line)
+        else:
+            where = line
+        print("  %s: cell %d: %s" % (where, index + 1, message), file=stream)
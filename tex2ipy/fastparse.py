@@ -0,0 +1,383 @@
+r"""A fast parser for the subset of LaTeX used in beamer slides.
+
+`parse` builds the same tree as `TexSoup.TexSoup`, made of the same TexSoup
+node classes, so the handlers of `Tex2Cells` work unchanged.  TexSoup reads
+its input one character at a time, here the input is split into tokens with
+regular expressions and the tree is built from a list of plain tuples,
+which is many times faster.
+
+The parser follows TexSoup's reader closely but only for the constructs
+tex2ipy deals with.  When it meets anything else, for example a `tabular`,
+`\verb`, `\newcommand` or malformed input, it raises `Unsupported` and the
+caller should parse the code with TexSoup instead.
+"""
+import re
+import string
+
+from TexSoup.data import (
+    BraceGroup, BracketGroup, TexArgs, TexCmd, TexDisplayMathEnv,
+    TexDisplayMathModeEnv, TexEnv, TexMathEnv, TexMathModeEnv, TexNamedEnv,
+    TexNode, TexText
+)
+from TexSoup.reader import (
+    ARG_OPTIONAL, ARG_REQUIRED, MODE_MATH, MODE_NON_MATH, MODE_SPECIAL,
+    RAW_ARG_ENVS, SIGNATURE_MODES, SIGNATURES, VERBATIM_COMMANDS
+)
+from TexSoup.tokens import (
+    MATH_ENV_NAMES, PUNCTUATION_COMMANDS, SKIP_ENV_NAMES
+)
+
+
+class Unsupported(Exception):
+    """Raised when the code uses something the fast parser does not handle.
+    """
+
+
+# The kinds of tokens.
+(ESC, NAME, PUNCT, TEXT, SPACE, ESCAPED, COMMENT, GROUP_BEGIN, GROUP_END,
+ BRACKET_BEGIN, BRACKET_END, MATH, DISPLAY_MATH, DISPLAY_MATH_BEGIN,
+ DISPLAY_MATH_END, MATH_BEGIN, MATH_END) = range(17)
+
+_LETTERS = frozenset(string.ascii_letters)
+# Characters which are neither letters nor "other" characters for TexSoup,
+# whitespace followed by one of these is a separate token.
+_SPECIAL = frozenset('{}\\$&\n\r#^_~%\x00 \t[]()\x7f')
+_SYMBOLS = {'{': GROUP_BEGIN, '}': GROUP_END, '[': BRACKET_BEGIN,
+            ']': BRACKET_END}
+_MATH_GROUPS = {'[': DISPLAY_MATH_BEGIN, ']': DISPLAY_MATH_END,
+                '(': MATH_BEGIN, ')': MATH_END}
+
+_SPACER = re.compile(r'[ \t]*[\n\r]?[ \t]*')
+_STRING = re.compile(r'[^\\{}$\[\]%]+')
+_COMMENT = re.compile(r'%[^\n\r]*')
+_NAME = re.compile(r'[a-zA-Z][a-zA-Z*]*')
+_PUNCT = re.compile('|'.join(
+    re.escape(x) for x in sorted(PUNCTUATION_COMMANDS, key=len, reverse=True)
+))
+
+_MATH_ENVS = {
+    MATH: (TexMathModeEnv, MATH),
+    DISPLAY_MATH: (TexDisplayMathModeEnv, DISPLAY_MATH),
+    DISPLAY_MATH_BEGIN: (TexDisplayMathEnv, DISPLAY_MATH_END),
+    MATH_BEGIN: (TexMathEnv, MATH_END),
+}
+
+
+def tokenize(code):
+    """Return the list of (kind, text, offset) tokens of the code, split in
+    the same way as TexSoup's tokenizer.
+    """
+    if '\x00' in code or '\x7f' in code or 'makeatletter' in code:
+        raise Unsupported('ignored characters or \\makeatletter')
+    tokens = []
+    append = tokens.append
+    pos = 0
+    n = len(code)
+    while pos < n:
+        c = code[pos]
+        if c in _LETTERS and pos and code[pos - 1] == '\\':
+            match = _PUNCT.match(code, pos)
+            if match is not None:
+                text = match.group()
+                if text.endswith('.|'):
+                    raise Unsupported('ambiguous delimiter %s' % text)
+                append((PUNCT, text, pos))
+            else:
+                match = _NAME.match(code, pos)
+                append((NAME, match.group(), pos))
+            pos = match.end()
+        elif c == '\\':
+            nxt = code[pos + 1:pos + 2]
+            if not nxt or nxt in _LETTERS:
+                append((ESC, c, pos))
+                pos += 1
+            else:
+                kind = _MATH_GROUPS.get(nxt, ESCAPED)
+                append((kind, code[pos:pos + 2], pos))
+                pos += 2
+        elif c == '%':
+            match = _COMMENT.match(code, pos)
+            append((COMMENT, match.group(), pos))
+            pos = match.end()
+        elif c == '$':
+            if code.startswith('$$', pos):
+                append((DISPLAY_MATH, '$$', pos))
+                pos += 2
+            else:
+                append((MATH, c, pos))
+                pos += 1
+        elif c in _SYMBOLS:
+            append((_SYMBOLS[c], c, pos))
+            pos += 1
+        else:
+            if c in ' \t\n\r':
+                end = _SPACER.match(code, pos).end()
+                if end == n or code[end] in _SPECIAL:
+                    append((SPACE, code[pos:end], pos))
+                    pos = end
+                    continue
+            match = _STRING.match(code, pos)
+            append((TEXT, match.group(), pos))
+            pos = match.end()
+    return tokens
+
+
+class _Reader(object):
+    """Build the TexSoup expressions from the tokens.
+
+    The methods mirror the functions of `TexSoup.reader`.
+    """
+    def __init__(self, code, tokens):
+        self.code = code
+        self.tokens = tokens
+        self.n = len(tokens)
+        self.i = 0
+
+    def _next(self):
+        if self.i >= self.n:
+            raise Unsupported('unexpected end of input')
+        token = self.tokens[self.i]
+        self.i += 1
+        return token
+
+    def _peek_kind(self, offset=0):
+        i = self.i + offset
+        return self.tokens[i][0] if i < self.n else None
+
+    def read_tex(self):
+        skip_envs = SKIP_ENV_NAMES
+        while self.i < self.n:
+            yield self.read_expr(skip_envs)
+
+    def read_expr(self, skip_envs=(), mode=MODE_NON_MATH):
+        kind, text, pos = self._next()
+        if kind in _MATH_ENVS:
+            cls, end = _MATH_ENVS[kind]
+            return self.read_math_env(cls([], position=pos), end)
+        elif kind == ESC:
+            name, args = self.read_command(mode=mode)
+            if name in VERBATIM_COMMANDS:
+                raise Unsupported('\\%s' % name)
+            elif name == 'item':
+                if mode == MODE_MATH:
+                    raise Unsupported('\\item in math mode')
+                return TexCmd(name, self.read_item(), args, position=pos)
+            elif name == 'begin' and mode != MODE_SPECIAL:
+                if not args or not isinstance(args[0], BraceGroup):
+                    raise Unsupported('\\begin without an environment')
+                expr = TexNamedEnv(args[0].string, args=args[1:],
+                                   position=pos)
+                if expr.name in MATH_ENV_NAMES:
+                    mode = MODE_MATH
+                if expr.name in skip_envs:
+                    self.read_skip_env(expr)
+                else:
+                    self.read_env(expr, skip_envs, mode)
+                return expr
+            return TexCmd(name, args=args, position=pos)
+        elif kind == GROUP_BEGIN:
+            return self.read_arg(kind, pos)
+        return TexText(text, position=pos)
+
+    def read_item(self):
+        extras = []
+        tokens = self.tokens
+        while self.i < self.n:
+            kind = tokens[self.i][0]
+            if kind == ESC:
+                if self._peek_kind(1) not in (NAME, PUNCT):
+                    raise Unsupported('\\ without a command name')
+                if tokens[self.i + 1][1] in ('end', 'item'):
+                    return extras
+            elif kind == GROUP_END:
+                break
+            extras.append(self.read_expr())
+        return extras
+
+    def read_math_env(self, expr, end):
+        contents = []
+        tokens = self.tokens
+        while self.i < self.n:
+            kind, text, pos = tokens[self.i]
+            if end == MATH and kind == DISPLAY_MATH:
+                tokens[self.i:self.i + 1] = [(MATH, '$', pos),
+                                             (MATH, '$', pos + 1)]
+                self.n += 1
+                kind = MATH
+            if kind == end:
+                break
+            contents.append(self.read_expr(mode=MODE_MATH))
+        if self.i >= self.n:
+            raise Unsupported('unclosed %s' % expr.name)
+        self.i += 1
+        expr.append(*contents)
+        return expr
+
+    def read_skip_env(self, expr):
+        end = '\\end{%s}' % expr.name
+        tokens = self.tokens
+        code = self.code
+        if self.i >= self.n:
+            raise Unsupported('unclosed %s' % expr.name)
+        i = self.i
+        while i < self.n and not code.startswith(end, tokens[i][2]):
+            i += 1
+        if i >= self.n:
+            raise Unsupported('unclosed %s' % expr.name)
+        expr.append(code[tokens[self.i][2]:tokens[i][2]])
+        self.i = i + 5
+        return expr
+
+    def read_env(self, expr, skip_envs=(), mode=MODE_NON_MATH):
+        contents = []
+        tokens = self.tokens
+        args = None
+        while self.i < self.n:
+            if tokens[self.i][0] == ESC:
+                if self._peek_kind(1) not in (NAME, PUNCT):
+                    raise Unsupported('\\ without a command name')
+                if tokens[self.i + 1][1] == 'end':
+                    start = self.i
+                    self.i += 2
+                    args = self.read_args(mode=mode)
+                    self.i = start
+                    break
+            contents.append(self.read_expr(skip_envs, mode))
+        if self.i >= self.n or not args or args[0].string != expr.name:
+            raise Unsupported('unclosed %s' % expr.name)
+        self.i += 5
+        expr.append(*contents)
+        return expr
+
+    def read_args(self, arg_spec=None, args=None, mode=MODE_NON_MATH):
+        args = args or TexArgs()
+        if arg_spec is None:
+            n_optional = 0 if mode == MODE_MATH else -1
+            arg_spec = (
+                (ARG_OPTIONAL, n_optional),
+                (ARG_REQUIRED, -1),
+                (ARG_OPTIONAL, n_optional),
+                (ARG_REQUIRED, -1),
+            )
+        for arg_kind, count in arg_spec:
+            if arg_kind == ARG_OPTIONAL:
+                self.read_arg_optional(args, count, mode)
+            else:
+                self.read_arg_required(args, count, mode)
+        return args
+
+    def read_spacer(self):
+        if self.i < self.n and self.tokens[self.i][0] == SPACE:
+            self.i += 1
+            return self.tokens[self.i - 1][1]
+        return ''
+
+    def read_arg_optional(self, args, n_optional=-1, mode=MODE_NON_MATH):
+        while n_optional != 0:
+            spacer = self.read_spacer()
+            if self._peek_kind() != BRACKET_BEGIN:
+                if spacer:
+                    self.i -= 1
+                break
+            kind, text, pos = self._next()
+            args.append(self.read_arg(kind, pos, mode))
+            n_optional -= 1
+        return n_optional
+
+    def read_arg_required(self, args, n_required=-1, mode=MODE_NON_MATH):
+        while n_required != 0 and self.i < self.n:
+            spacer = self.read_spacer()
+            kind = self._peek_kind()
+            if kind == GROUP_BEGIN:
+                kind, text, pos = self._next()
+                args.append(self.read_arg(kind, pos, mode))
+                n_required -= 1
+                continue
+            elif kind is not None and n_required > 0:
+                raise Unsupported('argument without braces')
+            if spacer:
+                self.i -= 1
+            break
+        return n_required
+
+    def read_arg(self, kind, pos, mode=MODE_NON_MATH):
+        if kind == GROUP_BEGIN:
+            cls, end = BraceGroup, GROUP_END
+        else:
+            cls, end = BracketGroup, BRACKET_END
+        content = []
+        tokens = self.tokens
+        while self.i < self.n:
+            if tokens[self.i][0] == end:
+                self.i += 1
+                return cls(*content, position=pos)
+            content.append(self.read_expr(mode=mode))
+        raise Unsupported('unclosed argument')
+
+    def read_begin_env_args(self, mode=MODE_NON_MATH):
+        args = TexArgs()
+        self.read_arg_required(args, 1, mode)
+        if not args:
+            return args
+        if str(args[0].string) in RAW_ARG_ENVS:
+            raise Unsupported('environment %s' % args[0].string)
+        return self.read_args(args=args, mode=mode)
+
+    def read_raw_command_args(self):
+        args = TexArgs()
+        spacer = self.read_spacer()
+        raw_arg = self.read_raw_brace_arg()
+        if raw_arg is None and spacer:
+            self.i -= 1
+        else:
+            if spacer:
+                args.append(spacer)
+            if raw_arg is not None:
+                args.append(raw_arg)
+        return args
+
+    def read_raw_brace_arg(self):
+        if self._peek_kind() != GROUP_BEGIN:
+            return None
+        kind, text, begin = self._next()
+        depth = 1
+        tokens = self.tokens
+        while self.i < self.n:
+            kind, text, pos = tokens[self.i]
+            self.i += 1
+            if kind == GROUP_BEGIN:
+                depth += 1
+            elif kind == GROUP_END:
+                depth -= 1
+                if depth == 0:
+                    return BraceGroup(self.code[begin + 1:pos],
+                                      position=begin)
+            elif kind == COMMENT:
+                raise Unsupported('comment in a raw argument')
+        raise Unsupported('unclosed argument')
+
+    def read_command(self, arg_spec=None, mode=MODE_NON_MATH):
+        kind, name, pos = self._next()
+        if kind not in (NAME, PUNCT):
+            raise Unsupported('\\ without a command name')
+        if arg_spec is None:
+            if name == 'begin':
+                return name, self.read_begin_env_args(mode)
+            elif name == 'url':
+                return name, self.read_raw_command_args()
+            arg_spec = SIGNATURES.get(name)
+        arg_mode = SIGNATURE_MODES.get(name, mode)
+        if arg_mode == MODE_SPECIAL:
+            raise Unsupported('\\%s' % name)
+        return name, self.read_args(arg_spec, mode=arg_mode)
+
+
+def parse(code):
+    """Parse the code and return the root `TexNode`, like `TexSoup`.
+
+    Raises `Unsupported` if the code uses anything the fast parser does not
+    handle exactly as TexSoup does.
+    """
+    reader = _Reader(code, tokenize(code))
+    root = TexEnv('[tex]', begin='', end='', contents=reader.read_tex())
+    return TexNode(root, src=code)
@@ -0,0 +1,295 @@
+r"""Resolve `\input` and `\include` by inlining the included files.
+
+The files read are cached along with their modification time, size and a
+hash of their contents so they are only read and scanned again when they
+change.  The files included by each document are recorded so that one can
+find out which documents are affected when a file changes.  A `SourceMap`
+records the file and line each line of the expanded code comes from.
+"""
+from bisect import bisect_right
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from .tex2cells import _COMMENT, _LISTING_BEGIN, _LISTING_END
+
+
+logger = logging.getLogger(__name__)
+
+_INCLUDE = re.compile(r'\\(?:input|include)\s*\{([^{}]*)\}')
+
+
+def file_stamp(path):
+    """Return the (modification time in ns, size) of the file or None if it
+    does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def scan_includes(code):
+    """Split the code into a list of text and included file names.
+
+    The names are given as 1-tuples.  Includes in comments and in
+    `lstlisting` or `verbatim` environments are left alone.
+    """
+    if '\\in' not in code:
+        return [code]
+    segments = []
+    start = 0
+    pos = 0
+    in_listing = False
+    n = len(code)
+    while pos < n:
+        nl = code.find('\n', pos)
+        end = n if nl < 0 else nl
+        if in_listing:
+            if code[pos:end].rstrip('\r').lstrip().endswith(_LISTING_END):
+                in_listing = False
+        else:
+            line_end = end
+            match = _COMMENT.search(code, pos, end)
+            if match is not None:
+                line_end = match.start()
+            for match in _INCLUDE.finditer(code, pos, line_end):
+                segments.append(code[start:match.start()])
+                segments.append((match.group(1).strip(),))
+                start = match.end()
+            if code[pos:end].lstrip().startswith(_LISTING_BEGIN):
+                in_listing = True
+        pos = end + 1
+    segments.append(code[start:])
+    return [x for x in segments if x]
+
+
+class SourceMap(object):
+    """Map the lines of code with the included files inlined to the file
+    and line they come from.
+    """
+    def __init__(self):
+        self._lines = []
+        self._sources = []
+
+    def add(self, line, filename, source_line):
+        """Record that the code from `line` (of the expanded code) on comes
+        from the file `filename` starting at `source_line`.
+        """
+        if self._lines and self._lines[-1] == line:
+            self._lines.pop()
+            self._sources.pop()
+        self._lines.append(line)
+        self._sources.append((filename, source_line))
+
+    def lookup(self, line):
+        """Return the (filename, line) that the given line (starting at 1)
+        of the expanded code comes from.  The filename is None for code not
+        from a file.
+        """
+        i = bisect_right(self._lines, line) - 1
+        if i < 0:
+            return None, line
+        filename, source_line = self._sources[i]
+        return filename, source_line + line - self._lines[i]
+
+
+class _File(object):
+    __slots__ = ('stamp', 'sha', 'segments')
+
+    def __init__(self, stamp, sha, segments):
+        self.stamp = stamp
+        self.sha = sha
+        self.segments = segments
+
+
+class IncludeResolver(object):
+    r"""Inline the files included with `\input` and `\include`.
+
+    Included files are looked for relative to the directory of the document
+    and then in `search_paths`, with a `.tex` extension added if the name
+    has none.  Each file is cached and is only read again if its
+    modification time or size change, and only scanned again if its contents
+    changed.  The files included by each document are stored in `graph`
+    which maps a file to the list of files it directly includes.
+    """
+    def __init__(self, search_paths=()):
+        self.search_paths = list(search_paths)
+        self.graph = {}
+        self._files = {}
+
+    def _read(self, path):
+        """Return the segments of the given file or None if it is missing.
+        """
+        stamp = file_stamp(path)
+        entry = self._files.get(path)
+        if stamp is None:
+            self._files.pop(path, None)
+            return None
+        if entry is not None and entry.stamp == stamp:
+            return entry.segments
+        with open(path, encoding='utf-8') as f:
+            code = f.read()
+        sha = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        if entry is not None and entry.sha == sha:
+            entry.stamp = stamp
+            return entry.segments
+        segments = scan_includes(code)
+        self._files[path] = _File(stamp, sha, segments)
+        return segments
+
+    def find(self, name, base_dir):
+        """Return the path of the file included as `name` from a document in
+        `base_dir`.  If it is not found, the path it would have in
+        `base_dir` is returned.
+        """
+        names = [name]
+        if not os.path.splitext(name)[1]:
+            names.insert(0, name + '.tex')
+        candidates = []
+        for dirname in [base_dir] + self.search_paths:
+            for fname in names:
+                path = os.path.abspath(os.path.join(dirname, fname))
+                if os.path.isfile(path):
+                    return path
+                candidates.append(path)
+        return candidates[0]
+
+    def expand(self, code, filename=None, source_map=None):
+        """Return the code with all the included files inlined.
+
+        `filename` is the path of the document the code is from, its
+        directory is used to find the included files.  If it is None, the
+        current directory is used and the includes are not recorded in
+        `graph`.  If a `source_map` (a `SourceMap`) is given, the origin of
+        the lines of the result is recorded in it.
+        """
+        if filename is None:
+            base_dir = os.getcwd()
+            stack = []
+        else:
+            filename = os.path.abspath(filename)
+            base_dir = os.path.dirname(filename)
+            stack = [filename]
+        parts = []
+        self._expand(
+            scan_includes(code), filename, base_dir, stack, parts, source_map
+        )
+        return ''.join(parts)
+
+    def expand_file(self, filename, source_map=None):
+        """Return the contents of the file with all the included files
+        inlined.  The origin of the lines is recorded in the `source_map`
+        if one is given.
+        """
+        filename = os.path.abspath(filename)
+        segments = self._read(filename)
+        if segments is None:
+            raise FileNotFoundError('No such file: %s' % filename)
+        parts = []
+        self._expand(
+            segments, filename, os.path.dirname(filename), [filename], parts,
+            source_map
+        )
+        return ''.join(parts)
+
+    def _expand(self, segments, filename, base_dir, stack, parts,
+                source_map=None, line=1):
+        """Append the expanded segments to `parts`.  `line` is the line of
+        the expanded code the segments start at, the line after them is
+        returned.
+        """
+        deps = []
+        source_line = 1
+        for segment in segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+                if source_map is not None:
+                    source_map.add(line, filename, source_line)
+                    n_lines = segment.count('\n')
+                    line += n_lines
+                    source_line += n_lines
+                continue
+            name = segment[0]
+            path = self.find(name, base_dir)
+            deps.append(path)
+            if path in stack:
+                logger.warning("Recursive include of %s in %s", path,
+                               filename)
+                parts.append('\\input{%s}' % name)
+                continue
+            included = self._read(path)
+            if included is None:
+                logger.warning("Included file %s not found", path)
+                parts.append('\\input{%s}' % name)
+                continue
+            stack.append(path)
+            line = self._expand(
+                included, path, base_dir, stack, parts, source_map, line
+            )
+            stack.pop()
+        if filename is not None:
+            self.graph[filename] = deps
+        return line
+
+    def dependencies(self, filename):
+        """Return the set of all the files the given file includes, directly
+        or indirectly, as recorded when it was last expanded.
+        """
+        result = set()
+        todo = list(self.graph.get(os.path.abspath(filename), ()))
+        while todo:
+            path = todo.pop()
+            if path not in result:
+                result.add(path)
+                todo.extend(self.graph.get(path, ()))
+        return result
+
+    def stamps(self, filename):
+        """Return a dictionary of the current stamps (see `file_stamp`) of
+        the file and all the files it includes.
+        """
+        filename = os.path.abspath(filename)
+        paths = self.dependencies(filename)
+        paths.add(filename)
+        return dict((path, file_stamp(path)) for path in sorted(paths))
+
+
+def changed_files(stamps):
+    """Return the sorted list of files whose stamp differs from the one given
+    in the `stamps` dictionary.
+    """
+    return sorted(
+        path for path, stamp in stamps.items() if file_stamp(path) != stamp
+    )
+
+
+def load_dependencies(fname):
+    """Load the dependencies saved with `save_dependencies`, returns an empty
+    dictionary if there are none.
+    """
+    try:
+        with open(fname, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_dependencies(fname, data):
+    """Save the dependencies (a dictionary) atomically to the given file.
+    """
+    dirname = os.path.dirname(fname) or '.'
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,376 @@
+r"""Expand the macros defined with `\newcommand`, `\renewcommand`,
+`\providecommand` and `\def`.
+
+The definitions are collected in a `MacroTable` which compiles the macro
+names into a single regular expression and the bodies into lists of text
+and argument numbers, so expanding a document is a single scan of it.  The
+tables built from a preamble are memoised on a hash of the preamble, so a
+preamble shared by many documents is only parsed once per process.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+import hashlib
+import logging
+import re
+
+
+logger = logging.getLogger(__name__)
+
+_DEFINE = r'(?P<define>newcommand|renewcommand|providecommand|def)' \
+    r'(?![a-zA-Z@])\*?'
+_CONTROL_SEQUENCE = re.compile(r'\\(?:[a-zA-Z@]+|.)', re.S)
+_LETTERS = re.compile(r'[a-zA-Z@]+$')
+_PARAMETER = re.compile(r'#(#|[1-9])')
+
+# The tables compiled by `compile_macros`, the least recently used ones are
+# discarded first.
+_tables = OrderedDict()
+_MAX_TABLES = 64
+
+
+def _skip_space(text, pos):
+    n = len(text)
+    while pos < n and text[pos].isspace():
+        pos += 1
+    return pos
+
+
+def _read_group(text, pos, close='}'):
+    """Read the group starting at `pos` (which must be the opening brace or
+    bracket) and return its contents and the offset after it, or None if
+    the group is not closed.
+    """
+    open_ = text[pos]
+    depth = 0
+    i = pos
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == open_:
+            depth += 1
+        elif c == close:
+            depth -= 1
+            if depth == 0:
+                return text[pos + 1:i], i + 1
+        i += 1
+    return None
+
+
+def _read_arg(text, pos):
+    """Read a macro argument: a braced group, a control sequence or a single
+    character.  Returns the argument and the offset after it, or None.
+    """
+    pos = _skip_space(text, pos)
+    if pos >= len(text):
+        return None
+    c = text[pos]
+    if c == '{':
+        return _read_group(text, pos)
+    if c == '\\':
+        match = _CONTROL_SEQUENCE.match(text, pos)
+        return match.group(), match.end()
+    if c == '}':
+        return None
+    return c, pos + 1
+
+
+def _compile_body(body):
+    """Return the body as a list of strings and argument indices.
+    """
+    segments = []
+    pos = 0
+    for match in _PARAMETER.finditer(body):
+        segments.append(body[pos:match.start()])
+        arg = match.group(1)
+        segments.append('#' if arg == '#' else int(arg) - 1)
+        pos = match.end()
+    segments.append(body[pos:])
+    return [x for x in segments if x != '']
+
+
+class MacroTable(object):
+    """A table of macros mapping each name (without the backslash) to a
+    tuple of the number of arguments, the default value of the optional
+    first argument (or None) and the body.
+
+    `expand` replaces the macros in some code with their expansion and adds
+    any definitions it finds to the table.  Expansions are expanded again
+    up to `max_depth` times, which stops recursive definitions.
+    """
+
+    # The maximum depth of nested expansions.
+    max_depth = 32
+
+    def __init__(self, macros=None):
+        self.macros = dict(macros or {})
+        self._compiled = {}
+        self._pattern = None
+
+    def __len__(self):
+        return len(self.macros)
+
+    def __contains__(self, name):
+        return name in self.macros
+
+    def copy(self):
+        table = MacroTable()
+        table.macros = dict(self.macros)
+        table._compiled = dict(self._compiled)
+        table._pattern = self._pattern
+        return table
+
+    @property
+    def key(self):
+        """A hash of the definitions, which identifies the table.
+        """
+        data = repr(sorted(self.macros.items())).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def define(self, name, n_args=0, default=None, body='', command='def'):
+        """Define the macro `name`, `command` is the command used to define
+        it, `providecommand` does nothing if the macro is already defined.
+        """
+        if command == 'providecommand' and name in self.macros:
+            return
+        if not _LETTERS.match(name):
+            logger.debug("Macro \\%s is not expanded", name)
+            return
+        if name not in self.macros:
+            self._pattern = None
+        self.macros[name] = (n_args, default, body)
+        self._compiled.pop(name, None)
+
+    def update(self, other):
+        """Add the definitions in another table, overriding existing ones.
+        """
+        for name, (n_args, default, body) in other.macros.items():
+            self.define(name, n_args, default, body)
+
+    def _get_pattern(self):
+        if self._pattern is None:
+            names = '|'.join(
+                re.escape(x) for x in sorted(self.macros, key=len,
+                                             reverse=True)
+            )
+            pattern = r'(?<!\\)\\(?:%s' % _DEFINE
+            if names:
+                pattern += r'|(?P<name>%s)(?![a-zA-Z@])' % names
+            self._pattern = re.compile(pattern + ')')
+        return self._pattern
+
+    def _parse_definition(self, text, match):
+        """Parse the definition at the match and add it to the table.
+        Returns the offset after the definition or None if it could not be
+        parsed.
+        """
+        command = match.group('define')
+        pos = _skip_space(text, match.end())
+        if command == 'def':
+            cs = _CONTROL_SEQUENCE.match(text, pos)
+            if cs is None:
+                return None
+            name = cs.group()
+            start = cs.end()
+            pos = text.find('{', start)
+            if pos < 0:
+                return None
+            params = ''.join(text[start:pos].split())
+            if params != ''.join('#%d' % (i + 1)
+                                 for i in range(len(params)//2)):
+                return None
+            n_args, default = len(params)//2, None
+        else:
+            if text.startswith('{', pos):
+                group = _read_group(text, pos)
+                if group is None:
+                    return None
+                name, pos = group[0].strip(), group[1]
+            else:
+                cs = _CONTROL_SEQUENCE.match(text, pos)
+                if cs is None:
+                    return None
+                name, pos = cs.group(), cs.end()
+            n_args, default = 0, None
+            pos = _skip_space(text, pos)
+            if text.startswith('[', pos):
+                group = _read_group(text, pos, ']')
+                if group is None or not group[0].strip().isdigit():
+                    return None
+                n_args, pos = int(group[0]), _skip_space(text, group[1])
+                if text.startswith('[', pos):
+                    group = _read_group(text, pos, ']')
+                    if group is None:
+                        return None
+                    default, pos = group
+        body = _read_arg(text, pos)
+        if body is None or not name.startswith('\\'):
+            return None
+        self.define(name[1:], n_args, default, body[0], command)
+        return body[1]
+
+    def _call(self, name, text, pos):
+        """Return the expansion of the macro `name` whose arguments start at
+        `pos` and the offset after them, or None if they are missing.
+        """
+        n_args, default, body = self.macros[name]
+        segments = self._compiled.get(name)
+        if segments is None:
+            segments = self._compiled[name] = _compile_body(body)
+        args = []
+        if n_args == 0:
+            if text.startswith('{}', pos):
+                pos += 2
+        elif default is not None:
+            start = _skip_space(text, pos)
+            group = None
+            if text.startswith('[', start):
+                group = _read_group(text, start, ']')
+            if group is None:
+                args.append(default)
+            else:
+                args.append(group[0])
+                pos = group[1]
+        while len(args) < n_args:
+            arg = _read_arg(text, pos)
+            if arg is None:
+                return None
+            args.append(arg[0])
+            pos = arg[1]
+        result = ''.join(
+            x if isinstance(x, str) else args[x] for x in segments
+        )
+        return result, pos
+
+    def expand(self, code, skip=(), depth=0, lines=None):
+        """Return the code with all the macros expanded.
+
+        The text in the (start, end) offsets given in `skip`, for example
+        listings, is left alone.  Definitions found in the code are added
+        to the table and removed from the code, keeping the newlines in
+        them so the line numbers of the rest of the code do not change.
+
+        Expansions may still add or remove lines.  If `lines` is a list, a
+        (line in the result, line in the code) pair is appended to it after
+        each expansion that does, the lines that follow are offset by the
+        same amount (see `map_line`).
+        """
+        parts = []
+        pos = 0
+        line = 1
+        delta = 0
+        for start, end in list(skip) + [(len(code), len(code))]:
+            text = code[pos:start]
+            result = self._expand(text, depth, lines, line, delta)
+            parts.append(result)
+            parts.append(code[start:end])
+            if lines is not None:
+                n = text.count('\n')
+                delta += result.count('\n') - n
+                line += n + code.count('\n', start, end)
+            pos = end
+        return ''.join(parts)
+
+    def _expand(self, text, depth, lines=None, line=1, delta=0):
+        if '\\' not in text:
+            return text
+        pattern = self._get_pattern()
+        parts = []
+        pos = 0
+        # The offset up to which the newlines are counted in `line`.
+        counted = 0
+        while True:
+            match = pattern.search(text, pos)
+            if match is None:
+                break
+            parts.append(text[pos:match.start()])
+            pos = match.end()
+            if match.group('define'):
+                end = self._parse_definition(text, match)
+                if end is None:
+                    parts.append(match.group())
+                    continue
+                parts.append('\n'*text.count('\n', match.start(), end))
+                pos = end
+                pattern = self._get_pattern()
+                continue
+            result = self._call(match.group('name'), text, pos)
+            if result is None:
+                parts.append(match.group())
+                continue
+            expansion, end = result
+            if depth >= self.max_depth:
+                logger.warning("Macro %s is nested too deeply, it is not "
+                               "expanded", match.group())
+                parts.append(text[match.start():end])
+            else:
+                expansion = self._expand(expansion, depth + 1)
+                parts.append(expansion)
+                if lines is not None:
+                    change = expansion.count('\n') - \
+                        text.count('\n', match.start(), end)
+                    if change:
+                        line += text.count('\n', counted, end)
+                        counted = end
+                        delta += change
+                        lines.append((line + delta, line))
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+
+def map_line(lines, line):
+    """Return the line of the code that the given line of its expansion
+    comes from, using the `lines` recorded by `MacroTable.expand`.  The
+    lines of an expansion that adds lines map to the line of the macro.
+    """
+    i = bisect_left(lines, (line,))
+    if i > 0:
+        out, source = lines[i - 1]
+        line = source + line - out
+    if i < len(lines):
+        line = min(line, lines[i][1])
+    return line
+
+
+def compile_macros(code, macros=None, lines=None):
+    """Expand the macros in the (preprocessed) code with a copy of the table
+    `macros` and collect the definitions in it.
+
+    Returns the expanded code and the table, which is a new copy every time.
+    The result is memoised on a hash of the code and the key of `macros` so
+    the same preamble is only parsed once.  If `lines` is a list the changes
+    of lines are appended to it as for `MacroTable.expand`.
+    """
+    base = '' if macros is None else macros.key
+    sha = hashlib.sha256(base.encode('utf-8') + b'\0')
+    sha.update(code.encode('utf-8'))
+    key = sha.hexdigest()
+    entry = _tables.get(key)
+    if entry is None:
+        table = MacroTable() if macros is None else macros.copy()
+        changes = []
+        entry = _tables[key] = (table.expand(code, lines=changes), table,
+                                tuple(changes))
+        while len(_tables) > _MAX_TABLES:
+            _tables.popitem(last=False)
+    else:
+        _tables.move_to_end(key)
+    if lines is not None:
+        lines.extend(entry[2])
+    return entry[0], entry[1].copy()
+
+
+def load_preamble(*filenames):
+    """Return a `MacroTable` with the macros defined in the given files,
+    later files override the definitions in earlier ones.
+    """
+    from .tex2cells import preprocess
+    table = None
+    for fname in filenames:
+        with open(fname, encoding='utf-8') as f:
+            code = preprocess(f.read()).code
+        table = compile_macros(code, table)[1]
+    return MacroTable() if table is None else table
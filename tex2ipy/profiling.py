@@ -0,0 +1,113 @@
+"""Record where the time is spent when converting a document.
+
+A `Profile` may be passed to `Tex2Cells` (and `cli.tex2ipy`) to record the
+number of calls and the time spent in each handler and under each kind of
+node as well as the time taken by each stage of the conversion.  When no
+profile is given, nothing is recorded and the conversion is not slowed down.
+"""
+from contextlib import contextmanager
+import json
+import time
+
+
+timer = time.perf_counter
+
+
+class Profile(object):
+    """Call counts and cumulative times of the conversion.
+
+    `stages` maps the name of each stage of the conversion to the time it
+    took, `handlers` maps the name of each handler method to a list of the
+    number of calls and the time spent in the handler itself and `nodes`
+    maps each node name to a list of the number of nodes and the time spent
+    converting them, including their children.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.handlers = {}
+        self.nodes = {}
+        self._active = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager adding the time spent in it to the given stage.
+        """
+        start = timer()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + timer() - start
+
+    def add_handler(self, name, elapsed):
+        stats = self.handlers.get(name)
+        if stats is None:
+            self.handlers[name] = [1, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+
+    def begin_node(self, name):
+        """Start timing a node with the given name, returns the start time.
+        """
+        stats = self.nodes.get(name)
+        if stats is None:
+            self.nodes[name] = [1, 0.0]
+        else:
+            stats[0] += 1
+        self._active[name] = self._active.get(name, 0) + 1
+        return timer()
+
+    def end_node(self, name, start):
+        """Finish timing the node started at `start`.  The time of nodes
+        nested in a node with the same name is only counted once.
+        """
+        active = self._active[name] - 1
+        self._active[name] = active
+        if active == 0:
+            self.nodes[name][1] += timer() - start
+
+    def to_dict(self):
+        def _stats(data):
+            return dict(
+                (k, dict(calls=v[0], time=v[1])) for k, v in data.items()
+            )
+        return dict(
+            stages=dict(self.stages),
+            handlers=_stats(self.handlers),
+            nodes=_stats(self.nodes),
+        )
+
+    def dump_json(self, fp):
+        """Write the profile as JSON to the file object `fp`.
+        """
+        json.dump(self.to_dict(), fp, indent=1, sort_keys=True)
+
+    def report(self, stream=None, limit=None):
+        """Print tables of the stages, handlers and nodes sorted by the time
+        spent in them.  Only the first `limit` handlers and nodes are shown
+        if it is given.
+        """
+        print("%-32s %12s" % ('Stage', 'Time (s)'), file=stream)
+        for name, elapsed in self.stages.items():
+            print("%-32s %12.4f" % (name, elapsed), file=stream)
+        for title, data in (('Handler', self.handlers), ('Node', self.nodes)):
+            print(file=stream)
+            print("%-32s %8s %12s %12s" % (
+                title, 'Calls', 'Time (s)', 'Per call (ms)'
+            ), file=stream)
+            items = sorted(data.items(), key=lambda x: (-x[1][1], x[0]))
+            for name, (calls, elapsed) in items[:limit]:
+                print("%-32s %8d %12.4f %12.4f" % (
+                    name, calls, elapsed, 1000*elapsed/calls
+                ), file=stream)
+
+
+@contextmanager
+def maybe_stage(profile, name):
+    """Time the given stage if `profile` is not None.
+    """
+    if profile is None:
+        yield
+    else:
+        with profile.stage(name):
+            yield
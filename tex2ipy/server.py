@@ -0,0 +1,273 @@
+"""A long running local server converting TeX to notebooks over HTTP.
+
+This avoids the cost of starting the interpreter and importing the
+dependencies for each conversion.  The conversions are done by a pool of
+worker processes which load the converter once when they start.  POST the
+TeX code to `/convert` and the notebook JSON is returned, for example::
+
+    $ tex2ipy serve --port 8000 &
+    $ curl --data-binary @talk.tex http://localhost:8000/convert > talk.ipynb
+
+At most `jobs` documents are converted at the same time and up to
+`max_pending` requests (including those being converted) are accepted, any
+more are rejected with a 503 response so clients can retry later.  A
+request which times out keeps its slot until its conversion finishes.
+Invalid input is answered with a 400 response and failures of the server
+itself, such as a worker process dying, with a 500 response.
+"""
+import argparse
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, \
+    TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+
+
+# 16 MB.
+DEFAULT_MAX_BODY = 16*1024*1024
+
+
+def _ping(i):
+    return os.getpid()
+
+
+def _convert(code):
+    from .batch import _worker
+    from .cli import tex2ipy_text
+    from .tex2cells import ImageResolver
+    # The image directories are listed again for every request as they may
+    # change while the server runs.
+    return tex2ipy_text(
+        code, _worker.converter, _worker.cache, _worker.converter_source,
+        _worker.validate, image_resolver=ImageResolver()
+    )
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """Handle the requests to a `ConversionServer`.
+    """
+    def _send(self, status, data, content_type='application/json'):
+        body = data.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, json.dumps(dict(error=message)))
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_error(404, 'Not found')
+            return
+        server = self.server
+        self._send(200, json.dumps(dict(
+            status='ok', jobs=server.jobs, pending=server.pending,
+            max_pending=server.max_pending
+        )))
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self._send_error(404, 'Not found')
+            return
+        server = self.server
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._send_error(411, 'Content-Length required')
+            return
+        if length < 0:
+            self._send_error(400, 'Invalid Content-Length')
+            return
+        if length > server.max_body:
+            self._send_error(413, 'Request too large')
+            return
+        code = self.rfile.read(length)
+        try:
+            code = code.decode('utf-8')
+        except UnicodeDecodeError:
+            self._send_error(400, 'Input must be UTF-8')
+            return
+
+        if not server.acquire():
+            self._send_error(503, 'Too many pending requests')
+            return
+        try:
+            future = server.pool.submit(_convert, code)
+        except Exception as e:
+            server.release()
+            self._send_error(500, '%s: %s' % (type(e).__name__, e))
+            return
+        # The slot is held until the conversion is done, even if it times
+        # out, so no more than `max_pending` conversions are ever queued.
+        future.add_done_callback(lambda f: server.release())
+        try:
+            text = future.result(server.timeout)
+        except TimeoutError:
+            future.cancel()
+            self._send_error(504, 'Conversion timed out')
+            return
+        except BrokenExecutor as e:
+            self._send_error(500, '%s: %s' % (type(e).__name__, e))
+            return
+        except Exception as e:
+            self._send_error(400, '%s: %s' % (type(e).__name__, e))
+            return
+        self._send(200, text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(ConversionHandler, self).log_message(format, *args)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """An HTTP server converting TeX to notebooks with a pool of `jobs`
+    worker processes.
+
+    `converter_path`, `cache` and `validate` are used as for
+    `tex2ipy.batch.batch_convert`, while the server runs the cache is
+    pruned every `cache.prune_interval` seconds.  `max_pending` is the
+    maximum number of requests accepted at a time (twice `jobs` by
+    default), `timeout` the maximum time in seconds a conversion may take
+    and `max_body` the largest input accepted in bytes.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, converter_path='', jobs=None,
+                 max_pending=None, cache=None, validate=False, timeout=None,
+                 max_body=DEFAULT_MAX_BODY, verbose=False):
+        from .batch import _init_worker
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if max_pending is None:
+            max_pending = 2*jobs
+        self.jobs = jobs
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_body = max_body
+        self.verbose = verbose
+        self.pending = 0
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._pruner = None
+        self.pool = ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(converter_path, cache, validate)
+        )
+        try:
+            # Start the workers now so the first requests are fast.
+            list(self.pool.map(_ping, range(jobs)))
+            super(ConversionServer, self).__init__(address, ConversionHandler)
+        except BaseException:
+            self.pool.shutdown()
+            raise
+        if cache is not None:
+            self._pruner = threading.Thread(target=self._prune, daemon=True)
+            self._pruner.start()
+
+    def _prune(self):
+        while not self._closed.wait(self.cache.prune_interval):
+            self.cache.maybe_prune()
+
+    def acquire(self):
+        """Reserve a slot for a request, returns False if there is none.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+    def server_close(self):
+        super(ConversionServer, self).server_close()
+        self._closed.set()
+        if self._pruner is not None:
+            self._pruner.join()
+        self.pool.shutdown()
+
+
+def main(args=None):
+    from .cache import ConversionCache, DEFAULT_MAX_SIZE
+    parser = argparse.ArgumentParser(
+        "tex2ipy serve",
+        description="Convert LaTeX beamer slides to notebooks over HTTP."
+    )
+    parser.add_argument(
+        "--host", action="store", default='127.0.0.1',
+        help="Address to listen on (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--port", action="store", type=int, default=8000,
+        help="Port to listen on (default: %(default)s)."
+    )
+    parser.add_argument(
+        "-c", "--converter", action="store", dest="converter", default='',
+        help="Path to a Python file which defines a subclass of Tex2Cells."
+    )
+    parser.add_argument(
+        "-j", "--jobs", action="store", type=int, default=None,
+        help="Number of worker processes (defaults to the number of CPUs)."
+    )
+    parser.add_argument(
+        "--max-pending", action="store", type=int, dest="max_pending",
+        default=None,
+        help="Maximum number of requests accepted at a time, more are "
+        "rejected (defaults to twice the number of jobs)."
+    )
+    parser.add_argument(
+        "--timeout", action="store", type=float, default=None,
+        help="Maximum time in seconds for a conversion."
+    )
+    parser.add_argument(
+        "--no-cache", action="store_false", dest="cache", default=True,
+        help="Do not use the conversion cache."
+    )
+    parser.add_argument(
+        "--cache-dir", action="store", dest="cache_dir", default=None,
+        help="Directory for the conversion cache "
+        "(defaults to ~/.cache/tex2ipy)."
+    )
+    parser.add_argument(
+        "--cache-size", action="store", type=int, dest="cache_size",
+        default=DEFAULT_MAX_SIZE//(1024*1024),
+        help="Maximum size of the conversion cache in MB (default: "
+        "%(default)s)."
+    )
+    parser.add_argument(
+        "--validate", action="store_true", default=False,
+        help="Validate the generated notebooks against the notebook schema."
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", default=False,
+        help="Log every request."
+    )
+    args = parser.parse_args(args)
+
+    cache = None
+    if args.cache:
+        cache = ConversionCache(args.cache_dir, args.cache_size*1024*1024)
+    server = ConversionServer(
+        (args.host, args.port), args.converter, args.jobs, args.max_pending,
+        cache, args.validate, args.timeout, verbose=args.verbose
+    )
+    host, port = server.server_address[:2]
+    print("Serving on http://%s:%d/convert with %d workers" % (
+        host, port, server.jobs
+    ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if cache is not None:
+            cache.maybe_prune()
@@ -0,0 +1,171 @@
+"""Split the cells of a large document into several notebooks.
+
+The cells are split at each section and/or when a part reaches a maximum
+number of cells or bytes.  Each part starts with a cell showing the title
+page information of the document and an index notebook linking to all the
+parts is also written.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+
+def _section(cell):
+    return getattr(cell, 'section', None)
+
+
+def _slide_type(cell):
+    slide_type = getattr(cell, 'slide_type', None)
+    if slide_type is None:
+        slide_type = cell['metadata']['slideshow']['slide_type']
+    return slide_type
+
+
+def _size(cell):
+    return sum(len(line.encode('utf-8')) for line in cell['source'])
+
+
+def split_cells(cells, by_section=True, max_cells=None, max_bytes=None):
+    """Split the list of cells into a list of parts (lists of cells).
+
+    A new part is started at every section if `by_section` is True.  Once a
+    part has `max_cells` cells or `max_bytes` bytes of source, a new part is
+    started at the next new slide so slides are never split.
+    """
+    parts = []
+    current = []
+    size = 0
+    for cell in cells:
+        if current:
+            start = by_section and _section(cell) is not None
+            if not start and (max_cells or max_bytes):
+                full = (max_cells and len(current) >= max_cells) or \
+                    (max_bytes and size >= max_bytes)
+                start = full and _slide_type(cell) == 'slide'
+            if start:
+                parts.append(current)
+                current = []
+                size = 0
+        current.append(cell)
+        if max_bytes:
+            size += _size(cell)
+    if current:
+        parts.append(current)
+    return parts
+
+
+def part_titles(parts):
+    """Return a title for each part: the section it starts or continues.
+    """
+    titles = []
+    section = None
+    for i, part in enumerate(parts):
+        first = _section(part[0])
+        if first is not None:
+            title = first
+        elif section is not None:
+            title = '%s (continued)' % section
+        else:
+            title = 'Part %d' % (i + 1)
+        titles.append(title)
+        for cell in part:
+            if _section(cell) is not None:
+                section = _section(cell)
+    return titles
+
+
+def title_cell(info, heading=None):
+    """Return a cell showing the title page information in `info` (as
+    collected by `Tex2Cells`) with an optional heading.
+    """
+    from .tex2cells import Cell
+    cell = Cell()
+    src = cell.source
+    src.append('# %s\n' % info.get('title', 'Title'))
+    if heading:
+        src.append('\n')
+        src.append('## %s\n' % heading)
+    for key in ('author', 'institute', 'date'):
+        if key in info:
+            src.append('\n')
+            src.append('**%s**\n' % info[key])
+    return cell
+
+
+def get_part_path(output, index):
+    """Return the path of the part with the given index (starting at 1).
+    """
+    base, ext = os.path.splitext(output)
+    return '%s_%02d%s' % (base, index, ext or '.ipynb')
+
+
+def _write_notebook(path, cells, metadata, validate):
+    from .cli import _cell_id, _new_notebook, notebook_text, \
+        write_if_changed
+    from .tex2cells import to_node
+    nodes = [to_node(cell) for cell in cells]
+    seen = set()
+    for node in nodes:
+        if 'id' not in node:
+            node['id'] = _cell_id(node, seen)
+    nb = _new_notebook(nodes)
+    nb.metadata['tex2ipy'] = metadata
+    write_if_changed(path, notebook_text(nb, validate))
+    return path
+
+
+def _write_task(args):
+    return _write_notebook(*args)
+
+
+def write_split(code, output, cls=None, by_section=True, max_cells=None,
+                max_bytes=None, jobs=None, validate=False, cells=None, **kw):
+    """Convert the TeX code and write it as several notebooks.
+
+    The parts are split using `split_cells` and written to files named
+    after `output` with the part number added, `output` itself is an index
+    notebook with links to the parts.  The parts are written using `jobs`
+    processes.  If `cells` is a list, the cells converted are added to it.
+    Any keyword arguments are passed on to the converter class `cls`
+    (`Tex2Cells` by default).
+
+    Returns the list of files written, the index first.
+    """
+    from .tex2cells import Cell, Tex2Cells
+    if cls is None:
+        cls = Tex2Cells
+    t2c = cls(code, **kw)
+    converted = t2c.parse_cells()
+    if cells is not None:
+        cells.extend(converted)
+    cells = converted
+    info = dict((str(k), str(v)) for k, v in t2c.info.items())
+    parts = split_cells(cells, by_section, max_cells, max_bytes)
+    titles = part_titles(parts)
+    del cells, t2c
+
+    tasks = []
+    links = Cell(slide_type='slide')
+    n_parts = len(parts)
+    for i, (part, title) in enumerate(zip(parts, titles)):
+        path = get_part_path(output, i + 1)
+        metadata = dict(info, part=i + 1, parts=n_parts, section=title)
+        heading = None if _section(part[0]) is not None else title
+        cells = [title_cell(info, heading)] + part
+        tasks.append((path, cells, metadata, validate))
+        links.source.append(
+            '%d. [%s](%s)\n' % (i + 1, title, os.path.basename(path))
+        )
+    del parts
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(tasks)))
+    if jobs == 1:
+        paths = [_write_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            paths = list(pool.map(_write_task, tasks))
+
+    metadata = dict(info, parts=[os.path.basename(x) for x in paths])
+    _write_notebook(output, [title_cell(info), links], metadata, validate)
+    return [output] + paths
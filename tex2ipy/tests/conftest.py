@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _cache_home(tmpdir, monkeypatch):
+    # Keep the default conversion cache out of the user's home directory.
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache_home')))
+
+
+@pytest.fixture(autouse=True, params=['texsoup', 'fast'])
+def engine(request, monkeypatch):
+    # Run every test with both parsing engines.
+    from tex2ipy.tex2cells import Tex2Cells
+    monkeypatch.setattr(Tex2Cells, 'engine', request.param)
+    return request.param
@@ -0,0 +1,157 @@
+import os
+from textwrap import dedent
+
+import nbformat
+
+from tex2ipy.batch import batch_convert, find_tex_files, get_output_path, \
+    is_document
+from tex2ipy.cache import ConversionCache
+from tex2ipy.cli import main
+
+
+DOCUMENT = dedent(r"""
+\documentclass[14pt, compress]{beamer}
+\begin{document}
+\begin{frame}
+\frametitle{Foo}
+Hello world
+\end{frame}
+\end{document}
+""")
+
+
+def _make_tree(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('a.tex').write(DOCUMENT)
+    src.mkdir('sub').join('b.tex').write(DOCUMENT)
+    src.join('notes.txt').write('not tex')
+    return src
+
+
+def test_find_tex_files(tmpdir):
+    # Given
+    src = _make_tree(tmpdir)
+
+    # When
+    files = find_tex_files(str(src))
+
+    # Then
+    expect = [str(src.join('a.tex')), str(src.join('sub', 'b.tex'))]
+    assert files == expect
+
+
+def test_is_document():
+    assert is_document(DOCUMENT)
+    assert is_document('\\begin {document}')
+    assert not is_document(r'\begin{frame}Hello\end{frame}')
+    assert not is_document('% \\begin{document}\n')
+
+
+def test_get_output_path():
+    # When
+    dest = get_output_path(
+        os.path.join('src', 'sub', 'b.tex'), 'src', 'out'
+    )
+
+    # Then
+    assert dest == os.path.join('out', 'sub', 'b.ipynb')
+
+
+def test_batch_convert_mirrors_tree(tmpdir):
+    # Given
+    src = _make_tree(tmpdir)
+    src.join('bad.tex').write(r'\begin{document}\begin{frame}')
+    src.join('unknown.tex').write(DOCUMENT.replace('Hello', r'\foo Hello'))
+    out = tmpdir.join('out')
+
+    # When
+    result = batch_convert(str(src), str(out), jobs=2)
+
+    # Then
+    assert len(result['files']) == 4
+    assert out.join('a.ipynb').check(file=1)
+    assert out.join('sub', 'b.ipynb').check(file=1)
+    nb = nbformat.read(str(out.join('sub', 'b.ipynb')), 4)
+    assert nb.cells[0].source.splitlines()[0] == '## Foo'
+    assert len(result['failures']) == 1
+    assert result['failures'][0][0] == str(src.join('bad.tex'))
+    assert result['diagnostics'].unknown == dict(foo=1)
+
+
+def test_main_with_batch(tmpdir, capsys):
+    # Given
+    src = _make_tree(tmpdir)
+    out = tmpdir.join('out')
+
+    # When
+    ret = main(args=['--batch', str(src), str(out), '-j', '1'])
+
+    # Then
+    assert ret == 0
+    assert out.join('a.ipynb').check(file=1)
+    assert out.join('sub', 'b.ipynb').check(file=1)
+    captured = capsys.readouterr()
+    assert 'Converted 2 of 2 files' in captured.out
+
+
+def test_batch_convert_reports_unknown_macros_of_skipped_files(tmpdir):
+    # Given
+    src = _make_tree(tmpdir)
+    src.join('a.tex').write(DOCUMENT.replace('Hello', r'\foo Hello'))
+    out = tmpdir.join('out')
+    cache = ConversionCache(str(tmpdir.join('cache')))
+    first = batch_convert(str(src), str(out), jobs=1, cache=cache)
+
+    # When
+    result = batch_convert(str(src), str(out), jobs=1, cache=cache)
+
+    # Then
+    assert len(result['skipped']) == 2
+    assert result['diagnostics'].unknown == {'foo': 1}
+    assert result['diagnostics'].unknown == first['diagnostics'].unknown
+
+
+def test_batch_convert_with_merge(tmpdir):
+    # Given
+    src = tmpdir.mkdir('src')
+    src.join('a.tex').write(DOCUMENT.replace('Hello world', dedent(r"""
+    \begin{lstlisting}
+    In []: print(1)
+    \end{lstlisting}
+    """)))
+    out = tmpdir.join('out')
+    batch_convert(str(src), str(out), jobs=1)
+    dest = out.join('a.ipynb')
+    nb = nbformat.read(str(dest), 4)
+    nb.cells[1].execution_count = 1
+    nbformat.write(nb, str(dest))
+    src.join('a.tex').write(src.join('a.tex').read().replace('Foo', 'Bar'))
+
+    # When
+    batch_convert(str(src), str(out), jobs=1, merge=True)
+
+    # Then
+    nb = nbformat.read(str(dest), 4)
+    assert nb.cells[0].source.startswith('## Bar')
+    assert nb.cells[1].execution_count == 1
+
+
+def test_batch_convert_checks_the_images(tmpdir):
+    # Given
+    src = tmpdir.mkdir('src')
+    src.join('a.tex').write(DOCUMENT.replace(
+        'Hello world', r'\includegraphics{%s}' % src.join('fig')
+    ))
+    out = tmpdir.join('out')
+    cache = ConversionCache(str(tmpdir.join('cache')))
+    batch_convert(str(src), str(out), jobs=1, cache=cache)
+    result = batch_convert(str(src), str(out), jobs=1, cache=cache)
+    assert len(result['skipped']) == 1
+
+    # When
+    src.join('fig.png').write('')
+    result = batch_convert(str(src), str(out), jobs=1, cache=cache)
+
+    # Then
+    assert result['skipped'] == []
+    assert 'fig.png' in out.join('a.ipynb').read()
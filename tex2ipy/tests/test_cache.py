@@ -0,0 +1,254 @@
+import os
+from textwrap import dedent
+import time
+
+from TexSoup import TexSoup
+
+from tex2ipy import fastparse, tex2cells
+from tex2ipy.cache import ConversionCache, DiskCache, DiskFrameCache, \
+    DiskTreeCache, make_key
+from tex2ipy.cli import main, tex2ipy_text
+from tex2ipy.tests.test_tex2ipy import DOCUMENT
+from tex2ipy.tex2cells import Tex2Cells
+
+
+def test_make_key_depends_on_all_parts():
+    # Given
+    key = make_key('code', 'converter')
+
+    # Then
+    assert key == make_key('code', 'converter')
+    assert key != make_key('code', 'other')
+    assert key != make_key('codeconverter', '')
+    assert len(key) == 64
+
+
+def test_disk_cache_get_put(tmpdir):
+    # Given
+    cache = DiskCache(str(tmpdir))
+    key = make_key('x')
+
+    # When/Then
+    assert cache.get(key) is None
+    cache.put(key, 'hello')
+    assert cache.get(key) == 'hello'
+    assert cache.size() == 5
+
+
+def test_disk_cache_prune_removes_least_recently_used(tmpdir):
+    # Given
+    cache = DiskCache(str(tmpdir), max_size=10)
+    keys = [make_key(str(i)) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, 'x'*5)
+        path = cache._path(key)
+        t = time.time() - 100 + i
+        os.utime(path, (t, t))
+    # Reading the first key makes it the most recently used.
+    cache.get(keys[0])
+
+    # When
+    removed = cache.prune()
+
+    # Then
+    assert removed == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == 'x'*5
+    assert cache.get(keys[2]) == 'x'*5
+
+
+def test_conversion_cache_prunes_all_entries_together(tmpdir):
+    # Given
+    cache = ConversionCache(str(tmpdir))
+    frames = cache.frame_cache()
+    trees = cache.tree_cache()
+    cache.put(make_key('a'), 'x'*4000)
+    frames.put('b', 'x'*4000)
+    trees.put('c', TexSoup('x'*4000))
+    paths = [
+        cache._path(make_key('a')),
+        frames._path(make_key(frames.namespace, 'b')),
+        trees._path(trees._key('c'))
+    ]
+    for i, path in enumerate(paths):
+        t = time.time() - 100 + i
+        os.utime(path, (t, t))
+
+    size = cache.size()
+    assert size > 12000
+    cache.max_size = size - 1
+
+    # When
+    removed = cache.prune()
+
+    # Then
+    assert removed == 1
+    assert not os.path.exists(paths[0])
+    assert frames.get('b') == 'x'*4000
+    assert trees.get('c') is not None
+    assert cache.size() < size
+
+
+def test_maybe_prune_only_prunes_every_interval(tmpdir, monkeypatch):
+    # Given
+    cache = ConversionCache(str(tmpdir), max_size=0)
+    calls = []
+    monkeypatch.setattr(DiskCache, '_entries',
+                        lambda self: calls.append(self) or [])
+
+    # When
+    cache.maybe_prune()
+    cache.maybe_prune()
+
+    # Then
+    assert len(calls) == 3
+    assert tmpdir.join('last_prune').check(file=1)
+
+    # When
+    t = time.time() - cache.prune_interval - 1
+    os.utime(str(tmpdir.join('last_prune')), (t, t))
+    cache.maybe_prune()
+
+    # Then
+    assert len(calls) == 6
+
+
+def test_main_uses_cache(tmpdir):
+    # Given
+    src = tmpdir.join('test.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('test.ipynb')
+    cache_dir = tmpdir.join('cache')
+    args = [str(src), str(dest), '--cache-dir', str(cache_dir)]
+    main(args=args)
+    cache = ConversionCache(str(cache_dir))
+    key = cache.key(DOCUMENT)
+    entry = cache.get(key)
+    assert entry['text'] == dest.read()
+    assert entry['images'] == {}
+    assert len(entry['diagnostics']) == 0
+
+    # When
+    cache.put(key, 'cached\n')
+    main(args=args)
+
+    # Then
+    assert dest.read() == 'cached\n'
+
+    # When the cache is disabled.
+    main(args=args + ['--no-cache'])
+
+    # Then
+    assert dest.read() != 'cached\n'
+
+
+def test_main_reports_unknown_macros_from_the_cache(tmpdir, capsys):
+    # Given
+    code = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \foo \bar
+    \end{frame}
+    \begin{frame}
+    \foo
+    \end{frame}
+    \end{document}
+    """)
+    src = tmpdir.join('test.tex')
+    dest = tmpdir.join('test.ipynb')
+    args = [str(src), str(dest), '--cache-dir', str(tmpdir.join('cache'))]
+    for edit in ('', 'Edited'):
+        end = '\\end{frame}\n\\end{document}'
+        src.write(code.replace(end, edit + '\n' + end))
+        main(args=args + ['--no-cache'])
+        expect = capsys.readouterr().out
+
+        # When the notebook is converted and then taken from the cache.
+        main(args=args)
+        main(args=args)
+
+        # Then
+        assert '\\foo: 2 (lines 4, 7)' in expect
+        assert capsys.readouterr().out == expect*2
+
+
+def test_cache_is_not_used_when_images_change(tmpdir):
+    # Given
+    src = tmpdir.join('test.tex')
+    src.write(DOCUMENT.replace('Hello world', r'\includegraphics{fig}'))
+    dest = tmpdir.join('test.ipynb')
+    args = [str(src), str(dest), '--cache-dir', str(tmpdir.join('cache'))]
+    with tmpdir.as_cwd():
+        main(args=args)
+        assert '<img src=\\"fig\\"/>' in dest.read()
+
+        # When
+        tmpdir.join('fig.png').write('')
+        main(args=args)
+
+    # Then
+    assert '<img src=\\"fig.png\\"/>' in dest.read()
+    cache = ConversionCache(str(tmpdir.join('cache')))
+    key = cache.key(src.read())
+    assert cache.get(key)['images'] == {('fig', ()): 'fig.png'}
+
+
+def test_disk_frame_cache(tmpdir):
+    # Given
+    cache = DiskFrameCache(str(tmpdir), namespace='a')
+    other = DiskFrameCache(str(tmpdir), namespace='b')
+    cells = [dict(cell_type='markdown', source=['hello'])]
+
+    # When
+    cache.put('key', cells)
+
+    # Then
+    assert cache.get('key') == cells
+    assert cache.get('key') is not cache.get('key')
+    assert other.get('key') is None
+
+
+def test_disk_tree_cache(tmpdir):
+    # Given
+    cache = DiskTreeCache(str(tmpdir))
+    code = r'\section{A} \begin{itemize}\item[x] $y$ \% z\end{itemize}'
+    soup = TexSoup(code)
+
+    # When
+    cache.put(code, soup)
+    tree = cache.get(code)
+
+    # Then
+    assert str(tree) == code
+    assert tree is not cache.get(code)
+    assert tree.itemize.item.args[0].string == 'x'
+    assert tree.section.name.position == soup.section.name.position
+    assert cache.get(code + ' ') is None
+
+
+class Converter(Tex2Cells):
+    def _handle_frametitle(self, node):
+        self.current.source.append('### %s\n' % node.string)
+        return []
+
+
+def _no_parsing(*args):
+    raise AssertionError('should not parse')
+
+
+def test_tree_cache_avoids_parsing(tmpdir, monkeypatch):
+    # Given
+    cache = ConversionCache(str(tmpdir))
+    tree_cache = cache.tree_cache()
+    Tex2Cells(DOCUMENT, tree_cache=tree_cache).parse()
+    tex2ipy_text(DOCUMENT, Tex2Cells, cache)
+    monkeypatch.setattr(tex2cells, 'TexSoup', _no_parsing)
+    monkeypatch.setattr(fastparse, 'parse', _no_parsing)
+
+    # When
+    cells = Converter(DOCUMENT, tree_cache=tree_cache).parse()
+    text = tex2ipy_text(DOCUMENT, Converter, cache, 'changed')
+
+    # Then
+    assert cells[0]['source'][0].startswith('### Foo\n')
+    assert '### Foo' in text
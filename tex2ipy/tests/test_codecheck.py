@@ -0,0 +1,174 @@
+import os
+import subprocess
+import sys
+from textwrap import dedent
+
+import tex2ipy
+from tex2ipy import codecheck
+from tex2ipy.cli import main
+from tex2ipy.codecheck import check_cells, check_source
+from tex2ipy.tex2cells import FrameCache, Tex2Cells
+
+
+DOCUMENT = dedent(r"""
+\documentclass{beamer}
+\begin{document}
+\begin{frame}[fragile]
+\frametitle{Code}
+\begin{lstlisting}
+In []: x = 1
+Out[]: 1
+In []: for i in range(x):
+...:     print i
+\end{lstlisting}
+\end{frame}
+\begin{frame}[fragile]
+\begin{lstlisting}
+In []: %timeit f(x)
+Out[]: 1 loop
+In []: y = (
+\end{lstlisting}
+\end{frame}
+\end{document}
+""")
+
+
+def test_check_source():
+    # When/Then
+    assert check_source('x = 1\nawait f(x)\n') is None
+    lineno, message = check_source('x = 1\nprint x\n')
+    assert lineno == 2
+    assert message.endswith(': print x')
+    assert check_source('if x:\n    !ls\n')[0] == 2
+    assert check_source('if x:\n    !ls\n', magics=True) is None
+    assert check_source('files = !ls\nlen?\n%time f()\n', magics=True) \
+        is None
+    assert check_source('%%bash\nls -l\n', magics=True) is None
+    assert check_source('\n%%time\nx = 1\ny =\n', magics=True)[0] == 4
+    assert check_source('x = 10 % 3\ny = x != 1\n', magics=True) is None
+
+
+def test_check_cells_reports_tex_lines(monkeypatch):
+    # Given
+    cells = Tex2Cells(DOCUMENT).parse_cells()
+
+    # When
+    errors = check_cells(cells, jobs=1)
+
+    # Then
+    lines = DOCUMENT.splitlines()
+    assert [(x[0], x[1]) for x in errors] == [(2, 10), (3, 15), (4, 17)]
+    assert 'print i' in lines[10 - 1]
+    assert '%timeit' in lines[15 - 1]
+
+    # When
+    errors = check_cells(cells, magics=True, jobs=1)
+
+    # Then
+    assert [(x[0], x[1]) for x in errors] == [(2, 10), (4, 17)]
+
+    # When
+    monkeypatch.setattr(codecheck, 'MIN_PARALLEL', 1)
+
+    # Then
+    assert check_cells(cells, magics=True, jobs=2) == errors
+    assert check_cells([c.to_dict() for c in cells], True, 1)[0][1] is None
+
+
+def test_lines_of_cached_frames_follow_the_frame():
+    # Given
+    cache = FrameCache()
+    Tex2Cells(DOCUMENT, frame_cache=cache).parse()
+    code = DOCUMENT.replace(r'\begin{document}', '\\begin{document}\n\n')
+
+    # When
+    cells = Tex2Cells(code, frame_cache=cache).parse_cells()
+
+    # Then
+    assert [c.line for c in cells if c.cell_type == 'code'] == \
+        [9, 11, 17, 19]
+    assert cells == Tex2Cells(code).parse()
+
+
+def test_main_with_check_code(tmpdir, capsys):
+    # Given
+    src = tmpdir.join('talk.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('talk.ipynb')
+
+    # When
+    ret = main(args=[str(src), str(dest), '--check-code', '--magics'])
+
+    # Then
+    assert ret == 1
+    assert dest.check(file=1)
+    out = capsys.readouterr().out
+    assert 'Invalid code cells in %s: 2' % src in out
+    assert '%s:10: cell 3: ' % src in out
+
+    # When
+    src.write(DOCUMENT.replace('print i', 'print(i)').replace('y = (', ''))
+    ret = main(args=[str(src), str(dest), '--check-code', '--magics',
+                     '--no-cache'])
+
+    # Then
+    assert ret is None
+    assert 'Invalid' not in capsys.readouterr().out
+
+
+def test_main_checks_the_cells_converted_once(tmpdir, capsys, monkeypatch):
+    # Given
+    src = tmpdir.join('talk.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('talk.ipynb')
+    calls = []
+    parse_cells = Tex2Cells.parse_cells
+
+    def _parse_cells(self):
+        calls.append(self)
+        return parse_cells(self)
+
+    monkeypatch.setattr(Tex2Cells, 'parse_cells', _parse_cells)
+    args = [str(src), str(dest), '--check-code', '--magics']
+
+    # When
+    ret = main(args=args)
+
+    # Then
+    assert ret == 1
+    assert len(calls) == 1
+    assert '%s:10: cell 3: ' % src in capsys.readouterr().out
+
+    # When
+    del calls[:]
+    ret = main(args=args)
+
+    # Then
+    assert ret == 1
+    assert len(calls) == 0
+    assert '%s:10: cell 3: ' % src in capsys.readouterr().out
+
+    # When
+    ret = main(args=args + ['--split'])
+
+    # Then
+    assert ret == 1
+    assert len(calls) == 1
+    assert '%s:10: cell 3: ' % src in capsys.readouterr().out
+
+
+def test_command_exits_with_error_for_invalid_code(tmpdir):
+    # Given
+    src = tmpdir.join('talk.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('talk.ipynb')
+    root = os.path.dirname(os.path.dirname(tex2ipy.__file__))
+    cmd = [sys.executable, '-m', 'tex2ipy.cli', str(src), str(dest),
+           '--check-code', '--magics', '--no-cache']
+
+    # When
+    proc = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE)
+
+    # Then
+    assert proc.returncode == 1
+    assert b'Invalid code cells' in proc.stdout
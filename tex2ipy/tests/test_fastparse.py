@@ -0,0 +1,177 @@
+import os
+from textwrap import dedent
+
+import pytest
+from TexSoup import TexSoup
+from TexSoup.data import TexExpr, TexText
+
+from tex2ipy import fastparse, tex2cells
+from tex2ipy.fastparse import Unsupported, parse
+from tex2ipy.tex2cells import FrameCache, Tex2Cells, preprocess
+
+
+SAMPLE = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, 'examples', 'sample.tex'
+)
+
+SNIPPETS = [
+    r'\begin{itemize}\item[a] x \item {b} y\end{itemize}',
+    '\\begin{enumerate}\n  \\item 1\n\n  \\item 2\n\\end{enumerate}',
+    r'a \\ b \\item c \% d } stray ] [ open',
+    r'$a$$b$ $$x$$ \(y\) \[z\] $\alpha_{x}^{[2]}$',
+    r'\left( x \right) \big| \Bigg\{ \right.',
+    r'\section*{A} \section[s]{B} {C} \textbf{a}{b} \emph {c}  [d]',
+    '\\foo \n\n {bar} \\baz \n {x} \n [y]',
+    '\\begin{frame}[fragile]{T}\\begin{lstlisting}[x]\n{a}\n$ \\\\\n'
+    '\\end{lstlisting}\\end{frame}',
+    r'\url{http://a.b/{c}} \includegraphics[width=3in]{images/a.png}',
+    r'\begin{align} a &= b \\ c \end{align} \begin{block}{T \textbf{x}}'
+    r' body \end{block}',
+    'tab\there \r\n crlf\r\n\r\n \u00fcn\u00efc\u00f6d\u00e9 \\\\ \\,',
+]
+
+
+def _tree(node):
+    if isinstance(node, TexText):
+        return ('text', str(node), node.position)
+    if isinstance(node, TexExpr):
+        return (
+            type(node).__name__, str(node.name), node.position,
+            [_tree(x) for x in node.args.all],
+            [_tree(x) for x in node._contents],
+        )
+    return str(node)
+
+
+@pytest.mark.parametrize('code', SNIPPETS)
+def test_parse_builds_the_texsoup_tree(code):
+    # When
+    soup = parse(code)
+
+    # Then
+    assert _tree(soup.expr) == _tree(TexSoup(code).expr)
+    assert str(soup) == str(TexSoup(code))
+
+
+def test_parse_sample():
+    # Given
+    with open(SAMPLE) as f:
+        code = preprocess(f.read()).code
+
+    # When
+    soup = parse(code)
+
+    # Then
+    assert _tree(soup.expr) == _tree(TexSoup(code).expr)
+    assert len(list(soup.find_all('frame'))) == code.count('begin{frame}')
+
+
+@pytest.mark.parametrize('code', [
+    r'\begin{tabular}{cc} a & b \end{tabular}', r'\verb|x|',
+    r'\newcommand{\x}{y}', r'\begin{itemize} \item a', r'{unclosed',
+    r'\textbf x', '\\',
+])
+def test_parse_unsupported(code):
+    with pytest.raises(Unsupported):
+        parse(code)
+
+
+def test_fast_engine_falls_back_to_texsoup(monkeypatch):
+    # Given
+    code = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \frametitle{Table}
+    \begin{tabular}{cc} a & b \end{tabular}
+    \end{frame}
+    \begin{frame}
+    \frametitle{List}
+    \begin{itemize}
+    \item $x^2$
+    \end{itemize}
+    \end{frame}
+    \end{document}
+    """)
+    parsed = []
+    original = fastparse.parse
+
+    def _parse(code):
+        try:
+            result = original(code)
+        except Unsupported:
+            parsed.append('texsoup')
+            raise
+        parsed.append('fast')
+        return result
+
+    monkeypatch.setattr(fastparse, 'parse', _parse)
+    expect = Tex2Cells(code, engine='texsoup').parse()
+
+    # When
+    cells = Tex2Cells(code, engine='fast', frame_cache=FrameCache()).parse()
+
+    # Then
+    assert cells == expect
+    assert parsed == ['fast', 'fast', 'texsoup', 'fast']
+
+    # When
+    del parsed[:]
+    cells = Tex2Cells(code, engine='fast').parse()
+
+    # Then
+    assert cells == expect
+    assert parsed == ['fast', 'fast', 'texsoup', 'fast']
+
+
+def test_fast_engine_only_parses_unsupported_frames_with_texsoup(
+        monkeypatch):
+    # Given
+    code = dedent(r"""
+    \title{Talk}
+    \begin{document}
+    \begin{frame}
+    \frametitle{List}
+    \begin{itemize}
+    \item Unknown \foo
+    \end{itemize}
+    \end{frame}
+    \begin{frame}
+    \frametitle{Table}
+    \begin{tabular}{cc} a & b \end{tabular}
+    \end{frame}
+    \begin{frame}
+    \frametitle{Code}
+    \begin{lstlisting}
+    x = 1
+    \end{lstlisting}
+    \end{frame}
+    \end{document}
+    """)
+    expect = Tex2Cells(code, engine='texsoup')
+    expect_cells = expect.parse()
+    parsed = []
+
+    def _texsoup(code):
+        parsed.append(code)
+        return TexSoup(code)
+
+    monkeypatch.setattr(tex2cells, 'TexSoup', _texsoup)
+
+    # When
+    t2c = Tex2Cells(code, engine='fast')
+    cells = t2c.parse()
+
+    # Then
+    assert cells == expect_cells
+    assert t2c.info == expect.info
+    assert t2c.diagnostics.unknown == expect.diagnostics.unknown
+    assert t2c.diagnostics.lines == expect.diagnostics.lines
+    assert len(parsed) == 1
+    assert 'tabular' in parsed[0]
+    assert 'itemize' not in parsed[0]
+    assert 'lstlisting' not in parsed[0]
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        Tex2Cells('', engine='bad')
@@ -0,0 +1,245 @@
+import os
+from textwrap import dedent
+
+import nbformat
+
+from tex2ipy.batch import batch_convert
+from tex2ipy.cache import ConversionCache
+from tex2ipy.cli import main
+from tex2ipy.includes import IncludeResolver, SourceMap, changed_files, \
+    scan_includes
+
+
+DOCUMENT = dedent(r"""
+\documentclass{beamer}
+\begin{document}
+\input{frames/one}
+\end{document}
+""")
+
+ONE = dedent(r"""
+\begin{frame}
+\frametitle{One}
+\include{two.tex} % \input{missing}
+\end{frame}
+""")
+
+TWO = dedent(r"""
+Two
+\begin{lstlisting}
+\input{not_a_file}
+\end{lstlisting}
+""")
+
+
+def _make_files(tmpdir):
+    doc = tmpdir.join('talk.tex')
+    doc.write(DOCUMENT)
+    frames = tmpdir.mkdir('frames')
+    frames.join('one.tex').write(ONE)
+    tmpdir.join('two.tex').write(TWO)
+    return doc
+
+
+def test_scan_includes():
+    # When
+    segments = scan_includes(ONE)
+
+    # Then
+    assert segments == [
+        '\n\\begin{frame}\n\\frametitle{One}\n', ('two.tex',),
+        ' % \\input{missing}\n\\end{frame}\n'
+    ]
+    assert scan_includes(TWO) == [TWO]
+
+
+def test_expand_file_inlines_includes(tmpdir):
+    # Given
+    doc = _make_files(tmpdir)
+    resolver = IncludeResolver()
+
+    # When
+    code = resolver.expand_file(str(doc))
+
+    # Then
+    assert code == DOCUMENT.replace(
+        '\\input{frames/one}', ONE.replace('\\include{two.tex}', TWO)
+    )
+    one = str(tmpdir.join('frames', 'one.tex'))
+    two = str(tmpdir.join('two.tex'))
+    assert resolver.graph[str(doc)] == [one]
+    assert resolver.graph[one] == [two]
+    assert resolver.dependencies(str(doc)) == set([one, two])
+    assert sorted(resolver.stamps(str(doc))) == sorted([str(doc), one, two])
+
+
+def test_source_map_gives_the_file_and_line(tmpdir):
+    # Given
+    doc = _make_files(tmpdir)
+    source_map = SourceMap()
+
+    # When
+    code = IncludeResolver().expand_file(str(doc), source_map)
+
+    # Then
+    lines = code.splitlines()
+    one = str(tmpdir.join('frames', 'one.tex'))
+    two = str(tmpdir.join('two.tex'))
+    assert lines[4] == r'\begin{frame}'
+    assert source_map.lookup(5) == (one, 2)
+    assert lines[7] == 'Two'
+    assert source_map.lookup(8) == (two, 2)
+    assert lines[11] == ' % \\input{missing}'
+    assert source_map.lookup(12) == (one, 4)
+    assert lines[14] == r'\end{document}'
+    assert source_map.lookup(15) == (str(doc), 5)
+    assert source_map.lookup(2) == (str(doc), 2)
+
+
+def test_included_files_are_only_scanned_when_changed(tmpdir):
+    # Given
+    doc = _make_files(tmpdir)
+    resolver = IncludeResolver()
+    resolver.expand_file(str(doc))
+    two = tmpdir.join('two.tex')
+    segments = resolver._files[str(two)].segments
+    stamps = resolver.stamps(str(doc))
+
+    # When
+    st = os.stat(str(two))
+    os.utime(str(two), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    resolver.expand_file(str(doc))
+
+    # Then
+    assert resolver._files[str(two)].segments is segments
+    assert changed_files(stamps) == [str(two)]
+
+    # When
+    two.write('Three\n')
+    code = resolver.expand_file(str(doc))
+
+    # Then
+    assert resolver._files[str(two)].segments == ['Three\n']
+    assert 'Three' in code
+
+
+def test_missing_and_recursive_includes_are_left_alone(tmpdir, caplog):
+    # Given
+    doc = tmpdir.join('talk.tex')
+    doc.write('\\input{talk}\n\\input{missing}\n')
+
+    # When
+    code = IncludeResolver().expand_file(str(doc))
+
+    # Then
+    assert code == '\\input{talk}\n\\input{missing}\n'
+    assert len(caplog.records) == 2
+
+
+def test_main_resolves_includes(tmpdir):
+    # Given
+    doc = _make_files(tmpdir)
+    dest = tmpdir.join('talk.ipynb')
+
+    # When
+    main(args=[str(doc), str(dest)])
+
+    # Then
+    nb = nbformat.read(str(dest), 4)
+    assert nb.cells[0].source.splitlines()[:2] == ['## One', 'Two']
+    assert nb.cells[1].source == '\\input{not_a_file}\n'
+
+
+def test_batch_only_converts_affected_files(tmpdir):
+    # Given
+    src = tmpdir.mkdir('src')
+    _make_files(src)
+    src.join('other.tex').write(DOCUMENT.replace('frames/one', 'three'))
+    src.join('three.tex').write(r'\begin{frame}Three\end{frame}')
+    out = tmpdir.join('out')
+    cache = ConversionCache(str(tmpdir.join('cache')))
+
+    # When
+    result = batch_convert(str(src), str(out), jobs=1, cache=cache)
+
+    # Then
+    assert len(result['files']) == 5
+    assert result['skipped'] == []
+    assert result['failures'] == []
+    # The included files are not documents and are not converted.
+    assert sorted(result['parts']) == sorted(
+        str(src.join(x)) for x in ('frames/one.tex', 'two.tex', 'three.tex')
+    )
+    assert sorted(os.listdir(str(out))) == ['other.ipynb', 'talk.ipynb']
+
+    # When
+    result = batch_convert(str(src), str(out), jobs=1, cache=cache)
+
+    # Then
+    assert len(result['skipped']) == 2
+    assert len(result['parts']) == 3
+
+    # When
+    src.join('two.tex').write('Changed\n')
+    result = batch_convert(str(src), str(out), jobs=1, cache=cache)
+
+    # Then
+    # frames/one.tex includes frames/two.tex when converted on its own.
+    talk = str(src.join('talk.tex'))
+    two = str(src.join('two.tex'))
+    assert result['affected'] == {talk: [two]}
+    converted = set(result['files']) - set(result['skipped']) - \
+        set(result['parts'])
+    assert sorted(converted) == [talk]
+    nb = nbformat.read(str(out.join('talk.ipynb')), 4)
+    assert nb.cells[0].source.splitlines()[1] == 'Changed'
+
+
+def test_main_reports_lines_of_included_files(tmpdir, capsys):
+    # Given
+    doc = tmpdir.join('talk.tex')
+    doc.write(dedent(r"""
+    \begin{document}
+    \input{part}
+    \begin{frame}
+    \bar
+    \end{frame}
+    \end{document}
+    """))
+    tmpdir.join('part.tex').write('\\begin{frame}\nx\n\\foo\n\\end{frame}\n')
+    dest = tmpdir.join('talk.ipynb')
+
+    for args in ([], ['--no-cache']):
+        # When
+        with tmpdir.as_cwd():
+            main(args=['talk.tex', str(dest)] + args)
+
+        # Then
+        out = capsys.readouterr().out
+        assert '\\bar: 1 (line 5)' in out
+        assert '\\foo: 1 (part.tex:3)' in out
+
+
+def test_main_checks_code_of_included_files(tmpdir, capsys):
+    # Given
+    doc = tmpdir.join('talk.tex')
+    doc.write(dedent(r"""
+    \begin{document}
+    \input{part}
+    \end{document}
+    """))
+    tmpdir.join('part.tex').write(dedent(r"""
+    \begin{frame}[fragile]
+    \begin{lstlisting}
+    In []: y = (
+    \end{lstlisting}
+    \end{frame}
+    """))
+
+    # When
+    with tmpdir.as_cwd():
+        ret = main(args=['talk.tex', 'talk.ipynb', '--check-code'])
+
+    # Then
+    assert ret == 1
+    assert 'part.tex:4: cell 1: ' in capsys.readouterr().out
@@ -0,0 +1,189 @@
+from textwrap import dedent
+
+import nbformat
+
+from tex2ipy import macros
+from tex2ipy.cli import main
+from tex2ipy.macros import MacroTable, compile_macros, load_preamble, \
+    map_line
+from tex2ipy.tex2cells import FrameCache, Tex2Cells, preprocess
+
+
+PREAMBLE = dedent(r"""
+\newcommand{\R}{\mathbb{R}}
+\newcommand\vect[2][x]{(#1, #2)}
+% \newcommand{\commented}{oops}
+\def\hello#1{Hello #1}
+""")
+
+DOCUMENT = dedent(r"""
+\documentclass{beamer}
+\providecommand{\R}{R}
+\begin{document}
+\begin{frame}
+\frametitle{\hello{world}}
+$\R^2$ $\vect{y}$ $\vect[a]{b}$ \commented
+\begin{lstlisting}
+\hello{x}
+\end{lstlisting}
+\end{frame}
+\end{document}
+""")
+
+
+def test_expand_definitions():
+    # Given
+    table = MacroTable()
+
+    # When
+    code = table.expand(PREAMBLE + r'\vect[\R]{\hello y} \R{}x')
+
+    # Then
+    assert code.splitlines()[-1] == r'(\mathbb{R}, Hello y) \mathbb{R}x'
+    assert code.count('\n') == PREAMBLE.count('\n')
+    assert table.macros['vect'] == (2, 'x', '(#1, #2)')
+    assert table.macros['hello'] == (1, None, 'Hello #1')
+    assert 'commented' in table
+
+    # When
+    code = table.expand(
+        r'\providecommand{\R}{R}\renewcommand{\hello}[1]{Hi #1}\R \hello a'
+    )
+
+    # Then
+    assert code == r'\mathbb{R} Hi a'
+
+
+def test_expand_skips_spans_and_stops_recursion(caplog):
+    # Given
+    table = MacroTable()
+    table.define('a', body=r'x\a')
+    table.define('b', 1, body='[#1]')
+    code = r'\b{1} \b{2} \b'
+
+    # When
+    result = table.expand(code, skip=[(6, 11)])
+
+    # Then
+    assert result == r'[1] \b{2} \b'
+
+    # When
+    result = table.expand(r'\a')
+
+    # Then
+    assert result == 'x'*table.max_depth + r'\a'
+    assert len(caplog.records) == 1
+
+
+def test_expand_records_changed_lines():
+    # Given
+    table = MacroTable()
+    table.define('two', body='a\nb')
+    table.define('pair', 2, body='(#1, #2)')
+    code = 'x\n\\two y\n\\pair{1}\n{2}\nz\n\\two\n'
+    lines = []
+
+    # When
+    result = table.expand(code, lines=lines)
+
+    # Then
+    assert result == 'x\na\nb y\n(1, 2)\nz\na\nb\n'
+    assert lines == [(3, 2), (4, 4), (7, 6)]
+    expect = [1, 2, 2, 3, 5, 6, 6, 7]
+    assert [map_line(lines, x) for x in range(1, 9)] == expect
+
+
+def test_tex2cells_lines_after_macros_with_newlines():
+    # Given
+    code = dedent(r"""
+    \newcommand{\two}{a
+
+    b}
+    \begin{document}
+    \begin{frame}
+    \two \two
+    \foo
+    \end{frame}
+    \end{document}
+    """)
+
+    for frame_cache in (None, FrameCache()):
+        # When
+        t2c = Tex2Cells(code, frame_cache=frame_cache)
+        t2c.parse()
+
+        # Then
+        assert code.splitlines()[8 - 1] == '\\foo'
+        assert t2c.diagnostics.lines['foo'] == [8]
+
+
+def test_compile_macros_is_memoised(monkeypatch):
+    # Given
+    calls = []
+    parse = MacroTable._parse_definition
+
+    def _parse_definition(self, text, match):
+        calls.append(match.group())
+        return parse(self, text, match)
+
+    monkeypatch.setattr(MacroTable, '_parse_definition', _parse_definition)
+    monkeypatch.setattr(macros, '_tables', macros.OrderedDict())
+    preamble = preprocess(PREAMBLE).code
+
+    # When
+    code, table = compile_macros(preamble)
+    code1, table1 = compile_macros(preamble)
+
+    # Then
+    assert len(calls) == 3
+    assert code1 == code
+    assert table1.macros == table.macros
+    assert table1 is not table
+
+
+def test_tex2cells_uses_preamble(tmpdir):
+    # Given
+    fname = tmpdir.join('preamble.tex')
+    fname.write(PREAMBLE)
+    table = load_preamble(str(fname))
+
+    # When
+    cells = Tex2Cells(DOCUMENT, macros=table).parse()
+
+    # Then
+    assert 'commented' not in table
+    assert cells[0]['source'][0] == '## Hello world\n'
+    assert cells[0]['source'][1] == \
+        r' $\mathbb{R}^2$  $(x, y)$  $(a, b)$ \commented '
+    assert cells[1]['source'] == ['\\hello{x}\n']
+
+    # When
+    t2c = Tex2Cells(DOCUMENT)
+
+    # Then
+    assert t2c.macros.macros == {'R': (0, None, 'R')}
+
+
+def test_main_with_preamble(tmpdir):
+    # Given
+    preamble = tmpdir.join('preamble.tex')
+    preamble.write(PREAMBLE)
+    src = tmpdir.join('talk.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('talk.ipynb')
+    cache_dir = str(tmpdir.join('cache'))
+
+    # When
+    main(args=[str(src), str(dest), '--cache-dir', cache_dir])
+
+    # Then
+    nb = nbformat.read(str(dest), 4)
+    assert nb.cells[0].source.splitlines()[0] == r'## \hello world'
+
+    # When
+    main(args=[str(src), str(dest), '--cache-dir', cache_dir,
+               '--preamble', str(preamble)])
+
+    # Then
+    nb = nbformat.read(str(dest), 4)
+    assert nb.cells[0].source.splitlines()[0] == '## Hello world'
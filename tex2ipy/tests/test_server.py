@@ -0,0 +1,161 @@
+from http.client import HTTPConnection
+import json
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import nbformat
+import pytest
+
+from tex2ipy.cache import ConversionCache
+from tex2ipy.cli import tex2ipy, notebook_text
+from tex2ipy.server import ConversionServer
+
+from .test_tex2ipy import DOCUMENT
+
+
+@pytest.fixture
+def server():
+    server = ConversionServer(('127.0.0.1', 0), jobs=1, max_pending=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def _post(server, data, path='/convert'):
+    host, port = server.server_address[:2]
+    url = 'http://%s:%d%s' % (host, port, path)
+    request = Request(url, data=data.encode('utf-8'), method='POST')
+    with urlopen(request, timeout=30) as response:
+        return response.status, response.read().decode('utf-8')
+
+
+def _wait_for_slots(server):
+    # The slots are released when the conversion is done, which may be just
+    # after the response is sent.
+    for i in range(1000):
+        if server.pending == 0:
+            break
+        time.sleep(0.01)
+    return server.pending
+
+
+def test_server_converts_tex(server):
+    # When
+    status, text = _post(server, DOCUMENT)
+
+    # Then
+    assert status == 200
+    assert text == notebook_text(tex2ipy(DOCUMENT))
+    nb = nbformat.reads(text, 4)
+    assert nb.cells[0].source.splitlines()[0] == '## Foo'
+    assert _wait_for_slots(server) == 0
+
+
+def test_server_reports_errors(server):
+    # When
+    with pytest.raises(HTTPError) as info:
+        _post(server, r'\begin{document}\begin{frame}')
+
+    # Then
+    assert info.value.code == 400
+    assert 'error' in json.loads(info.value.read().decode('utf-8'))
+
+    # When
+    with pytest.raises(HTTPError) as info:
+        _post(server, DOCUMENT, path='/foo')
+
+    # Then
+    assert info.value.code == 404
+
+
+def test_server_reports_server_failures(server):
+    # Given
+    for process in list(server.pool._processes.values()):
+        process.kill()
+        process.join()
+
+    # When
+    with pytest.raises(HTTPError) as info:
+        _post(server, DOCUMENT)
+
+    # Then
+    assert info.value.code == 500
+    assert 'Broken' in json.loads(info.value.read().decode('utf-8'))['error']
+    assert _wait_for_slots(server) == 0
+
+
+def test_server_rejects_negative_lengths(server):
+    # Given
+    host, port = server.server_address[:2]
+    connection = HTTPConnection(host, port, timeout=30)
+
+    # When
+    connection.putrequest('POST', '/convert')
+    connection.putheader('Content-Length', '-1')
+    connection.endheaders()
+    response = connection.getresponse()
+
+    # Then
+    assert response.status == 400
+    connection.close()
+
+
+def test_server_rejects_requests_when_busy(server):
+    # Given
+    assert server.acquire()
+
+    # When
+    with pytest.raises(HTTPError) as info:
+        _post(server, DOCUMENT)
+
+    # Then
+    assert info.value.code == 503
+    assert info.value.headers['Retry-After'] == '1'
+
+    # When
+    server.release()
+    status, text = _post(server, DOCUMENT)
+
+    # Then
+    assert status == 200
+
+
+def test_server_holds_the_slot_of_requests_which_time_out(server):
+    # Given
+    frame = DOCUMENT[DOCUMENT.index(r'\begin{frame}'):
+                     DOCUMENT.index(r'\end{document}')]
+    slow = DOCUMENT.replace(frame, frame*100)
+    server.timeout = 0.01
+
+    # When
+    with pytest.raises(HTTPError) as info:
+        _post(server, slow)
+
+    # Then
+    assert info.value.code == 504
+    with pytest.raises(HTTPError) as info:
+        _post(server, DOCUMENT)
+    assert info.value.code == 503
+    assert _wait_for_slots(server) == 0
+
+
+def test_server_prunes_the_cache(tmpdir, monkeypatch):
+    # Given
+    pruned = threading.Event()
+    monkeypatch.setattr(ConversionCache, 'maybe_prune',
+                        lambda self: pruned.set())
+    cache = ConversionCache(str(tmpdir))
+    cache.prune_interval = 0.01
+
+    # When
+    server = ConversionServer(('127.0.0.1', 0), jobs=1, cache=cache)
+    try:
+        # Then
+        assert pruned.wait(10)
+    finally:
+        server.server_close()
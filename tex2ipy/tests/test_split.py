@@ -0,0 +1,123 @@
+from textwrap import dedent
+
+import nbformat
+
+from tex2ipy.cli import main
+from tex2ipy.split import part_titles, split_cells, write_split
+from tex2ipy.tex2cells import Cell, Tex2Cells
+
+
+DOCUMENT = dedent(r"""
+\documentclass{beamer}
+\title{Talk}
+\author{Ty Coon}
+\begin{document}
+\begin{frame}
+\titlepage
+\end{frame}
+\section{One}
+\begin{frame}
+\frametitle{A}
+\begin{itemize}
+\item a \pause
+\item b
+\end{itemize}
+\end{frame}
+\begin{frame}
+\frametitle{B}
+\end{frame}
+\section{Two}
+\begin{frame}
+\frametitle{C}
+\end{frame}
+\end{document}
+""")
+
+
+def _sources(parts):
+    return [[cell['source'][0] for cell in part] for part in parts]
+
+
+def test_split_cells_at_sections():
+    # Given
+    cells = Tex2Cells(DOCUMENT).parse_cells()
+
+    # When
+    parts = split_cells(cells)
+
+    # Then
+    assert _sources(parts) == [
+        ['# Talk\n'],
+        ['## One\n', '## A\n', '* b\n', '## B\n'],
+        ['## Two\n', '## C\n'],
+    ]
+    assert part_titles(parts) == ['Part 1', 'One', 'Two']
+
+
+def test_split_cells_by_size_only_at_slides():
+    # Given
+    cells = Tex2Cells(DOCUMENT).parse_cells()
+
+    # When
+    parts = split_cells(cells, by_section=False, max_cells=1)
+
+    # Then
+    assert _sources(parts) == [
+        ['# Talk\n'], ['## One\n'], ['## A\n', '* b\n'], ['## B\n'],
+        ['## Two\n'], ['## C\n']
+    ]
+    assert part_titles(parts)[3] == 'One (continued)'
+
+    # When
+    parts = split_cells(cells, by_section=False, max_bytes=20)
+
+    # Then
+    assert len(parts) == 3
+    assert _sources(parts)[1] == ['## One\n', '## A\n', '* b\n']
+
+    # When
+    parts = split_cells([Cell(), Cell(), Cell(slide_type='-')], max_cells=1)
+
+    # Then
+    assert [len(x) for x in parts] == [1, 2]
+
+
+def test_write_split(tmpdir):
+    # Given
+    output = tmpdir.join('talk.ipynb')
+
+    # When
+    paths = write_split(DOCUMENT, str(output), jobs=1)
+
+    # Then
+    names = ['talk.ipynb', 'talk_01.ipynb', 'talk_02.ipynb', 'talk_03.ipynb']
+    assert paths == [str(tmpdir.join(x)) for x in names]
+    index = nbformat.read(str(output), 4)
+    nbformat.validate(index)
+    assert index.metadata.tex2ipy.parts == names[1:]
+    assert index.cells[1].source.splitlines() == [
+        '1. [Part 1](talk_01.ipynb)', '2. [One](talk_02.ipynb)',
+        '3. [Two](talk_03.ipynb)'
+    ]
+    nb = nbformat.read(str(tmpdir.join('talk_03.ipynb')), 4)
+    nbformat.validate(nb)
+    assert nb.metadata.tex2ipy == dict(
+        title='Talk', author='Ty Coon', part=3, parts=3, section='Two'
+    )
+    assert nb.cells[0].source == '# Talk\n\n**Ty Coon**\n'
+    assert nb.cells[1].source == '## Two\n'
+
+
+def test_main_with_split_output(tmpdir):
+    # Given
+    src = tmpdir.join('talk.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('talk.ipynb')
+
+    # When
+    main(args=[str(src), str(dest), '--max-cells', '2', '-j', '2'])
+
+    # Then
+    assert dest.check(file=1)
+    assert tmpdir.join('talk_04.ipynb').check(file=1)
+    assert not tmpdir.join('talk_05.ipynb').check()
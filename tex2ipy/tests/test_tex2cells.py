@@ -1,8 +1,20 @@
+from io import StringIO
+import json
+import logging
 import os
+import pickle
+import re
+import time
 from textwrap import dedent
 
-from tex2ipy.tex2cells import Tex2Cells, get_all_listings, \
-    get_real_image_from_path, remove_comments
+from TexSoup import TexSoup
+from TexSoup.data import TexEnv, TexNode, TexText
+
+from tex2ipy.profiling import Profile
+from tex2ipy.tex2cells import Cell, CellSource, Diagnostics, FrameCache, \
+    ImageResolver, Tex2Cells, get_all_listings, get_real_image_from_path, \
+    clear_newline, handles, index_nodes, preprocess, remove_comments, \
+    split_frames, to_node
 
 
 def test_get_all_listings():
@@ -68,6 +80,65 @@ def test_get_real_image_from_path(tmpdir):
     img.remove()
 
 
+def test_image_resolver(tmpdir, monkeypatch):
+    # Given
+    for name in ('b.svg', 'b.PNG', 'c.gif', 'c.jpg', 'd.xpm', 'e.png'):
+        tmpdir.join(name).write('')
+    calls = []
+    listdir = os.listdir
+
+    def _listdir(path):
+        calls.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, 'listdir', _listdir)
+    resolver = ImageResolver()
+    path = str(tmpdir)
+
+    # When/Then
+    assert resolver.resolve(os.path.join(path, 'b')) == \
+        os.path.join(path, 'b.PNG')
+    assert resolver.resolve(os.path.join(path, 'c')) == \
+        os.path.join(path, 'c.jpg')
+    assert resolver.resolve(os.path.join(path, 'd')) == \
+        os.path.join(path, 'd')
+    assert resolver.resolve(os.path.join(path, 'e.png')) == \
+        os.path.join(path, 'e.png')
+    assert resolver.resolve('e', search_paths=['nowhere', path]) == \
+        os.path.join(path, 'e.png')
+    assert calls.count(path) == 1
+
+    # Given a different priority.
+    resolver = ImageResolver(formats=['svg', 'gif', 'png'])
+
+    # When/Then
+    assert resolver.resolve(os.path.join(path, 'b')) == \
+        os.path.join(path, 'b.svg')
+    assert resolver.resolve(os.path.join(path, 'c')) == \
+        os.path.join(path, 'c.gif')
+
+
+def test_graphicspath_is_used_to_find_images(tmpdir):
+    # Given
+    tmpdir.mkdir('figs').join('img1.png').write('')
+    figs = tmpdir.join('figs')
+    doc = dedent(r"""
+    \graphicspath{{%s/}{%s/}}
+    \begin{document}
+    \begin{frame}
+    \includegraphics{img1}
+    \end{frame}
+    \end{document}
+    """ % (str(tmpdir), str(figs)))
+
+    # When
+    cells = Tex2Cells(doc).parse()
+
+    # Then
+    image = os.path.join(str(figs), 'img1.png')
+    assert cells[0]['source'] == ['<img src="%s"/>\n' % image]
+
+
 def test_remove_comments():
     # Given
     doc = dedent(r"""
@@ -85,6 +156,52 @@ def test_remove_comments():
     assert doc == expect
 
 
+def _old_clear_newline(s):
+    # The implementation clear_newline replaces.
+    x = re.search(r'(.*)(\s+)', s)
+    if x and '\n' in x.groups()[1]:
+        s = s.rstrip() + '\n'
+    else:
+        s = s.rstrip()
+    if s.startswith(('\n', '\r')):
+        return s.lstrip()
+    return s
+
+
+def test_clear_newline():
+    # Given
+    texts = [
+        '', ' ', '\n', ' \n ', 'a', ' a ', 'a\n', '\na', '\n a b \n ',
+        'a\nb', 'a \r\n', '\ra ', 'a\rb ', '\t\x0ba\x0c\x85', 'a\u2028 ',
+    ]
+
+    # When/Then
+    for text in texts:
+        assert clear_newline(text) == _old_clear_newline(text), repr(text)
+
+
+def test_clear_newline_is_linear():
+    # Given
+    n = 10**6
+    texts = ['x'*n, 'x'*n + ' ', ' '*n + 'x', 'x \t'*(n//3), '\r'*n]
+    line = 'x'*30000
+    doc = '\\begin{document}\\begin{frame}%s\\end{frame}\\end{document}' \
+        % line
+
+    # When
+    start = time.perf_counter()
+    results = [clear_newline(text) for text in texts]
+    cells = Tex2Cells(doc).parse()
+    elapsed = time.perf_counter() - start
+
+    # Then
+    # The old regex took about a second for just 8000 characters and over
+    # ten for the document.
+    assert elapsed < 3
+    assert results[:3] == ['x'*n, 'x'*n, ' '*n + 'x']
+    assert cells[0]['source'] == [line]
+
+
 def test_lstlisting_with_output_should_make_multiple_cells():
     # Given
     doc = dedent(r"""
@@ -268,6 +385,64 @@ def test_titlepage_is_created_when_title_is_outside_document():
     assert src[6] == '**date**\n'
 
 
+def test_index_nodes_finds_nodes_like_find_all():
+    # Given
+    soup = TexSoup(dedent(r"""
+    \title{a \title{b}} {\title{c}}
+    \begin{document}
+    \begin{frame}\title{d}\begin{block}{x}\title{e}\end{block}\end{frame}
+    \title{f}
+    \end{document}
+    """))
+    names = ['title', 'document', 'block', 'missing']
+
+    # When
+    index = index_nodes(soup, names)
+
+    # Then
+    for name in names:
+        expect = list(soup.find_all(name))
+        assert [repr(x) for x in index[name]] == [repr(x) for x in expect]
+        assert [x.parent.name for x in index[name]] == \
+            [x.parent.name for x in expect]
+    assert len(index['title']) == 6
+
+
+def test_preamble_is_found_in_one_pass(monkeypatch):
+    # Given
+    class Converter(Tex2Cells):
+        preamble_nodes = Tex2Cells.preamble_nodes + ('subtitle',)
+
+        @handles('subtitle')
+        def _handle_subtitle(self, node):
+            self.info['subtitle'] = node.string
+            return True
+
+    doc = dedent(r"""
+    \title{foo}
+    \subtitle{bar}
+    \begin{document}
+    \begin{frame}
+    \titlepage
+    \end{frame}
+    \end{document}
+    """)
+
+    def _find_all(self, *args, **kw):
+        raise AssertionError('find_all should not be used')
+
+    monkeypatch.setattr(TexNode, 'find_all', _find_all)
+
+    for frame_cache in (None, FrameCache()):
+        # When
+        t2c = Converter(doc, frame_cache=frame_cache)
+        cells = t2c.parse()
+
+        # Then
+        assert t2c.info['subtitle'] == 'bar'
+        assert cells[0]['source'][0] == '# foo\n'
+
+
 def test_itemize_enumerate_works():
     # Given
     doc = dedent(r"""
@@ -734,6 +909,42 @@ def test_unknown_macro_should_be_in_source():
     assert len(cells) == 1
     src = cells[0]['source']
     assert src == ['\\something \\other hello']
+    diagnostics = t2c.diagnostics
+    assert diagnostics.unknown == dict(something=1, other=1)
+    assert diagnostics.lines == dict(something=[4], other=[5])
+
+
+def test_diagnostics_are_collected_with_frame_cache(caplog):
+    # Given
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    a \foo % \bar
+    \end{frame}
+    \begin{frame}
+    \foo{x}
+    \end{frame}
+    \end{document}
+    """)
+    diagnostics = Diagnostics()
+
+    # When
+    with caplog.at_level(logging.DEBUG, logger='tex2ipy.tex2cells'):
+        Tex2Cells(doc, frame_cache=FrameCache(),
+                  diagnostics=diagnostics).parse()
+        Tex2Cells(doc, diagnostics=diagnostics).parse()
+
+    # Then
+    assert diagnostics.unknown == dict(foo=4)
+    assert diagnostics.lines == dict(foo=[4, 7, 4, 7])
+    assert len(caplog.records) == 4
+    assert caplog.records[0].getMessage() == 'No handler for foo at line 4'
+    stream = StringIO()
+    diagnostics.report(stream)
+    assert stream.getvalue().splitlines() == [
+        'Unknown macros: 1 distinct, 4 uses',
+        '  \\foo: 4 (lines 4, 7, 4, 7)'
+    ]
 
 
 def test_block_is_handled():
@@ -800,3 +1011,612 @@ def test_title_can_have_text_embellishments():
     src = cells[0]['source']
     print(src)
     assert src[0] == '## *emph* **bold**  $\\alpha$ `print` \n'
+
+
+def test_split_frames():
+    # Given
+    doc = dedent(r"""
+    \title{foo}
+    \begin{document}
+    \section{Intro}
+    \begin{frame}
+    \begin{lstlisting}
+    \begin{frame}
+    \end{lstlisting}
+    \end{frame}
+    \begin{frame}
+    hello
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    preamble, chunks = split_frames(doc)
+
+    # Then
+    assert preamble == '\n\\title{foo}\n'
+    assert len(chunks) == 3
+    assert chunks[0] == '\n\\section{Intro}\n'
+    assert chunks[1].startswith('\\begin{frame}\n\\begin{lstlisting}')
+    assert chunks[2] == '\\begin{frame}\nhello\n\\end{frame}\n'
+
+    # Given no document.
+    assert split_frames('hello') == ('hello', None)
+
+
+def test_frame_cache_reuses_unchanged_frames():
+    # Given
+    class Converter(Tex2Cells):
+        frames_are_independent = True
+        frames = 0
+
+        def _handle_frame(self, node):
+            Converter.frames += 1
+            return super(Converter, self)._handle_frame(node)
+
+    template = dedent(r"""
+    \title{foo}
+    \begin{document}
+    \begin{frame}
+    \titlepage
+    \end{frame}
+    \section{Intro}
+    \begin{frame}
+    \frametitle{One}
+    \begin{lstlisting}
+    In []: 1
+    \end{lstlisting}
+    \end{frame}
+    \begin{frame}
+    \frametitle{%s}
+    \end{frame}
+    \end{document}
+    """)
+    doc = template % 'Two'
+    cache = FrameCache()
+    expect = Tex2Cells(doc).parse()
+
+    # When
+    cells = Converter(doc, frame_cache=cache).parse()
+
+    # Then
+    assert cells == expect
+    assert Converter.frames == 3
+
+    # When
+    Converter.frames = 0
+    cells = Converter(template % 'Three', frame_cache=cache).parse()
+
+    # Then
+    assert Converter.frames == 1
+    assert cells == Tex2Cells(template % 'Three').parse()
+    assert cells[-1]['source'][0] == '## Three\n'
+
+
+def test_frame_cache_is_only_used_for_independent_frames():
+    # Given
+    class Numbered(Tex2Cells):
+        def _handle_document(self, node):
+            super(Numbered, self)._handle_document(node)
+            self.slides = 0
+            self._make_cell()
+            self.current['source'].append('# Header\n')
+
+        def _handle_frametitle(self, node):
+            self.slides += 1
+            self.current['source'].append('## Slide %d\n' % self.slides)
+            return True
+
+    template = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \frametitle{One}
+    \end{frame}
+    \begin{frame}
+    \frametitle{%s}
+    \end{frame}
+    \end{document}
+    """)
+    cache = FrameCache()
+    Numbered(template % 'Two', frame_cache=cache).parse()
+    code = template % 'Three'
+
+    # When
+    cells = Numbered(code, frame_cache=cache).parse()
+
+    # Then
+    sources = [c['source'][-1] for c in cells]
+    assert sources == ['# Header\n', '## Slide 1\n', '## Slide 2\n']
+    assert len(cache) == 0
+    assert cells == Numbered(code).parse()
+
+
+def test_frame_cache_calls_the_document_handler():
+    # Given
+    class Converter(Tex2Cells):
+        frames_are_independent = True
+
+        def _handle_document(self, node):
+            super(Converter, self)._handle_document(node)
+            self._make_cell()
+            self.current['source'].append('# Header\n')
+
+    code = GROUPED_FRAME.replace('{\\setbeamertemplate{background}{}', '')
+    code = code.replace('\\end{frame}}', '\\end{frame}')
+    cache = FrameCache()
+
+    # When
+    cells = Converter(code, frame_cache=cache).parse()
+
+    # Then
+    assert cells[0]['source'] == ['# Header\n']
+    assert cells == Converter(code).parse()
+    assert len(cache) == 3
+
+
+GROUPED_FRAME = dedent(r"""
+\documentclass{beamer}
+\title{foo}
+\begin{document}
+\begin{frame}
+\frametitle{One}
+Hello
+\end{frame}
+{\setbeamertemplate{background}{}
+\begin{frame}
+\frametitle{Two}
+World
+\end{frame}}
+\end{document}
+""")
+
+
+def test_is_balanced():
+    # Given
+    pre = preprocess(dedent(r"""
+    \begin{frame}{a \{ b}
+    \begin{lstlisting}
+    {
+    \end{lstlisting}
+    \end{frame}
+    {\begin{frame}\end{frame}
+    }\begin{itemize}\end{enumerate}
+    """))
+    code = pre.code
+    starts = [m.start() for m in re.finditer(r'\\begin\{frame\}', code)]
+    end = code.index(r'\begin{itemize}')
+
+    # When/Then
+    assert pre.is_balanced(starts[0], starts[1] - 1)
+    assert not pre.is_balanced(starts[0], starts[1])
+    assert pre.is_balanced(starts[1] - 1, end)
+    assert not pre.is_balanced(starts[1], end)
+    assert not pre.is_balanced(end, len(code))
+
+
+def test_frame_cache_with_frames_in_a_group():
+    # Given
+    expect = Tex2Cells(GROUPED_FRAME).parse()
+
+    # When
+    cells = Tex2Cells(GROUPED_FRAME, frame_cache=FrameCache()).parse()
+
+    # Then
+    assert cells == expect
+    assert cells[-1]['source'][0] == '## Two\n'
+
+
+def test_frame_cache_checks_the_images(tmpdir):
+    # Given
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \includegraphics{%s}
+    \end{frame}
+    \end{document}
+    """) % tmpdir.join('fig')
+    cache = FrameCache()
+    t2c = Tex2Cells(doc, frame_cache=cache)
+    t2c.parse()
+    assert t2c.images == {(str(tmpdir.join('fig')), ()): tmpdir.join('fig')}
+
+    # When
+    tmpdir.join('fig.png').write('')
+    cells = Tex2Cells(doc, frame_cache=cache).parse()
+
+    # Then
+    assert cells[0]['source'] == ['<img src="%s"/>\n' % tmpdir.join('fig.png')]
+
+
+def test_iter_cells_yields_same_cells_as_parse():
+    # Given
+    doc = dedent(r"""
+    \documentclass{beamer}
+    \title{foo}
+    \begin{document}
+    \begin{frame}
+    \titlepage
+    \end{frame}
+    \section{Intro}
+    \begin{frame}
+    \frametitle{One}
+    \begin{lstlisting}
+    In []: 1
+    Out[]: 1
+    In []: 2
+    \end{lstlisting}
+    \end{frame}
+    \begin{frame}
+    \begin{itemize}
+    \item a \pause
+    \item b
+    \end{itemize}
+    \end{frame}
+    \end{document}
+    """)
+    expect = Tex2Cells(doc).parse()
+
+    # When
+    t2c = Tex2Cells(doc)
+    cells = t2c.iter_cells()
+
+    # Then
+    first = next(cells)
+    assert first == expect[0]
+    assert [first] + list(cells) == expect
+    assert t2c.cells == []
+
+
+def test_iter_cells_parses_the_document_if_frames_cannot_be_split(
+        monkeypatch):
+    # Given
+    expect = Tex2Cells(GROUPED_FRAME).parse()
+
+    # When
+    cells = list(Tex2Cells(GROUPED_FRAME).iter_cells())
+
+    # Then
+    assert cells == expect
+
+    # Given
+    doc = GROUPED_FRAME.replace('{\\set', '\\set').replace('}}', '}')
+    expect = Tex2Cells(doc).parse()
+    parse_tex = Tex2Cells._parse_tex
+
+    def _parse_tex(self, code):
+        if code.startswith('\\begin{frame}') and 'World' in code:
+            raise TypeError('Malformed argument')
+        return parse_tex(self, code)
+
+    monkeypatch.setattr(Tex2Cells, '_parse_tex', _parse_tex)
+
+    # When
+    cells = Tex2Cells(doc).iter_cells()
+    first = next(cells)
+
+    # Then
+    assert [first] + list(cells) == expect
+    assert len(expect) == 2
+
+
+def test_handlers_can_be_registered_with_decorator():
+    # Given
+    class Converter(Tex2Cells):
+        @handles('foo', 'bar*')
+        def _handle_custom(self, node):
+            self.current['source'].append('custom %s\n' % node.name)
+            return True
+
+        def _handle_equation(self, node):
+            self.current['source'].append('equation\n')
+            return True
+
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \foo{x}
+    \bar*{y}
+    \begin{equation}
+    x
+    \end{equation}
+    \begin{align}
+    y
+    \end{align}
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    cells = Converter(doc).parse()
+
+    # Then
+    # The align environment still uses Tex2Cells._handle_align.
+    src = cells[0]['source']
+    assert src == ['custom foo\n', 'custom bar*\n', 'equation\n', '$$\n',
+                   'y\n', '$$\n']
+    assert Converter._get_handler_name('foo') == '_handle_custom'
+    assert Converter._get_handler_name('align') == '_handle_align'
+    assert Converter._get_handler_name('blah') is None
+    assert 'blah' in Converter._dispatch_table
+    assert Tex2Cells._get_handler_name('foo') is None
+
+
+def test_handler_aliases_are_kept():
+    # Given
+    class Converter(Tex2Cells):
+        _handle_code = Tex2Cells._handle_lstinline
+
+        def _handle_texttt(self, node):
+            self.append_inline('TT')
+            return True
+
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \texttt{a} \lstinline{b} \code{c} \typ{d}
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    cells = Converter(doc).parse()
+
+    # Then
+    assert cells[0]['source'] == ['TT`b` `c` `d` ']
+    for name in ('enumerate', 'includegraphics', 'author', 'vspace', 'media',
+                 'center', 'verbatim', 'BackgroundPicture', 'kwrd', 'py'):
+        assert callable(getattr(Tex2Cells, '_handle_%s' % name))
+
+
+def test_walk_handles_deeply_nested_nodes():
+    # Given
+    expr = TexText('deep\n')
+    for i in range(5000):
+        expr = TexEnv(
+            'minipage', r'\begin{minipage}', r'\end{minipage}',
+            contents=[expr]
+        )
+    t2c = Tex2Cells('')
+    t2c._make_cell()
+
+    # When
+    t2c._walk(TexNode(expr))
+
+    # Then
+    assert t2c.cells[0]['source'] == ['deep\n']
+
+
+def test_handler_can_return_nodes_and_callables_to_walk():
+    # Given
+    class Converter(Tex2Cells):
+        def _handle_alert(self, node):
+            src = self.current['source']
+            src.append('<')
+
+            def end():
+                src[-1] += '>'
+
+            return list(node.contents) + [end]
+
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \alert{hello \emph{world}}
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    cells = Converter(doc).parse()
+
+    # Then
+    assert cells[0]['source'] == ['<hello*world* >']
+
+
+def test_cell_source_behaves_like_a_list():
+    # Given
+    src = CellSource()
+
+    # When
+    src.append_inline('a')
+    src.append_inline('b')
+    src.append('c')
+    src[-1] += 'd'
+    src.append_inline('e')
+    src[0] = 'x'
+
+    # Then
+    assert len(src) == 2
+    assert src == ['x', 'cde']
+    assert src[-2] == 'x'
+    assert src[-1] == 'cde'
+    assert list(src) == ['x', 'cde']
+    assert src.to_list() == ['x', 'cde']
+    assert len(CellSource()) == 0
+    assert CellSource(['a', 'b']) == ['a', 'b']
+
+    # When
+    src.append_inline('f')
+    src.insert(0, 'w')
+    src += ['y', 'z']
+
+    # Then
+    assert src == ['w', 'x', 'cdef', 'y', 'z']
+    assert src.index('cdef') == 2
+    assert src.pop() == 'z'
+    src.remove('x')
+    assert src == ['w', 'cdef', 'y']
+    src.append_inline('g')
+    assert src[1:] == ['cdef', 'yg']
+    src[:] = ['a', 'b']
+    src.append_inline('c')
+    assert src == ['a', 'bc']
+    del src[0]
+    assert src == ['bc']
+    src.clear()
+    assert len(src) == 0
+    src.append_inline('h')
+    assert src == ['h']
+
+
+def test_parse_returns_dictionaries():
+    # Given
+    import nbformat
+    from nbformat.v4 import new_notebook
+    code = dedent(r"""
+    \begin{document}
+    \begin{frame}[fragile]
+    \frametitle{Foo}
+    \begin{lstlisting}
+    In []: x = 1
+    \end{lstlisting}
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    cells = Tex2Cells(code).parse()
+
+    # Then
+    assert all(type(cell) is dict for cell in cells)
+    assert json.loads(json.dumps(cells)) == cells
+    nb = new_notebook(cells=nbformat.from_dict(cells))
+    fp = StringIO()
+    nbformat.write(nb, fp)
+    nb = nbformat.reads(fp.getvalue(), 4)
+    assert [c.cell_type for c in nb.cells] == ['markdown', 'code']
+    assert nb.cells[1].source == 'x = 1\n'
+    assert Tex2Cells(code).parse_cells() == cells
+
+
+def test_cell_behaves_like_a_dict():
+    # Given
+    cell = Cell('markdown', 'fragment')
+    cell['source'].append('a')
+
+    # When
+    md = cell.to_dict()
+
+    # Then
+    assert md == dict(
+        cell_type='markdown', source=['a'],
+        metadata=dict(slideshow=dict(slide_type='fragment'))
+    )
+    assert cell == md
+    assert sorted(cell) == ['cell_type', 'metadata', 'source']
+    assert 'outputs' not in cell
+    assert cell._metadata is None
+
+    # When
+    cell['cell_type'] = 'code'
+    cell['metadata']['slideshow']['slide_type'] = '-'
+    cell['metadata']['extra'] = 1
+    node = cell.to_node()
+
+    # Then
+    assert cell.slide_type == '-'
+    assert node.metadata.slideshow.slide_type == '-'
+    assert node.metadata.extra == 1
+    assert node.outputs == []
+    assert node.execution_count is None
+    assert dict(cell) == cell.to_dict()
+    assert pickle.loads(pickle.dumps(cell)) == cell
+    assert to_node(cell.to_dict()) == node
+
+
+def test_append_inline_and_new_line_in_handlers():
+    # Given
+    class Converter(Tex2Cells):
+        def _handle_alert(self, node):
+            self.append_inline('!%s!' % node.string)
+            self.new_line('next')
+            return True
+
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    hello \alert{world}
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    cells = Converter(doc).parse()
+
+    # Then
+    assert cells[0]['source'] == ['hello\n!world!', 'next']
+
+
+def test_preprocess_leaves_listings_alone():
+    # Given
+    doc = dedent(r"""
+    \begin{document}%start
+    \begin{frame}
+    \[x\] 50\% done
+    \begin{lstlisting}
+    In []: print("%d" % 1)  # \[0\]
+    \end{lstlisting}
+    \end{frame}
+    \end{document}
+    """)
+
+    # When
+    pre = preprocess(doc)
+
+    # Then
+    expect = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \begin{equation*}x\end{equation*} 50\% done
+    \begin{lstlisting}
+    In []: print("%d" % 1)  # \[0\]
+    \end{lstlisting}
+    \end{frame}
+    \end{document}
+    """)
+    assert pre.code == expect
+    assert len(pre.listings) == 1
+    start, end = pre.listings[0]
+    assert pre.code[start:end] == 'In []: print("%d" % 1)  # \\[0\\]\n'
+    assert pre.code[pre.begin_document:].startswith(r'\begin{document}')
+    assert pre.code[pre.end_document:] == '\\end{document}\n'
+    assert pre.frames == [expect.index(r'\begin{frame}')]
+
+    # When
+    cells = Tex2Cells(doc).parse()
+
+    # Then
+    assert cells[0]['source'][1] == 'x'
+    assert cells[1]['source'] == ['print("%d" % 1)  # \\[0\\]\n']
+
+
+def test_profile_records_handlers_and_nodes():
+    # Given
+    doc = dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \begin{itemize}
+    \item a \foo
+    \item b
+    \end{itemize}
+    \end{frame}
+    \end{document}
+    """)
+    expect = Tex2Cells(doc).parse()
+    profile = Profile()
+
+    # When
+    cells = Tex2Cells(doc, profile=profile).parse()
+
+    # Then
+    assert cells == expect
+    assert profile.handlers['_handle_item'][0] == 2
+    assert profile.handlers['_handle_itemize'][0] == 1
+    assert profile.handlers['_handle_unknown'][0] == 1
+    assert profile.handlers['_handle_str'][0] >= 2
+    assert profile.nodes['item'][0] == 2
+    assert profile.nodes['frame'][0] == 1
+    assert profile.nodes['frame'][1] >= profile.nodes['itemize'][1] > 0
+    assert profile._active == dict(
+        document=0, frame=0, itemize=0, item=0, foo=0
+    )
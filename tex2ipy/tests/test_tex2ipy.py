@@ -1,10 +1,16 @@
 from io import StringIO
+import json
+import os
+import subprocess
+import sys
 from textwrap import dedent
 
 import nbformat
+import pytest
 
 from tex2ipy.tex2cells import Tex2Cells
-from tex2ipy.cli import tex2ipy, main, get_tex2cells_subclass
+from tex2ipy.cli import tex2ipy, tex2ipy_stream, main, merge_outputs, \
+    notebook_text, get_tex2cells_subclass
 
 
 DOCUMENT = dedent(r"""
@@ -76,6 +82,32 @@ def test_main_with_no_options(tmpdir):
     assert dest.check(file=1)
 
 
+def test_main_with_frames_in_a_group(tmpdir):
+    # Given
+    src = tmpdir.join('test.tex')
+    src.write(dedent(r"""
+    \begin{document}
+    \begin{frame}
+    \frametitle{One}
+    \end{frame}
+    {\setbeamertemplate{background}{}
+    \begin{frame}
+    \frametitle{Two}
+    \end{frame}}
+    \end{document}
+    """))
+    dest = tmpdir.join('test.ipynb')
+    other = tmpdir.join('other.ipynb')
+
+    # When
+    main(args=[str(src), str(dest)])
+    main(args=[str(src), str(other), '--no-cache'])
+
+    # Then
+    assert dest.read() == other.read()
+    assert nbformat.read(str(dest), 4).cells[1].source == '## Two\n'
+
+
 def test_main_with_options(tmpdir):
     # Given
     code = dedent("""
@@ -101,3 +133,225 @@ def test_main_with_options(tmpdir):
     src = nb.cells[0].source.splitlines()
     assert src[0] == '## Overloaded'
     assert src[1] == '## Foo'
+
+
+def test_main_with_profile(tmpdir, capsys):
+    # Given
+    src = tmpdir.join('test.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('test.ipynb')
+    prof = tmpdir.join('profile.json')
+
+    # When
+    main(args=[str(src), str(dest), '--profile', '--profile-json', str(prof)])
+
+    # Then
+    assert dest.check(file=1)
+    out = capsys.readouterr().out
+    assert '_handle_frame' in out
+    data = json.loads(prof.read())
+    stages = ['from_dict', 'preprocess', 'save', 'texsoup', 'walk', 'write']
+    assert sorted(data['stages']) == stages
+    assert data['handlers']['_handle_frametitle']['calls'] == 1
+    assert data['nodes']['frame']['calls'] == 1
+
+
+def test_notebook_text_matches_nbformat():
+    # Given
+    code = DOCUMENT.replace('Hello world', dedent(r"""
+    \begin{lstlisting}
+    In []: print(1)
+    \end{lstlisting}
+    """))
+    nb = tex2ipy(code)
+    nb.cells[0].source = 'one\ntwo\n'
+    expect = nbformat.writes(nb) + '\n'
+
+    # When
+    text = notebook_text(nb, validate=True)
+
+    # Then
+    assert text == expect
+    assert nb.cells[0].source == ['one\n', 'two\n']
+
+
+def test_main_with_validate(tmpdir):
+    # Given
+    code = dedent("""
+    from tex2ipy.tex2cells import Tex2Cells
+    class Converter(Tex2Cells):
+        def _handle_frame(self, node):
+            super(Converter, self)._handle_frame(node)
+            self.current['cell_type'] = 'bogus'
+    """)
+    convert = tmpdir.join('extra.py')
+    convert.write(code)
+    src = tmpdir.join('test.tex')
+    src.write(DOCUMENT)
+    dest = tmpdir.join('test.ipynb')
+
+    # When
+    main(args=[str(src), str(dest), '-c', str(convert), '--no-cache'])
+
+    # Then
+    assert dest.check(file=1)
+
+    # When
+    dest.remove()
+    with pytest.raises(nbformat.ValidationError):
+        main(args=[str(src), str(dest), '-c', str(convert), '--no-cache',
+                   '--validate'])
+
+    # Then
+    assert not dest.check()
+
+
+def test_tex2ipy_stream_matches_nbformat(tmpdir):
+    # Given
+    sample = os.path.join(
+        os.path.dirname(__file__), os.pardir, os.pardir, 'examples',
+        'sample.tex'
+    )
+    with open(sample) as fp:
+        code = fp.read()
+    grouped = '\\begin{document}{\\begin{frame}x\\end{frame}}\\end{document}'
+    for doc in (DOCUMENT, code, '\\begin{document}\\end{document}', grouped):
+        expect = nbformat.writes(tex2ipy(doc)) + '\n'
+
+        # When
+        stream = StringIO()
+        tex2ipy_stream(doc, stream)
+
+        # Then
+        assert stream.getvalue() == expect
+
+
+LISTINGS = DOCUMENT.replace('Hello world', dedent(r"""
+\begin{lstlisting}
+In []: x = 1
+\end{lstlisting}
+\begin{lstlisting}
+In []: print(x)
+\end{lstlisting}
+\begin{lstlisting}
+In []: x = 1
+\end{lstlisting}
+"""))
+
+
+def _run(text):
+    """Return the notebook text as if it had been run.
+    """
+    nb = nbformat.reads(text, 4)
+    count = 0
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            count += 1
+            cell.execution_count = count
+            cell.outputs = [nbformat.v4.new_output(
+                'stream', text='out %d\n' % count
+            )]
+    nb.metadata['kernelspec'] = dict(name='python3', display_name='Python 3')
+    return nbformat.writes(nb) + '\n'
+
+
+def test_merge_outputs():
+    # Given
+    old = _run(notebook_text(tex2ipy(LISTINGS)))
+    code = LISTINGS.replace('In []: x = 1', 'In []: y = 2', 1)
+    code = code.replace('Foo', 'Bar')
+    text = notebook_text(tex2ipy(code))
+
+    # When
+    merged = merge_outputs(text, old)
+
+    # Then
+    nb = nbformat.reads(merged, 4)
+    nbformat.validate(nb)
+    cells = [x for x in nb.cells if x.cell_type == 'code']
+    assert [x.execution_count for x in cells] == [None, 2, 3]
+    assert cells[0].outputs == []
+    assert cells[2].outputs[0].text == 'out 3\n'
+    assert nb.cells[0].source.startswith('## Bar')
+    assert nb.metadata.kernelspec.name == 'python3'
+    assert merge_outputs(merged, merged) == merged
+    assert merge_outputs(text, None) is text
+    assert merge_outputs(text, 'junk') is text
+
+
+def test_main_with_merge(tmpdir):
+    # Given
+    src = tmpdir.join('test.tex')
+    src.write(LISTINGS)
+    dest = tmpdir.join('test.ipynb')
+    args = [str(src), str(dest), '--no-cache']
+    main(args=args)
+    dest.write(_run(dest.read()))
+    executed = dest.read()
+    mtime = dest.mtime() - 10
+    dest.setmtime(mtime)
+
+    # When
+    main(args=args + ['--merge'])
+
+    # Then
+    assert dest.read() == executed
+    assert dest.mtime() == mtime
+
+    # When
+    src.write(LISTINGS.replace('Foo', 'Bar'))
+    main(args=args + ['--merge'])
+
+    # Then
+    nb = nbformat.read(str(dest), 4)
+    assert nb.cells[0].source.startswith('## Bar')
+    assert [x.execution_count for x in nb.cells[1:]] == [1, 2, 3]
+
+    # When
+    main(args=args)
+
+    # Then
+    nb = nbformat.read(str(dest), 4)
+    assert [x.execution_count for x in nb.cells[1:]] == [None]*3
+
+
+# Maximum time in seconds to import the command line module.
+IMPORT_TIME_BUDGET = 0.15
+
+
+def test_cli_does_not_import_dependencies_for_help():
+    # Given
+    code = dedent("""
+    import sys
+    from tex2ipy.cli import main
+    try:
+        main(['--help'])
+    except SystemExit:
+        pass
+    print(sorted(set(x.split('.')[0] for x in sys.modules)))
+    """)
+
+    # When
+    out = subprocess.check_output([sys.executable, '-c', code])
+
+    # Then
+    modules = out.decode('utf-8').splitlines()[-1]
+    assert 'nbformat' not in modules
+    assert 'TexSoup' not in modules
+
+
+def test_cli_import_time_is_within_budget():
+    # Given
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import tex2ipy.cli']
+
+    # When
+    times = []
+    for i in range(3):
+        proc = subprocess.run(cmd, stderr=subprocess.PIPE, check=True)
+        for line in proc.stderr.decode('utf-8').splitlines():
+            if line.rstrip().endswith('| tex2ipy.cli'):
+                times.append(int(line.split('|')[1])*1e-6)
+
+    # Then
+    assert len(times) == 3
+    assert min(times) < IMPORT_TIME_BUDGET
@@ -1,126 +1,1301 @@
-from glob import glob
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from collections.abc import MutableSequence
+import hashlib
+import logging
 import os
+import pickle
 import re
+import sys
 
 from TexSoup import TexSoup, TexNode
-from TexSoup.data import BraceGroup, BracketGroup
+from TexSoup.data import BraceGroup, BracketGroup, TexCmd, TexEnv, \
+    TexNamedEnv, TexText
 
+from . import fastparse
+from .macros import MacroTable, compile_macros, map_line
+from .profiling import timer
 
-def get_all_listings(code):
-    result = []
-    start = (r'\begin{lstlisting}', r'\begin{verbatim}')
-    end = (r'\end{lstlisting}', r'\end{verbatim}')
+
+_LISTING_BEGIN = (r'\begin{lstlisting}', r'\begin{verbatim}')
+_LISTING_END = (r'\end{lstlisting}', r'\end{verbatim}')
+_COMMENT = re.compile(r'(?<!\\)%')
+# The start and end of environments, escaped characters and braces.
+_GROUPING = re.compile(r'\\(begin|end)\s*\{([^{}]*)\}|\\.|[{}]', re.S)
+
+logger = logging.getLogger(__name__)
+
+
+class Listings(object):
+    """The listings found in some code, stored as offsets into the code.
+
+    Indexing returns the lines of the listing as a list of strings, each
+    ending with a newline.
+    """
+    __slots__ = ('code', 'spans')
+
+    def __init__(self, code, spans):
+        self.code = code
+        self.spans = spans
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, index):
+        start, end = self.spans[index]
+        return [line + '\n' for line in self.code[start:end].splitlines()]
+
+
+class PreprocessedCode(object):
+    r"""The result of `preprocess`.
+
+    `code` is the processed code, `listings` a list of (start, end) offsets
+    of the body of each listing, `frames` the offsets of each
+    `\begin{frame}` and `begin_document`, `end_document` the offsets of
+    the `\begin{document}` and `\end{document}` or None if they are not
+    present.  `line_map` holds the lines added or removed by expanding
+    macros in the code (see `tex2ipy.macros.MacroTable.expand`).
+    """
+    __slots__ = ('code', 'listings', 'frames', 'begin_document',
+                 'end_document', 'line_map', '_newlines')
+
+    def __init__(self, code, listings, frames, begin_document, end_document):
+        self.code = code
+        self.listings = listings
+        self.frames = frames
+        self.begin_document = begin_document
+        self.end_document = end_document
+        self.line_map = ()
+        self._newlines = None
+
+    def _line(self, offset):
+        if self._newlines is None:
+            self._newlines = [m.start() for m in re.finditer('\n', self.code)]
+        return bisect_right(self._newlines, offset - 1) + 1
+
+    def line_number(self, offset):
+        """Return the line number (starting at 1) of the given offset in the
+        original code.
+
+        Preprocessing does not add or remove lines and those added or removed
+        by expanding macros are looked up in `line_map`.
+        """
+        line = self._line(offset)
+        if self.line_map:
+            line = map_line(self.line_map, line)
+        return line
+
+    def line_changes(self, start, end):
+        """Return the entries of `line_map` in the code between the offsets
+        `start` and `end`, relative to the line of `start`.
+        """
+        if not self.line_map:
+            return []
+        first, last = self._line(start), self._line(end)
+        source = self.line_number(start)
+        return [(x - first, y - source) for x, y in self.line_map
+                if first <= x <= last]
+
+    def is_balanced(self, start, end):
+        """Return True if the braces and environments opened in the code
+        between the offsets `start` and `end` are also closed there, so this
+        code may be parsed on its own.  The listings are skipped.
+        """
+        code = self.code
+        stack = []
+        pos = start
+        spans = self.listings
+        i = bisect_right(spans, (start,))
+        while pos < end:
+            stop = end
+            if i < len(spans) and spans[i][0] < end:
+                stop = spans[i][0]
+            for match in _GROUPING.finditer(code, pos, stop):
+                kind = match.group(1)
+                if kind == 'begin':
+                    stack.append(match.group(2))
+                elif kind == 'end':
+                    if not stack or stack.pop() != match.group(2):
+                        return False
+                elif match.group() == '{':
+                    stack.append('{')
+                elif match.group() == '}':
+                    if not stack or stack.pop() != '{':
+                        return False
+            if stop == end:
+                break
+            pos = spans[i][1]
+            i += 1
+        return not stack
+
+    def frame_bounds(self):
+        """Return the offsets splitting the document body at each frame.
+
+        The first entry is the start of the body and the last its end, so
+        consecutive entries delimit the text before the first frame and
+        then each frame with whatever follows it.  Returns None if there is
+        no document environment.
+        """
+        if self.begin_document is None:
+            return None
+        start = self.begin_document + len(r'\begin{document}')
+        end = self.end_document
+        if end is None:
+            end = len(self.code)
+        frames = [x for x in self.frames if start <= x < end]
+        return [start] + frames + [end]
+
+
+def preprocess(code):
+    r"""Prepare the TeX code for parsing in a single pass over its lines.
+
+    This replaces `\[` and `\]` with an `equation*` environment and
+    removes comments everywhere except inside the `lstlisting` and
+    `verbatim` environments, which are left untouched.  The offsets of the
+    listings, the frames and the document environment in the processed
+    code are recorded as well.  Returns a `PreprocessedCode` instance.
+    """
+    parts = []
+    listings = []
+    frames = []
+    begin_doc = end_doc = None
     in_listing = False
-    for line in code.splitlines():
-        llstrip = line.lstrip()
-        if llstrip.startswith(start):
-            in_listing = True
-            block = []
-            continue
-        elif llstrip.endswith(end):
-            in_listing = False
-            result.append(block)
-            continue
-        elif in_listing:
-            block.append(line + '\n')
-
-    return result
-
-
-def get_real_image_from_path(image_path):
-    """Often images are provided without an extension, so we try to
-    find a suitable one using glob.
+    listing_start = 0
+    pos = 0
+    out = 0
+    while True:
+        nl = code.find('\n', pos)
+        if nl < 0:
+            line = code[pos:]
+            newline = ''
+        else:
+            line = code[pos:nl]
+            newline = '\n'
+        pos = nl + 1
+
+        if in_listing:
+            if line.rstrip('\r').lstrip().endswith(_LISTING_END):
+                in_listing = False
+                listings.append((listing_start, out))
+        else:
+            if '\\' in line:
+                line = line.replace(r'\[', r'\begin{equation*}')
+                line = line.replace(r'\]', r'\end{equation*}')
+            if '%' in line:
+                match = _COMMENT.search(line)
+                if match is not None:
+                    line = line[:match.start()]
+            if '\\begin{' in line or '\\end{' in line:
+                if begin_doc is None:
+                    idx = line.find(r'\begin{document}')
+                    if idx > -1:
+                        begin_doc = out + idx
+                if end_doc is None:
+                    idx = line.find(r'\begin{frame}')
+                    while idx > -1:
+                        frames.append(out + idx)
+                        idx = line.find(r'\begin{frame}', idx + 1)
+                    idx = line.find(r'\end{document}')
+                    if idx > -1 and begin_doc is not None:
+                        end_doc = out + idx
+                if line.lstrip().startswith(_LISTING_BEGIN):
+                    in_listing = True
+                    listing_start = out + len(line) + len(newline)
+
+        parts.append(line)
+        parts.append(newline)
+        out += len(line) + len(newline)
+        if nl < 0:
+            break
+
+    return PreprocessedCode(
+        ''.join(parts), listings, frames, begin_doc, end_doc
+    )
+
+
+def get_all_listings(code):
+    """Return the lines of all the listings in the code as a list of lists.
+    """
+    pre = preprocess(code)
+    return list(Listings(pre.code, pre.listings))
+
+
+class ImageResolver(object):
+    """Find the image file to use for an image path.
+
+    Images are often given without an extension, in which case a file with
+    the same name and one of the extensions in `formats` is looked for, the
+    earlier extensions are preferred.  Each directory is listed only once
+    and the listing is reused, so a single resolver may be shared by all the
+    documents converted in a run.  Create a new resolver if the files may
+    have changed.
     """
+
     formats = ('png', 'jpg', 'svg', 'gif', 'jpeg', 'bmp')
-    image = image_path
-    if not os.path.exists(image):
-        for f in glob(image+'*'):
-            if f.lower().endswith(formats):
-                image = f
-                break
-    return image
+
+    def __init__(self, formats=None):
+        if formats is not None:
+            self.formats = tuple(x.lower().lstrip('.') for x in formats)
+        self._dirs = {}
+
+    def _index(self, dirname):
+        index = self._dirs.get(dirname)
+        if index is None:
+            try:
+                names = sorted(os.listdir(dirname or os.curdir))
+            except OSError:
+                names = []
+            stems = {}
+            for name in names:
+                stem, ext = os.path.splitext(name)
+                ext = ext[1:].lower()
+                if ext in self.formats:
+                    stems.setdefault(stem, {}).setdefault(ext, name)
+            index = self._dirs[dirname] = (set(names), stems)
+        return index
+
+    def _find(self, path):
+        dirname, basename = os.path.split(path)
+        names, stems = self._index(dirname)
+        if basename in names:
+            return path
+        exts = stems.get(basename)
+        if exts:
+            for ext in self.formats:
+                if ext in exts:
+                    return os.path.join(dirname, exts[ext])
+        return None
+
+    def resolve(self, image_path, search_paths=()):
+        r"""Return the image file for the given path.
+
+        The path is looked up as given and then relative to each of the
+        `search_paths` (typically those given by `\graphicspath`).  If no
+        file is found the path is returned unchanged.
+        """
+        found = self._find(image_path)
+        if found is None and not os.path.isabs(image_path):
+            for search_path in search_paths:
+                found = self._find(os.path.join(search_path, image_path))
+                if found is not None:
+                    break
+        return image_path if found is None else found
+
+    def is_unchanged(self, images):
+        """Return True if each of the `images`, a dictionary mapping the
+        arguments of `resolve` (the image path and a tuple of search paths)
+        to its result, still resolves to the same file.
+        """
+        for (image_path, search_paths), image in images.items():
+            if self.resolve(image_path, search_paths) != image:
+                return False
+        return True
 
 
-def _replace_display_math(code):
-    code = code.replace(r'\[', r'\begin{equation*}')
-    return code.replace(r'\]', r'\end{equation*}')
+def get_real_image_from_path(image_path, resolver=None):
+    """Often images are provided without an extension, so we try to
+    find a suitable one using the given `ImageResolver` or a new one.
+    """
+    if resolver is None:
+        resolver = ImageResolver()
+    return resolver.resolve(image_path)
+
+
+def split_frames(code):
+    r"""Split the document body of the given code into chunks at each
+    `\begin{frame}`.
+
+    The code may be a string or a `PreprocessedCode` instance, a string is
+    preprocessed first.  Returns a tuple `(preamble, chunks)` where
+    `preamble` is the code before `\begin{document}` and `chunks` is a list
+    of strings.  The first chunk is the part of the body before the first
+    frame, every other chunk starts with a `\begin{frame}` and extends up
+    to the next one.  Each frame chunk thus produces its own cells
+    independent of the others.  `chunks` is None if there is no document
+    environment.
+    """
+    if not isinstance(code, PreprocessedCode):
+        code = preprocess(code)
+    text = code.code
+    bounds = code.frame_bounds()
+    if bounds is None:
+        return text, None
+    chunks = [text[bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1)]
+    return text[:code.begin_document], chunks
+
+
+class FrameCache(object):
+    """An in-memory cache of the cells generated for each frame.
+
+    This may be passed to `Tex2Cells` to avoid re-parsing frames that have
+    not changed since the last conversion.  The cells are stored pickled so
+    callers always get a fresh copy.  At most `max_entries` frames are kept,
+    the least recently used ones are discarded first.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        data = self._data.get(key)
+        if data is None:
+            return None
+        self._data.move_to_end(key)
+        return pickle.loads(data)
+
+    def put(self, key, cells):
+        self._data[key] = pickle.dumps(cells, pickle.HIGHEST_PROTOCOL)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+
+class CellSource(MutableSequence):
+    """Collect the source of a cell.
+
+    Text appended to the last line with `append_inline` is stored as a list
+    of fragments which are only joined when needed, so building a long line
+    takes linear time.  Otherwise this is a mutable sequence of lines which
+    can be used like a list, `to_list` returns the list of lines stored in
+    the notebook.
+    """
+    __slots__ = ('_lines', '_tail')
+
+    def __init__(self, lines=()):
+        self._lines = list(lines)
+        # Fragments making up the last line while text is appended to it, or
+        # None if all the lines are in `_lines`.
+        self._tail = None
+
+    def _flush(self):
+        if self._tail is not None:
+            self._lines.append(''.join(self._tail))
+            self._tail = None
+        return self._lines
+
+    def append(self, line):
+        """Start a new line with the given text.
+        """
+        self._flush().append(line)
+
+    def append_inline(self, text):
+        """Append text to the last line, starting one if there is none.
+        """
+        tail = self._tail
+        if tail is None:
+            lines = self._lines
+            tail = self._tail = [lines.pop()] if lines else []
+        tail.append(text)
+
+    def extend(self, lines):
+        self._flush().extend(lines)
+
+    def insert(self, index, line):
+        self._flush().insert(index, line)
+
+    def to_list(self):
+        """Return the lines as a list of strings.
+        """
+        return list(self._flush())
+
+    def __len__(self):
+        return len(self._lines) + (self._tail is not None)
+
+    def __iter__(self):
+        return iter(self._flush())
+
+    def __eq__(self, other):
+        if isinstance(other, CellSource):
+            other = other.to_list()
+        return self._flush() == other
+
+    def __getitem__(self, index):
+        return self._flush()[index]
+
+    def __setitem__(self, index, value):
+        self._flush()[index] = value
+
+    def __delitem__(self, index):
+        del self._flush()[index]
+
+    def __repr__(self):
+        return 'CellSource(%r)' % self.to_list()
+
+
+class Cell(object):
+    """A notebook cell built by `Tex2Cells`.
+
+    This is a compact replacement for the dictionary of a cell.  It may
+    still be used like one, i.e. `cell['source']`, `cell['cell_type']` or
+    `cell['metadata']['slideshow']['slide_type']` work as before, but the
+    metadata dictionary is only made when it is asked for.  Use `to_dict`
+    or `to_node` to convert the cell for nbformat.
+
+    `section` is the title of the section started by the cell, if any.  It
+    is not part of the notebook but is used to split the output.  Likewise
+    `line` is the line of the TeX code the source of a code cell starts at,
+    if known.
+    """
+    __slots__ = ('cell_type', 'source', '_slide_type', '_metadata',
+                 '_outputs', 'execution_count', 'section', 'line')
+
+    def __init__(self, cell_type='markdown', slide_type='slide', source=None):
+        self.cell_type = cell_type
+        self.source = CellSource() if source is None else source
+        self._slide_type = sys.intern(slide_type)
+        self._metadata = None
+        self._outputs = None
+        self.execution_count = None
+        self.section = None
+        self.line = None
+
+    @property
+    def slide_type(self):
+        if self._metadata is None:
+            return self._slide_type
+        return self._metadata['slideshow']['slide_type']
+
+    @slide_type.setter
+    def slide_type(self, value):
+        if self._metadata is None:
+            self._slide_type = sys.intern(value)
+        else:
+            self._metadata['slideshow']['slide_type'] = value
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            slideshow = dict(slide_type=self._slide_type)
+            self._metadata = dict(slideshow=slideshow)
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
+
+    @property
+    def outputs(self):
+        if self._outputs is None:
+            self._outputs = []
+        return self._outputs
+
+    @outputs.setter
+    def outputs(self, value):
+        self._outputs = value
+
+    def keys(self):
+        if self.cell_type == 'code':
+            return ['cell_type', 'execution_count', 'metadata', 'outputs',
+                    'source']
+        return ['cell_type', 'metadata', 'source']
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in ('cell_type', 'execution_count', 'metadata', 'outputs',
+                       'source'):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key in self.keys():
+            return getattr(self, key)
+        return default
+
+    def _source_list(self):
+        source = self.source
+        if isinstance(source, CellSource):
+            return source.to_list()
+        elif isinstance(source, str):
+            return source.splitlines(True)
+        return list(source)
+
+    def to_dict(self):
+        """Return the cell as a dictionary.
+        """
+        metadata = self._metadata
+        if metadata is None:
+            metadata = dict(slideshow=dict(slide_type=self._slide_type))
+        d = dict(
+            cell_type=self.cell_type, metadata=metadata,
+            source=self._source_list()
+        )
+        if self.cell_type == 'code':
+            d['outputs'] = self.outputs
+            d['execution_count'] = self.execution_count
+        return d
+
+    def to_node(self):
+        """Return the cell as an nbformat `NotebookNode`.
+        """
+        from nbformat.notebooknode import NotebookNode, from_dict
+        if self._metadata is None:
+            metadata = NotebookNode(
+                slideshow=NotebookNode(slide_type=self._slide_type)
+            )
+        else:
+            metadata = from_dict(self._metadata)
+        node = NotebookNode(
+            cell_type=self.cell_type, metadata=metadata,
+            source=self._source_list()
+        )
+        if self.cell_type == 'code':
+            node['outputs'] = from_dict(self.outputs)
+            node['execution_count'] = self.execution_count
+        return node
+
+    def __eq__(self, other):
+        if isinstance(other, Cell):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Cell(%r)' % self.to_dict()
+
+
+def to_node(cell):
+    """Return the given `Cell` or cell dictionary as a `NotebookNode`.
+    """
+    if isinstance(cell, Cell):
+        return cell.to_node()
+    from nbformat.v4.nbjson import from_dict
+    return from_dict(cell)
+
+
+def index_nodes(soup, names):
+    """Return a dictionary mapping each of the `names` to the list of nodes
+    with that name in the `soup`, in the order `soup.find_all(name)` finds
+    them.  The tree is walked once for all the names, `find_all` walks it
+    for each name.
+    """
+    index = dict((name, []) for name in names)
+    stack = [soup]
+    while stack:
+        node = stack.pop()
+        children = []
+        for content in node.expr.contents:
+            if isinstance(content, TexText):
+                if content.name in index:
+                    index[content.name].append(content)
+                continue
+            if not hasattr(content, 'name'):
+                continue
+            child = TexNode(content)
+            child.parent = node
+            found = index.get(str(content.name))
+            if found is not None:
+                found.append(child)
+            if isinstance(content, (TexEnv, TexCmd)):
+                children.append(child)
+        # Like `find_all`, all the contents of a node come before those of
+        # its children.
+        stack.extend(reversed(children))
+    return index
+
+
+class Diagnostics(object):
+    """The unknown macros found while converting documents.
+
+    `unknown` counts the number of times each node name without a handler
+    was seen and `lines` maps each of them to the lines they were seen on.
+    The same instance may be used for several documents to aggregate them.
+    """
+    def __init__(self):
+        self.unknown = Counter()
+        self.lines = {}
+
+    def __len__(self):
+        return len(self.unknown)
+
+    def add_unknown(self, name, line=None):
+        self.unknown[name] += 1
+        if line is not None:
+            self.lines.setdefault(name, []).append(line)
+
+    def update(self, other):
+        """Add the diagnostics of another `Diagnostics` instance.
+        """
+        self.unknown.update(other.unknown)
+        for name, lines in other.lines.items():
+            self.lines.setdefault(name, []).extend(lines)
+
+    def map_lines(self, func):
+        """Return a copy with each line replaced by `func(line)`, for example
+        to give the file a line of a document with included files is in.
+        """
+        result = Diagnostics()
+        result.unknown.update(self.unknown)
+        for name, lines in self.lines.items():
+            result.lines[name] = [func(x) for x in lines]
+        return result
+
+    def report(self, stream=None, title='Unknown macros', show_lines=True,
+               max_lines=10):
+        """Print a summary of the unknown macros, most frequent first.
+        """
+        if not self.unknown:
+            return
+        print("%s: %d distinct, %d uses" % (
+            title, len(self.unknown), sum(self.unknown.values())
+        ), file=stream)
+        for name, count in sorted(self.unknown.items(),
+                                  key=lambda x: (-x[1], x[0])):
+            lines = self.lines.get(name, [])
+            where = ''
+            if show_lines and lines:
+                where = ', '.join(str(x) for x in lines[:max_lines])
+                if len(lines) > max_lines:
+                    where += ', ...'
+                if all(isinstance(x, int) for x in lines):
+                    where = 'line%s %s' % ('s' if len(lines) > 1 else '',
+                                           where)
+                where = ' (%s)' % where
+            print("  \\%s: %d%s" % (name, count, where), file=stream)
+
+
+def handles(*names):
+    """Decorator to register a `Tex2Cells` method as the handler for the
+    given TeX macro or environment names, for example::
+
+        @handles('alert', 'structure')
+        def _handle_highlight(self, node):
+            ...
+
+    The names refer to the method by name, so overriding the method in a
+    subclass also overrides the handler for all its names.  A method called
+    `_handle_<name>` (with a `*` in the name replaced by `_star`) is always
+    used in preference to a registered handler, this includes aliases such
+    as `Tex2Cells._handle_align`.
+    """
+    def decorator(func):
+        func.tex_names = getattr(func, 'tex_names', ()) + names
+        return func
+    return decorator
+
+
+def clear_newline(text):
+    """Strip the whitespace around the text of a node, ending it with a
+    newline if the text has a line break anywhere.
+
+    This takes time linear in the length of the text.
+    """
+    # This used to search for `(.*)(\s+)` and check for a newline in the
+    # second group.  As `.` does not match a newline, that is the case if
+    # and only if the text has one, but the search was quadratic.
+    if '\n' in text:
+        text = text.rstrip() + '\n'
+    else:
+        text = text.rstrip()
+    if text.startswith(('\n', '\r')):
+        return text.lstrip()
+    return text
 
 
 def remove_comments(code):
     return re.sub('(?<!\\\\)%.*$', '', code, flags=re.M)
 
 
+def _shift_lines(cells, delta):
+    for cell in cells:
+        line = getattr(cell, 'line', None)
+        if line is not None:
+            cell.line = line + delta
+
+
+class _SplitError(Exception):
+    """Raised when a document cannot be converted one frame at a time.
+    """
+
+
+class _NodeEnd(object):
+    """Marks the end of the children of a node when profiling.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+
+
 class Tex2Cells(object):
-    def __init__(self, code):
-        code = _replace_display_math(code)
-        code = remove_comments(code)
-        self.soup = TexSoup(code)
-        self.listings = get_all_listings(code)
+    r"""Convert TeX code into a list of notebook cells.
+
+    If a `frame_cache` is given (a `FrameCache` or any object with similar
+    `get` and `put` methods), the document is converted one frame at a time
+    (see `iter_cells`) and the cells of frames that are found in the cache
+    are reused instead of parsing the frame again.  This is only done for
+    classes which set `frames_are_independent` to True themselves (a
+    subclass does not inherit it), as it is only correct if the cells of a
+    frame depend on nothing but the frame and the preamble nodes.
+
+    If a `tree_cache` is given (a `tex2ipy.cache.DiskTreeCache` or any object
+    with `get(code)` and `put(code, tree)` methods), the trees of the code
+    parsed are looked up there first, so code that has not changed is not
+    parsed again even when the converter has.
+
+    If a `profile` (a `tex2ipy.profiling.Profile`) is given, the calls to
+    each handler and the time spent in them are recorded in it.
+
+    Macros defined with `\newcommand`, `\def` etc. in the document are
+    expanded before parsing, `macros` may be a `MacroTable` with more
+    definitions, for example from a shared preamble (see
+    `tex2ipy.macros.load_preamble`).  The macros used are in `self.macros`.
+
+    The code is parsed with TexSoup unless `engine` is `'fast'`, in which
+    case `tex2ipy.fastparse` is used and TexSoup only for the code it does
+    not support.  When converting one frame at a time this falls back for
+    that frame alone.
+
+    The images found by `resolve_image` are recorded in `images`, which maps
+    the arguments of `ImageResolver.resolve` to the file found.  The cached
+    frames are only reused if their images are still the same files.
+
+    Nodes without a handler are recorded in `diagnostics`, a `Diagnostics`
+    instance which may be passed in to collect them over several documents,
+    and are logged at `unknown_log_level`.  The diagnostics of each frame
+    are kept in the `frame_cache` and are added again when it is reused.
+    """
+
+    # Nodes handled before the document is converted, wherever they are.
+    preamble_nodes = ('title', 'author', 'institute', 'date', 'logo',
+                      'graphicspath')
+
+    # The logging level at which nodes without a handler are reported.
+    unknown_log_level = logging.DEBUG
+
+    # The parser used, either 'texsoup' or 'fast'.
+    engine = 'texsoup'
+
+    # True if the handlers keep no state from one frame to the next, so the
+    # document may be converted one frame at a time.  Only the value set in
+    # the class itself is used.
+    frames_are_independent = True
+
+    def __init__(self, code, frame_cache=None, image_resolver=None,
+                 profile=None, diagnostics=None, macros=None, engine=None,
+                 tree_cache=None):
+        if engine is not None:
+            if engine not in ('texsoup', 'fast'):
+                raise ValueError('Unknown engine: %r' % engine)
+            self.engine = engine
+        pre = self._expand_macros(preprocess(code), macros)
+        self.code = pre.code
+        self._preprocessed = pre
+        self.frame_cache = frame_cache
+        self.tree_cache = tree_cache
+        if image_resolver is None:
+            image_resolver = ImageResolver()
+        self.image_resolver = image_resolver
+        self.profile = profile
+        if diagnostics is None:
+            diagnostics = Diagnostics()
+        self.diagnostics = diagnostics
+        self._offset = 0
+        self.graphics_path = []
+        self.images = {}
+        self._soup = None
+        self._soups = None
+        self.listings = Listings(pre.code, pre.listings)
         self._listings_count = 0
         self.info = {}
         self.cells = []
         self.current = None
-        self._ws = re.compile(r'(.*)(\s+)')
+        self._handlers = {}
 
-    def _parse_titlepage(self):
-        nodes = ('title', 'author', 'institute', 'date', 'logo')
-        for node in nodes:
-            for elem in self.soup.find_all(node):
-                method = getattr(self, '_handle_' + node)
-                method(elem)
+    def _expand_macros(self, pre, macros):
+        """Expand the macros in the `PreprocessedCode` and return the new
+        `PreprocessedCode`.  The preamble is expanded by `compile_macros` so
+        the definitions in it are parsed only once.
+        """
+        code = pre.code
+        if macros is None and 'command' not in code and '\\def' not in code:
+            self.macros = MacroTable()
+            return pre
+        start = pre.begin_document or 0
+        lines = []
+        head, table = compile_macros(code[:start], macros, lines)
+        skip = [(s - start, e - start) for s, e in pre.listings if s >= start]
+        body = []
+        code = head + table.expand(code[start:], skip, lines=body)
+        self.macros = table
+        # The lines of the body are counted from the line it starts on.
+        first = pre.line_number(start) - 1
+        shift = head.count('\n') - pre.code.count('\n', 0, start) + first
+        lines.extend((x + shift, y + first) for x, y in body)
+        pre = preprocess(code)
+        pre.line_map = lines
+        return pre
+
+    @property
+    def soup(self):
+        """The TexSoup tree of the whole document, parsed on first use.
+        """
+        if self._soup is None:
+            self._soup = self._parse_tex(self.code)
+        return self._soup
+
+    @property
+    def soups(self):
+        """The trees `parse` converts, as a list of (offset, tree) pairs,
+        parsed on first use.
+
+        With the fast engine and balanced frames, the first tree is that of
+        the preamble and the others those of the text before the first frame
+        and of each frame, so a frame the fast parser does not support is
+        the only one parsed with TexSoup.  Otherwise, or if a chunk fails to
+        parse, this is the `soup` of the whole document.
+        """
+        if self._soups is None:
+            soups = None
+            pre = self._preprocessed
+            chunks = None
+            if self.engine == 'fast':
+                chunks = self._balanced_chunks()
+            if chunks is not None:
+                code = pre.code
+                try:
+                    soups = [(0, self._parse_chunk(code[:pre.begin_document]))]
+                    soups.extend(
+                        (start, self._parse_chunk(code[start:end]))
+                        for start, end in chunks
+                    )
+                except _SplitError as e:
+                    logger.debug("Parsing the whole document: %s", e)
+                    soups = None
+            if soups is None:
+                soups = [(0, self.soup)]
+            self._soups = soups
+        return self._soups
+
+    def _balanced_chunks(self):
+        """Return the (start, end) offsets of the text before the first
+        frame and of each frame (see `PreprocessedCode.frame_bounds`) or
+        None if there is no document or they cannot be parsed on their own.
+        """
+        pre = self._preprocessed
+        bounds = pre.frame_bounds()
+        if bounds is None:
+            return None
+        chunks = list(zip(bounds[:-1], bounds[1:]))
+        if not pre.is_balanced(0, pre.begin_document) or \
+                not all(pre.is_balanced(s, e) for s, e in chunks):
+            return None
+        return chunks
+
+    def _parse_tex(self, code):
+        """Return the TexSoup tree of the code, from the `tree_cache` or
+        parsed with the engine.
+        """
+        tree_cache = self.tree_cache
+        if tree_cache is not None:
+            soup = tree_cache.get(code)
+            if soup is not None:
+                return soup
+        soup = None
+        if self.engine == 'fast':
+            try:
+                soup = fastparse.parse(code)
+            except fastparse.Unsupported as e:
+                logger.debug("Parsing with TexSoup: %s", e)
+        if soup is None:
+            soup = TexSoup(code)
+        if tree_cache is not None:
+            tree_cache.put(code, soup)
+        return soup
+
+    @classmethod
+    def _get_handler_name(cls, name):
+        """Return the name of the method handling the given node name or
+        None if there is no handler.  The result is cached for each class.
+        """
+        table = cls.__dict__.get('_dispatch_table')
+        if table is None:
+            table = cls._dispatch_table = {}
+        try:
+            return table[name]
+        except KeyError:
+            pass
+
+        registered = cls.__dict__.get('_registered_handlers')
+        if registered is None:
+            registered = {}
+            for klass in reversed(cls.__mro__):
+                for attr, value in vars(klass).items():
+                    for tex_name in getattr(value, 'tex_names', ()):
+                        registered[tex_name] = attr
+            cls._registered_handlers = registered
+
+        attr = '_handle_%s' % name.replace('*', '_star').replace('$', 'dollar')
+        if not callable(getattr(cls, attr, None)):
+            attr = registered.get(name)
+        table[name] = attr
+        return attr
+
+    def _get_handler(self, name):
+        """Return the bound method handling the given node name or None.
+        """
+        handlers = self._handlers
+        try:
+            return handlers[name]
+        except KeyError:
+            attr = self._get_handler_name(name)
+            method = None if attr is None else getattr(self, attr)
+            handlers[name] = method
+            return method
+
+    def _parse_titlepage(self, soups=None):
+        """Call the handlers of the `preamble_nodes` in the soups, the whole
+        document by default.  Returns the index of each soup (see
+        `index_nodes`), which also has the `document` nodes.
+        """
+        if soups is None:
+            soups = [self.soup]
+        indexes = [
+            index_nodes(soup, self.preamble_nodes + ('document',))
+            for soup in soups
+        ]
+        for node in self.preamble_nodes:
+            method = self._get_handler(node)
+            for index in indexes:
+                for elem in index[node]:
+                    method(elem)
+        return indexes
 
     def parse(self):
-        """Parse the given TeX code and return suitable IPython cells.
+        """Parse the given TeX code and return suitable IPython cells, as
+        dictionaries.
         """
-        self._parse_titlepage()
-        doc = self.soup.find('document')
-        self._walk(doc)
+        return [cell.to_dict() for cell in self.parse_cells()]
+
+    def parse_cells(self):
+        """Parse the given TeX code and return the `Cell` objects made, which
+        also record the line and section of each cell.  Use `to_node` to
+        convert them for nbformat.
+        """
+        if self.frame_cache is not None:
+            cells = list(self.iter_cells())
+            self.cells = cells
+            return cells
+        return self._parse_document()
+
+    def _parse_document(self):
+        """Parse the whole document and return its cells.
+        """
+        pre = self._preprocessed
+        self.cells = []
+        self.current = None
+        self._offset = 0
+        self.images = {}
+        self.listings = Listings(pre.code, pre.listings)
+        self._listings_count = 0
+        soups = self.soups
+        indexes = self._parse_titlepage([soup for offset, soup in soups])
+        if len(soups) == 1:
+            documents = indexes[0]['document']
+            doc = documents[0] if documents else None
+            self._walk(doc)
+        else:
+            # The document is in chunks, the document handler is called
+            # with an empty node before the chunks are walked in order.
+            self._walk(TexNode(TexNamedEnv('document', args=[])))
+            for offset, soup in soups[1:]:
+                self._offset = offset
+                for element in soup.contents:
+                    self._walk(element)
+            self._offset = 0
+        self._finish_cells(self.cells)
         return self.cells
 
+    def iter_cells(self):
+        """Parse the given TeX code one frame at a time and yield the cells,
+        as `Cell` objects like `parse_cells`.
+
+        Unlike `parse`, the whole document is never parsed at once and only
+        the cells of the current frame are kept in `self.cells`, so memory
+        use is bounded by the size of the largest frame.
+
+        If the frames cannot be parsed on their own, for example when a
+        frame is inside a group, `{...\\begin{frame}...\\end{frame}}`, or a
+        frame fails to parse, or the class does not set
+        `frames_are_independent`, the whole document is parsed instead and
+        the cells are the same as those of `parse`.  Otherwise the document
+        handler is called with an empty `document` node before the frames
+        are converted.
+        """
+        count = 0
+        try:
+            cls = type(self)
+            if not cls.__dict__.get('frames_are_independent', False):
+                raise _SplitError(
+                    '%s does not set frames_are_independent' % cls.__name__
+                )
+            for cell in self._iter_frame_cells():
+                count += 1
+                yield cell
+        except _SplitError as e:
+            logger.debug("Parsing the whole document: %s", e)
+            cells = self._parse_document()
+            self.cells = []
+            for cell in cells[count:]:
+                yield cell
+
+    def _parse_chunk(self, code):
+        try:
+            return self._parse_tex(code)
+        except Exception as e:
+            raise _SplitError('%s: %s' % (type(e).__name__, e))
+
+    def _iter_frame_cells(self):
+        pre = self._preprocessed
+        code = pre.code
+        bounds = pre.frame_bounds()
+        if bounds is None:
+            return
+        chunks = self._balanced_chunks()
+        if chunks is None:
+            raise _SplitError('the frames are not balanced')
+
+        # The preamble nodes may be set anywhere, so the chunks that set them
+        # are always parsed.
+        names = '|'.join(re.escape(x) for x in self.preamble_nodes)
+        preamble_re = re.compile(r'\\(?:%s)(?![a-zA-Z@])' % names)
+        soups = {}
+        for i, (start, end) in enumerate(chunks):
+            if preamble_re.search(code, start, end):
+                soups[i] = self._parse_chunk(code[start:end])
+        preamble = self._parse_chunk(code[:pre.begin_document])
+        self._parse_titlepage([preamble] + list(soups.values()))
+        del preamble
+
+        frame_cache = self.frame_cache
+        if frame_cache is not None:
+            cls = type(self)
+            info = sorted((k, str(v)) for k, v in self.info.items())
+            state = repr((info, self.graphics_path))
+            sha = hashlib.sha256()
+            for part in (cls.__module__, cls.__qualname__, state):
+                sha.update(part.encode('utf-8') + b'\0')
+
+        listings = pre.listings
+        n_listings = len(listings)
+        first_listing = 0
+        while first_listing < n_listings and \
+                listings[first_listing][0] < bounds[0]:
+            first_listing += 1
+
+        self.cells = []
+        self.current = None
+        self._offset = 0
+        self._walk(TexNode(TexNamedEnv('document', args=[])))
+        cells = self.cells
+        self._finish_cells(cells)
+        for cell in cells:
+            yield cell
+        # The diagnostics are only added once all the frames are converted,
+        # the whole document is parsed again if a frame cannot be.
+        diagnostics = self.diagnostics
+        found = Diagnostics()
+        for i, (start, end) in enumerate(chunks):
+            chunk = code[start:end]
+            # The cached cells have lines relative to the start of the chunk
+            # so they are still right if the frame has moved.
+            base = pre.line_number(start) - 1
+            last_listing = first_listing
+            while last_listing < n_listings and \
+                    listings[last_listing][0] < end:
+                last_listing += 1
+            spans = listings[first_listing:last_listing]
+            first_listing = last_listing
+
+            self.cells = []
+            self._offset = start
+            images = self.images
+            self.images = {}
+            cells = None
+            if frame_cache is not None:
+                chunk_sha = sha.copy()
+                chunk_sha.update(chunk.encode('utf-8'))
+                # The lines of the frame depend on the macros expanded in it.
+                changes = pre.line_changes(start, end)
+                if changes:
+                    chunk_sha.update(repr(changes).encode('utf-8'))
+                key = chunk_sha.hexdigest()
+                entry = frame_cache.get(key)
+                # The images of the frame must still be the same files.
+                if isinstance(entry, tuple) and len(entry) == 3 and \
+                        self.image_resolver.is_unchanged(entry[1]):
+                    cells, self.images, unknown = entry
+                    found.update(unknown.map_lines(lambda x: x + base))
+            if cells is None:
+                soup = soups.pop(i, None)
+                if soup is None:
+                    soup = self._parse_chunk(chunk)
+                self.diagnostics = unknown = Diagnostics()
+                try:
+                    self._walk_chunk(soup, Listings(code, spans))
+                finally:
+                    self.diagnostics = diagnostics
+                del soup
+                cells = self.cells
+                self._finish_cells(cells)
+                found.update(unknown)
+                if frame_cache is not None:
+                    _shift_lines(cells, -base)
+                    unknown = unknown.map_lines(lambda x: x - base)
+                    frame_cache.put(key, (cells, self.images, unknown))
+                    _shift_lines(cells, base)
+            elif cells:
+                _shift_lines(cells, base)
+                self.current = cells[-1]
+            images.update(self.images)
+            self.images = images
+            for cell in cells:
+                yield cell
+        diagnostics.update(found)
+        self.cells = []
+        self._offset = 0
+
+    def _walk_chunk(self, soup, listings):
+        self.listings = listings
+        self._listings_count = 0
+        for element in soup.contents:
+            self._walk(element)
+
     def _walk(self, node):
-        if isinstance(node, TexNode):
-            name = node.name.replace('*', '_star').replace('$', 'dollar')
-            method_name = '_handle_%s' % name
-            method = getattr(self, method_name, None)
-            skip_children = False
-            if method:
-                skip_children = method(node)
-            else:
-                self._handle_unknown(node)
-            if not skip_children:
-                for element in node.contents:
-                    self._walk(element)
-        elif isinstance(node, str):  # pragma: no branch
-            if self.current is not None:  # pragma: no branch
-                self._handle_str(node)
+        """Walk the node and its children calling the handlers for each.
+
+        A handler may return a list (or tuple) of nodes to walk instead of
+        the children of the node, any other true value to skip the children
+        or a false value to walk all of them.  Callables in the returned list
+        are called when they are reached, which lets a handler do something
+        after its children are walked.
+
+        The tree is walked using an explicit stack rather than recursion so
+        arbitrarily deep documents may be converted.
+        """
+        if self.profile is not None:
+            return self._walk_profiled(node)
+        stack = [node]
+        pop = stack.pop
+        extend = stack.extend
+        get_handler = self._get_handler
+        while stack:
+            node = pop()
+            if isinstance(node, TexNode):
+                method = get_handler(node.name)
+                result = False
+                if method:
+                    result = method(node)
+                else:
+                    self._handle_unknown(node)
+                if isinstance(result, (list, tuple)):
+                    extend(reversed(result))
+                elif not result:
+                    extend(reversed(list(node.contents)))
+            elif isinstance(node, str):
+                if self.current is not None:  # pragma: no branch
+                    self._handle_str(node)
+            elif callable(node):
+                node()
+
+    def _walk_profiled(self, node):
+        """Same as `_walk` but records the handler calls in `self.profile`.
+        """
+        profile = self.profile
+        stack = [node]
+        pop = stack.pop
+        extend = stack.extend
+        append = stack.append
+        get_handler = self._get_handler
+        while stack:
+            node = pop()
+            if isinstance(node, TexNode):
+                name = node.name
+                method = get_handler(name)
+                start = profile.begin_node(name)
+                result = False
+                if method:
+                    result = method(node)
+                    handler = method.__name__
+                else:
+                    self._handle_unknown(node)
+                    handler = '_handle_unknown'
+                profile.add_handler(handler, timer() - start)
+                append(_NodeEnd(name, start))
+                if isinstance(result, (list, tuple)):
+                    extend(reversed(result))
+                elif not result:
+                    extend(reversed(list(node.contents)))
+            elif isinstance(node, _NodeEnd):
+                profile.end_node(node.name, node.start)
+            elif isinstance(node, str):
+                if self.current is not None:  # pragma: no branch
+                    start = timer()
+                    self._handle_str(node)
+                    profile.add_handler('_handle_str', timer() - start)
+            elif callable(node):
+                node()
 
     def _make_cell(self, cell_type='markdown', slide_type='slide'):
-        slideshow = dict(slide_type=slide_type)
-        if cell_type == 'markdown':
-            self.current = dict(
-                cell_type=cell_type,
-                metadata=dict(slideshow=slideshow),
-                source=[]
-            )
-        else:
-            self.current = dict(
-                cell_type=cell_type,
-                metadata=dict(slideshow=slideshow),
-                source=[],
-                outputs=[],
-                execution_count=None
-            )
+        self.current = Cell(cell_type, slide_type)
         self.cells.append(self.current)
 
-    def _clear_newline(self, s):
-        if self._has_trailing_whitespace_and_nl(s):
-            s = s.rstrip() + '\n'
-        else:
-            s = s.rstrip()
-        if s.startswith(('\n', '\r')):
-            return s.lstrip()
+    def _finish_cells(self, cells):
+        """Convert the `CellSource` of the given cells to lists.
+        """
+        for cell in cells:
+            source = cell['source']
+            if isinstance(source, CellSource):
+                cell['source'] = source.to_list()
+
+    def resolve_image(self, image_path):
+        """Return the image file to use for the given path.
+
+        The result is recorded in `self.images`.
+        """
+        search_paths = tuple(self.graphics_path)
+        image = self.image_resolver.resolve(image_path, search_paths)
+        self.images[str(image_path), search_paths] = str(image)
+        return image
+
+    def append_inline(self, text):
+        """Append the text to the last line of the current cell.
+        """
+        source = self.current['source']
+        if isinstance(source, CellSource):
+            source.append_inline(text)
+        elif len(source) == 0:
+            source.append(text)
         else:
-            return s
+            source[-1] += text
+
+    def new_line(self, text=''):
+        """Start a new line in the current cell with the given text.
+        """
+        self.current['source'].append(text)
+
+    def _clear_newline(self, s):
+        return clear_newline(s)
 
     def _do_arg(self, arg):
         if isinstance(arg, BraceGroup):
@@ -139,17 +1314,12 @@ class Tex2Cells(object):
         src.append('### %s\n' % block_title)
         src.append('')
         if block_title == str(node.contents[0]):
-            for element in node.contents[1:]:
-                self._walk(element)
-            return True
+            return node.contents[1:]
         else:
             return False
 
     def _handle_dollar(self, node):
-        src = self.current['source']
-        if len(src) == 0:
-            src.append('')
-        src[-1] += ' ' + str(node) + ' '
+        self.append_inline(' ' + str(node) + ' ')
         return True
 
     def _handle_equation(self, node):
@@ -166,10 +1336,7 @@ class Tex2Cells(object):
     _handle_eqnarray_star = _handle_equation
 
     def _handle_emph(self, node):
-        src = self.current['source']
-        if len(src) == 0:
-            src.append('')
-        src[-1] += '*%s* ' % node.string
+        self.append_inline('*%s* ' % node.string)
         return True
 
     def _handle_frame(self, node):
@@ -177,52 +1344,39 @@ class Tex2Cells(object):
         if node.args:
             option = self._do_arg(node.args[0])
             if option == str(node.contents[0]):
-                for item in node.contents[1:]:
-                    self._walk(item)
-                return True
+                return node.contents[1:]
 
     def _handle_frametitle(self, node):
         src = self.current['source']
-        src.append('## ')
-        for item in node.contents:
-            self._walk(item)
+        self.new_line('## ')
 
-        src[-1] += '\n'
-        src.append('')
+        def end_title():
+            src[-1] += '\n'
+            src.append('')
 
-        return True
+        return list(node.contents) + [end_title]
 
     def _handle_str(self, node):
-        src = self.current['source']
-        data = self._clear_newline(str(node))
-        if len(src) == 0:
-            src.append('')
-
-        src[-1] += data
+        self.append_inline(self._clear_newline(str(node)))
 
     def _handle_item(self, node):
         if self.current['cell_type'] == 'code':
             self._make_cell(slide_type='-')
-        src = self.current['source']
-        if len(src) > 0:
-            src[-1] += '\n'
+        if len(self.current['source']) > 0:
+            self.append_inline('\n')
         if node.parent.name == 'itemize':
-            src.append('*')
+            self.new_line('*')
         elif node.parent.name == 'enumerate':  # pragma: no branch
-            src.append('1.')
+            self.new_line('1.')
         else:  # pragma: no cover
-            print(r"\item has unknown parent node", node.parent.name)
-
-    def _has_trailing_whitespace_and_nl(self, s):
-        x = self._ws.search(s)
-        return x and '\n' in x.groups()[1]
+            logger.warning(
+                "\\item has unknown parent node %s", node.parent.name
+            )
 
     def _handle_itemize(self, node):
         if self.current['cell_type'] == 'code':
             self._make_cell(slide_type='-')
-        for item in node.contents:
-            self._walk(item)
-        return True
+        return False
 
     _handle_enumerate = _handle_itemize
 
@@ -237,17 +1391,24 @@ class Tex2Cells(object):
             self._make_cell(cell_type='code', slide_type='-')
         del cell
         src = []
-        code = self.listings[self._listings_count]
+        listings = self.listings
+        code = listings[self._listings_count]
+        first = self._preprocessed.line_number(
+            listings.spans[self._listings_count][0]
+        )
         START = ('In []:', '...:', '....:', '.....:')
-        for line in code:
+        for n, line in enumerate(code):
             llstrip = line.lstrip()
-            if llstrip.startswith(START):
-                idx = line.index(':') + 2
-                src.append(line[idx:])
-            elif llstrip.startswith('Out[]:'):
+            if llstrip.startswith('Out[]:'):
                 self.current['source'] = src
                 self._make_cell(cell_type='code', slide_type='-')
                 src = []
+                continue
+            if not src:
+                self.current.line = first + n
+            if llstrip.startswith(START):
+                idx = line.index(':') + 2
+                src.append(line[idx:])
             else:
                 src.append(line)
         if len(src) > 0:
@@ -267,18 +1428,11 @@ class Tex2Cells(object):
         self._make_cell(slide_type='fragment')
 
     def _handle_textbf(self, node):
-        src = self.current['source']
-        if len(src) == 0:
-            src.append('')
-
-        src[-1] += '**%s** ' % node.string
+        self.append_inline('**%s** ' % node.string)
         return True
 
     def _handle_texttt(self, node):
-        src = self.current['source']
-        if len(src) == 0:
-            src.append('')
-        src[-1] += '`%s` ' % node.string
+        self.append_inline('`%s` ' % node.string)
         return True
 
     _handle_lstinline = _handle_texttt
@@ -307,10 +1461,15 @@ class Tex2Cells(object):
         src.append('**%s**\n' % self.info.get('date', 'Date'))
         src.append('\n')
 
+    def _handle_graphicspath(self, node):
+        if node.args:
+            self.graphics_path = re.findall(r'{([^{}]*)}', str(node.args[0]))
+        return True
+
     def _handle_pgfimage(self, node):
         src = self.current['source']
         data = list(node.contents)
-        image = get_real_image_from_path(data[-1])
+        image = self.resolve_image(data[-1])
         src.append('<img src="%s"/>\n' % image)
         return True
 
@@ -342,21 +1501,22 @@ class Tex2Cells(object):
         self.current = None
 
     def _handle_hrule(self, node):
-        self.current['source'].append('\n----\n')
+        self.new_line('\n----\n')
 
     def _handle_section(self, node):
         self._make_cell()
-        self.current['source'].append('## %s\n' % node.string)
+        self.current.section = str(node.string)
+        self.new_line('## %s\n' % node.string)
         return True
 
     def _handle_subsection(self, node):
         self._make_cell()
-        self.current['source'].append('### %s\n' % node.string)
+        self.new_line('### %s\n' % node.string)
         return True
 
     def _handle_subsubsection(self, node):
         self._make_cell()
-        self.current['source'].append('#### %s\n' % node.string)
+        self.new_line('#### %s\n' % node.string)
         return True
 
     def _ignore(self, node):
@@ -383,12 +1543,16 @@ class Tex2Cells(object):
     _handle_hspace_star = _ignore_children
 
     def _handle_unknown(self, node):
-        src = self.current['source']
-        if len(src) == 0:
-            src.append('')
-
-        src[-1] += '\\%s ' % node.name
-        print("No handler for ", node.name)
+        self.append_inline('\\%s ' % node.name)
+        line = None
+        position = node.position
+        if position is not None and position >= 0:
+            line = self._preprocessed.line_number(self._offset + position)
+        name = str(node.name)
+        self.diagnostics.add_unknown(name, line)
+        logger.log(
+            self.unknown_log_level, "No handler for %s at line %s", name, line
+        )
 
     ####################################################################
     # The following are not generic LaTeX commands but specific to
@@ -401,7 +1565,7 @@ class Tex2Cells(object):
             return True
         self._make_cell(slide_type='slide')
         src = self.current['source']
-        image = get_real_image_from_path(data[-1])
+        image = self.resolve_image(data[-1])
         src.append('<img width="100%%" src="%s"/>\n' % image)
         return True
 
@@ -411,7 +1575,7 @@ class Tex2Cells(object):
             return True
         self._make_cell(slide_type='slide')
         src = self.current['source']
-        image = get_real_image_from_path(data[-1])
+        image = self.resolve_image(data[-1])
         src.append('<img height="100%%" src="%s"/>\n' % image)
         return True
 